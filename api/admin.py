@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Robot, RobotStateHistory
+from .models import (
+    Robot, RobotStateHistory, RobotStateRollup, RobotConnectionSession, RobotStateValue, RobotHeatmapTile, AlertRule,
+    HistoryCheckpoint, RobotStateDeadLetter,
+)
 
 @admin.register(Robot)
 class RobotAdmin(admin.ModelAdmin):
@@ -11,3 +14,43 @@ class RobotStateHistoryAdmin(admin.ModelAdmin):
     list_display = ('robot', 'timestamp')
     search_fields = ('robot__unique_robot_id', 'robot__robot_id')
     list_filter = ('timestamp',)
+
+@admin.register(RobotStateRollup)
+class RobotStateRollupAdmin(admin.ModelAdmin):
+    list_display = ('robot', 'resolution', 'bucket_start', 'count')
+    search_fields = ('robot__unique_robot_id', 'robot__robot_id')
+    list_filter = ('resolution', 'bucket_start')
+
+@admin.register(RobotConnectionSession)
+class RobotConnectionSessionAdmin(admin.ModelAdmin):
+    list_display = ('robot', 'connected_at', 'disconnected_at', 'close_code', 'messages')
+    search_fields = ('robot__unique_robot_id', 'robot__robot_id')
+    list_filter = ('connected_at',)
+
+@admin.register(RobotStateValue)
+class RobotStateValueAdmin(admin.ModelAdmin):
+    list_display = ('robot', 'key', 'number', 'text', 'timestamp')
+    search_fields = ('robot__unique_robot_id', 'robot__robot_id', 'key')
+    list_filter = ('key', 'timestamp')
+
+@admin.register(RobotHeatmapTile)
+class RobotHeatmapTileAdmin(admin.ModelAdmin):
+    list_display = ('owner', 'bucket_start', 'tile_x', 'tile_y', 'count')
+    search_fields = ('owner__username',)
+    list_filter = ('bucket_start',)
+
+@admin.register(AlertRule)
+class AlertRuleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'owner', 'robot', 'cooldown', 'enabled', 'updated_at')
+    search_fields = ('name', 'owner__username', 'robot__unique_robot_id')
+    list_filter = ('enabled',)
+
+@admin.register(HistoryCheckpoint)
+class HistoryCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('name', 'history_id', 'recorded_at')
+
+@admin.register(RobotStateDeadLetter)
+class RobotStateDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('unique_robot_id', 'timestamp', 'attempts', 'created_at')
+    search_fields = ('unique_robot_id',)
+    list_filter = ('created_at',)
@@ -0,0 +1,88 @@
+from django.conf import settings
+from . import metrics
+import asyncio
+import random
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ロボット接続のアドミッション制御
+#   ハンドシェイク: DB を使う接続処理の同時実行数を制限し、空きを待てなかった接続はバックオフを指示して閉じる
+#   メッセージ: ロボットごと・所有者ごとのトークンバケットで受信フレーム数を制限する
+BACKOFF_CLOSE_CODE = 4029  # 混雑のため切断した（retry_after 秒以上あけて再接続すること）
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, current_time, amount=1):
+        # 取得できれば 0、できなければ取得できるまでの秒数を返す
+        self.tokens = min(self.burst, self.tokens + (current_time - self.updated) * self.rate)
+        self.updated = current_time
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class AdmissionController:
+
+    def __init__(self):
+        self.pending_handshakes = 0
+        self.handshake_slots = None
+        self.loop = None
+        self.owner_buckets = {}  # { owner: TokenBucket }
+
+    def _slots(self):
+        # セマフォはイベントループに結び付くため、ループが変わったら作り直す
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.handshake_slots = asyncio.Semaphore(settings.ROBOT_MAX_PENDING_HANDSHAKES)
+        return self.handshake_slots
+
+    async def acquire_handshake(self):
+        # 空きを ROBOT_HANDSHAKE_TIMEOUT 秒まで待つ。待てなかった場合は False
+        slots = self._slots()
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout=settings.ROBOT_HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.ADMISSION_REJECTED.inc(1, "handshake")
+            return False
+        self.pending_handshakes += 1
+        metrics.PENDING_HANDSHAKES.set(self.pending_handshakes)
+        return True
+
+    def release_handshake(self):
+        self.pending_handshakes -= 1
+        metrics.PENDING_HANDSHAKES.set(self.pending_handshakes)
+        self.handshake_slots.release()
+
+    @staticmethod
+    def robot_bucket():
+        limit = settings.ROBOT_RATE_LIMITS["robot"]
+        return TokenBucket(limit["rate"], limit["burst"]) if limit["rate"] else None
+
+    def owner_bucket(self, owner):
+        limit = settings.ROBOT_RATE_LIMITS["owner"]
+        if not limit["rate"] or owner is None:
+            return None
+        bucket = self.owner_buckets.get(owner)
+        if bucket is None:
+            bucket = self.owner_buckets[owner] = TokenBucket(limit["rate"], limit["burst"])
+        return bucket
+
+    @staticmethod
+    def retry_after(minimum=0.0):
+        # 一斉に再接続しないようにばらつかせた待ち時間
+        return round(max(minimum, random.uniform(1.0, settings.ROBOT_RECONNECT_BACKOFF)), 1)
+
+
+admission_controller = AdmissionController()
@@ -0,0 +1,236 @@
+from .models import AlertRule
+from .spatial import get_position_fields, extract_position
+from . import metrics
+import math
+import operator
+import logging
+
+logger = logging.getLogger(__name__)
+
+# アラートのルール
+# 条件は JSON で書き、読み込み時に1度だけ評価関数（クロージャ）にコンパイルする
+#   {"field": "battery", "op": "lt", "value": 15}        状態のキーの比較 (lt, lte, gt, gte, eq, ne, in)
+#   {"zone": [x0, y0, x1, y1]}                          位置 (ROBOT_POSITION_FIELDS) が矩形内
+#   {"silent_for": 30}                                  最後のメッセージからの秒数
+#   {"all": [...]}, {"any": [...]}, {"not": {...}}      組み合わせ
+# 例: 区域内での速度超過 {"all": [{"field": "speed", "op": "gt", "value": 1.5}, {"zone": [0, 0, 10, 10]}]}
+NUMBER_OPERATORS = {
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+}
+ALERT_FIRING = "firing"
+ALERT_RESOLVED = "resolved"
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def compile_condition(spec):
+    # (評価関数, 時間に依存するか) を返す。評価関数は (state, 最後のメッセージからの秒数) -> bool
+    # 不正な条件は ValueError
+    if not isinstance(spec, dict) or len(spec) == 0:
+        raise ValueError("条件はオブジェクトで指定してください。")
+
+    if "field" in spec:
+        field, op, expected = spec["field"], spec.get("op"), spec.get("value")
+        if not isinstance(field, str) or not field:
+            raise ValueError("field には状態のキーを指定してください。")
+        if op in NUMBER_OPERATORS:
+            if not _is_number(expected):
+                raise ValueError(f"op '{op}' の value には数値を指定してください。")
+            compare = NUMBER_OPERATORS[op]
+            return (lambda state, silent: _is_number(value := state.get(field)) and compare(value, expected)), False
+        if op == "eq":
+            return (lambda state, silent: field in state and state[field] == expected), False
+        if op == "ne":
+            return (lambda state, silent: field in state and state[field] != expected), False
+        if op == "in":
+            if not isinstance(expected, list):
+                raise ValueError("op 'in' の value には配列を指定してください。")
+            choices = list(expected)
+            return (lambda state, silent: field in state and state[field] in choices), False
+        raise ValueError(f"op には {', '.join(list(NUMBER_OPERATORS) + ['eq', 'ne', 'in'])} のいずれかを指定してください。")
+
+    if "zone" in spec:
+        zone = spec["zone"]
+        if not isinstance(zone, list) or len(zone) != 4 or not all(_is_number(value) for value in zone):
+            raise ValueError("zone には [x0, y0, x1, y1] を数値で指定してください。")
+        fields = get_position_fields()
+        if fields is None:
+            raise ValueError("zone を使うには ROBOT_POSITION_FIELDS を設定してください。")
+        x0, x1 = min(zone[0], zone[2]), max(zone[0], zone[2])
+        y0, y1 = min(zone[1], zone[3]), max(zone[1], zone[3])
+
+        def in_zone(state, silent):
+            position = extract_position(state, fields)
+            return position is not None and x0 <= position[0] <= x1 and y0 <= position[1] <= y1
+        return in_zone, False
+
+    if "silent_for" in spec:
+        seconds = spec["silent_for"]
+        if not _is_number(seconds) or seconds <= 0:
+            raise ValueError("silent_for には正の秒数を指定してください。")
+        return (lambda state, silent: silent >= seconds), True
+
+    if "all" in spec or "any" in spec:
+        key = "all" if "all" in spec else "any"
+        if not isinstance(spec[key], list) or not spec[key]:
+            raise ValueError(f"{key} には条件の配列を指定してください。")
+        compiled = [compile_condition(child) for child in spec[key]]
+        evaluators = tuple(evaluate for evaluate, _ in compiled)
+        uses_time = any(child_uses_time for _, child_uses_time in compiled)
+        if key == "all":
+            return (lambda state, silent: all(evaluate(state, silent) for evaluate in evaluators)), uses_time
+        return (lambda state, silent: any(evaluate(state, silent) for evaluate in evaluators)), uses_time
+
+    if "not" in spec:
+        evaluate, uses_time = compile_condition(spec["not"])
+        return (lambda state, silent: not evaluate(state, silent)), uses_time
+
+    raise ValueError("条件には field, zone, silent_for, all, any, not のいずれかを指定してください。")
+
+
+class CompiledRule:
+    __slots__ = ("id", "owner", "unique_robot_id", "name", "cooldown", "updated_at", "evaluate", "uses_time")
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.owner = row["owner__username"]
+        self.unique_robot_id = row["robot__unique_robot_id"]  # None は所有者の全ロボット
+        self.name = row["name"]
+        self.cooldown = row["cooldown"]
+        self.updated_at = row["updated_at"]
+        self.evaluate, self.uses_time = compile_condition(row["condition"])
+
+
+def load_alert_rules():
+    return list(AlertRule.objects.filter(enabled=True).values(
+        "id", "owner__username", "robot__unique_robot_id", "name", "condition", "cooldown", "updated_at",
+    ))
+
+
+class AlertEngine:
+    # 配信タスクがティックごとに各ロボットの最新状態を渡し、ルールをまとめて評価する
+    #   変化したロボット: そのロボットの所有者のルールを全て評価する
+    #   一定間隔の見回り: 時間に依存するルール（silent_for）と、クールダウン中で通知を保留した組み合わせを評価する
+    # (ルール, ロボット) ごとに発生中かどうかを持ち、発生・解消の変化があったときだけイベントを返す
+
+    def __init__(self):
+        self.rules = {}  # { rule_id: CompiledRule }
+        self.owner_rules = {}  # { owner: [CompiledRule, ...] }
+        self.robots = {}  # { unique_robot_id: (owner, robot_id, state, 最後にメッセージを受け取った時刻) }
+        self.active = set()  # 発生中の (rule_id, unique_robot_id)
+        self.suppressed = set()  # 条件を満たしたがクールダウン中で通知していない (rule_id, unique_robot_id)
+        self.last_fired = {}  # { (rule_id, unique_robot_id): 最後に通知した時刻 }
+
+    def load(self, rows):
+        # 更新時刻が変わったルールだけコンパイルし直す
+        rules = {}
+        for row in rows:
+            rule = self.rules.get(row["id"])
+            if rule is None or rule.updated_at != row["updated_at"]:
+                try:
+                    rule = CompiledRule(row)
+                except ValueError as e:
+                    logger.error(f"Alert rule {row['id']} could not be compiled: {e}")
+                    metrics.ALERT_RULE_ERRORS.inc()
+                    continue
+            rules[rule.id] = rule
+        self.rules = rules
+        self.owner_rules = {}
+        for rule in rules.values():
+            self.owner_rules.setdefault(rule.owner, []).append(rule)
+
+        # 削除・無効化されたルールの状態を捨てる
+        self.active = {key for key in self.active if key[0] in rules}
+        self.suppressed = {key for key in self.suppressed if key[0] in rules}
+        self.last_fired = {key: fired_at for key, fired_at in self.last_fired.items() if key[0] in rules}
+        metrics.ALERT_RULES.set(len(rules))
+
+    def observe(self, unique_robot_id, owner, robot_id, state, current_time, received):
+        # received: このティックでメッセージを受け取った（接続・切断の通知だけの場合は False）
+        previous = self.robots.get(unique_robot_id)
+        seen_at = current_time if previous is None or received else previous[3]
+        self.robots[unique_robot_id] = (owner, robot_id, state if isinstance(state, dict) else {}, seen_at)
+
+    def seed(self, unique_robot_id, owner, robot_id, state, seen_at):
+        # 配信を引き継いだときの初期値（seen_at は保存されている最後のメッセージの時刻）
+        # 引き継いだ後にすでに受け取ったロボットは上書きしない
+        if unique_robot_id not in self.robots:
+            self.robots[unique_robot_id] = (owner, robot_id, state if isinstance(state, dict) else {}, seen_at)
+
+    def prune(self, unique_robot_ids):
+        # unique_robot_ids（登録済みのロボット）に含まれないロボットの状態を捨てる
+        self.robots = {uid: robot for uid, robot in self.robots.items() if uid in unique_robot_ids}
+        self.active = {key for key in self.active if key[1] in self.robots}
+        self.suppressed = {key for key in self.suppressed if key[1] in self.robots}
+        self.last_fired = {key: fired_at for key, fired_at in self.last_fired.items() if key[1] in self.robots}
+
+    def _check(self, rule, unique_robot_id, robot, current_time, events):
+        owner, robot_id, state, seen_at = robot
+        key = (rule.id, unique_robot_id)
+        if rule.evaluate(state, current_time - seen_at):
+            if key in self.active:
+                return
+            if current_time - self.last_fired.get(key, -math.inf) < rule.cooldown:
+                self.suppressed.add(key)
+                return
+            self.suppressed.discard(key)
+            self.active.add(key)
+            self.last_fired[key] = current_time
+            status = ALERT_FIRING
+        else:
+            self.suppressed.discard(key)
+            if key not in self.active:
+                return
+            self.active.discard(key)
+            status = ALERT_RESOLVED
+        events.append({
+            "status": status,
+            "rule_id": rule.id,
+            "rule": rule.name,
+            "owner": owner,
+            "unique_robot_id": unique_robot_id,
+            "robot_id": robot_id,
+            "at": current_time,
+        })
+
+    def evaluate(self, unique_robot_ids, current_time):
+        # 変化したロボットを評価し、(イベント, 評価した件数) を返す
+        events = []
+        evaluations = 0
+        for unique_robot_id in unique_robot_ids:
+            robot = self.robots.get(unique_robot_id)
+            if robot is None:
+                continue
+            for rule in self.owner_rules.get(robot[0], ()):
+                if rule.unique_robot_id is not None and rule.unique_robot_id != unique_robot_id:
+                    continue
+                evaluations += 1
+                self._check(rule, unique_robot_id, robot, current_time, events)
+        return events, evaluations
+
+    def sweep(self, current_time):
+        # 時間に依存するルールとクールダウン中の組み合わせを評価する
+        events = []
+        evaluations = 0
+        timed = {owner: [rule for rule in rules if rule.uses_time] for owner, rules in self.owner_rules.items()}
+        checked = set()
+        for unique_robot_id, robot in self.robots.items():
+            for rule in timed.get(robot[0], ()):
+                if rule.unique_robot_id is not None and rule.unique_robot_id != unique_robot_id:
+                    continue
+                evaluations += 1
+                checked.add((rule.id, unique_robot_id))
+                self._check(rule, unique_robot_id, robot, current_time, events)
+        for rule_id, unique_robot_id in list(self.suppressed - checked):
+            robot = self.robots.get(unique_robot_id)
+            if robot is None:
+                self.suppressed.discard((rule_id, unique_robot_id))
+                continue
+            evaluations += 1
+            self._check(self.rules[rule_id], unique_robot_id, robot, current_time, events)
+        return events, evaluations
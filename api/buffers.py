@@ -0,0 +1,374 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django.utils.dateparse import parse_datetime
+from collections import deque
+import json
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BaseStateBuffer:
+    # 履歴書き込み待ちのキャッシュとフロントエンド送信待ちのバッファを保持するバックエンド
+    # 複数ワーカーで共有する場合は pop_* がアトミックであること
+
+    durable = False  # プロセスが停止しても書き込み待ちの履歴が残る（先行書き込みログを使わない）
+
+    def __init__(self, **options):
+        self.options = options
+
+    async def append_history(self, unique_robot_id, samples):
+        # サンプルのリストを末尾に追加し、追加後のキャッシュ件数を返す
+        raise NotImplementedError
+
+    async def prepend_history(self, unique_robot_id, samples):
+        # 書き込みに失敗したサンプルを先頭に戻す
+        raise NotImplementedError
+
+    async def has_history(self):
+        raise NotImplementedError
+
+    async def pop_history(self, unique_robot_ids=None):
+        # { unique_robot_id: [sample, ...] } を取り出してキャッシュから削除する
+        raise NotImplementedError
+
+    async def merge_frontend(self, unique_robot_id, meta, state_changes, removed=()):
+        # 次の配信までに届いた更新をロボットごとに合成する（同じキーは後勝ち）
+        raise NotImplementedError
+
+    async def pop_frontend(self):
+        # { unique_robot_id: {"meta", "state", "removed"} } を取り出してバッファから削除する
+        raise NotImplementedError
+
+    async def update_latest(self, updates):
+        # pop_frontend の結果を各ロボットの最新状態に反映する（新規接続へのスナップショット用）
+        raise NotImplementedError
+
+    async def get_latest(self, unique_robot_ids):
+        # { unique_robot_id: {"meta", "state"} }
+        raise NotImplementedError
+
+    async def append_streams(self, epoch, entries):
+        # 配信したフレームを購読単位（ストリーム）ごとの再開用リングバッファに追加する
+        # entries: { stream: (seq, text) }。seq が 1 のストリームは新しい epoch の始まりなので古いフレームを捨てる
+        raise NotImplementedError
+
+    async def read_stream(self, stream):
+        # {"epoch", "seq": 最後に配信した seq, "entries": [(seq, text), ...]}
+        raise NotImplementedError
+
+    async def acquire_lock(self, name, ttl):
+        # 定期タスクをクラスタ内で1プロセスだけが実行するためのロック（保持中は延長）
+        raise NotImplementedError
+
+    async def sizes(self):
+        # メトリクス用 {"history_rows", "history_robots", "frontend_robots"}
+        raise NotImplementedError
+
+
+class InMemoryStateBuffer(BaseStateBuffer):
+    # プロセス内の dict を使う既定のバックエンド（単一ワーカー向け）
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.robot_cache = {}  # { unique_robot_id: [データキャッシュリスト] }
+        self.frontend_data = {}  # フロントエンド更新用キャッシュ
+        self.latest = {}  # { unique_robot_id: {"meta", "state"} }
+        self.streams = {}  # { stream: {"epoch", "seq", "entries": deque([(seq, text)])} }
+
+    async def append_history(self, unique_robot_id, samples):
+        cache = self.robot_cache.setdefault(unique_robot_id, [])
+        cache.extend(samples)
+        return len(cache)
+
+    async def prepend_history(self, unique_robot_id, samples):
+        self.robot_cache[unique_robot_id] = list(samples) + self.robot_cache.get(unique_robot_id, [])
+
+    async def has_history(self):
+        return any(self.robot_cache.values())
+
+    async def pop_history(self, unique_robot_ids=None):
+        snapshot = {}
+        for unique_robot_id in list(unique_robot_ids or self.robot_cache.keys()):
+            cache = self.robot_cache.pop(unique_robot_id, None)
+            if cache:
+                snapshot[unique_robot_id] = cache
+        return snapshot
+
+    async def merge_frontend(self, unique_robot_id, meta, state_changes, removed=()):
+        entry = self.frontend_data.get(unique_robot_id)
+        if entry is None:
+            entry = self.frontend_data[unique_robot_id] = {"meta": {}, "state": {}, "removed": set()}
+        entry["meta"].update(meta)
+        entry["state"].update(state_changes)
+        entry["removed"].difference_update(state_changes)
+        for key in removed:
+            entry["state"].pop(key, None)
+            entry["removed"].add(key)
+
+    async def pop_frontend(self):
+        data, self.frontend_data = self.frontend_data, {}
+        for entry in data.values():
+            entry["removed"] = sorted(entry["removed"])
+        return data
+
+    async def update_latest(self, updates):
+        for unique_robot_id, update in updates.items():
+            latest = self.latest.setdefault(unique_robot_id, {"meta": {}, "state": {}})
+            latest["meta"].update(update["meta"])
+            latest["state"].update(update["state"])
+            for key in update["removed"]:
+                latest["state"].pop(key, None)
+
+    async def get_latest(self, unique_robot_ids):
+        return {
+            unique_robot_id: self.latest[unique_robot_id]
+            for unique_robot_id in unique_robot_ids
+            if unique_robot_id in self.latest
+        }
+
+    async def append_streams(self, epoch, entries):
+        for stream, (seq, text) in entries.items():
+            ring = self.streams.get(stream)
+            if ring is None or seq == 1:
+                ring = self.streams[stream] = {
+                    "epoch": epoch, "seq": 0, "entries": deque(maxlen=settings.ROBOT_FRONTEND_RESUME_BUFFER),
+                }
+            ring["epoch"] = epoch
+            ring["seq"] = seq
+            ring["entries"].append((seq, text))
+
+    async def read_stream(self, stream):
+        ring = self.streams.get(stream)
+        if ring is None:
+            return {"epoch": None, "seq": 0, "entries": []}
+        return {"epoch": ring["epoch"], "seq": ring["seq"], "entries": list(ring["entries"])}
+
+    async def acquire_lock(self, name, ttl):
+        return True
+
+    async def sizes(self):
+        return {
+            "history_rows": sum(len(cache) for cache in self.robot_cache.values()),
+            "history_robots": sum(1 for cache in self.robot_cache.values() if cache),
+            "frontend_robots": len(self.frontend_data),
+        }
+
+
+class RedisStateBuffer(BaseStateBuffer):
+    # Redis を使う共有バックエンド（複数ワーカー・複数ノード向け）
+    # 履歴: ロボットごとのリスト + 書き込み待ちロボットのセット
+    # フロントエンド: ロボットごとのハッシュ {"m:<キー>": メタ情報, "s:<キー>": 状態, "r:<キー>": 削除されたキー}
+    #                + 配信待ちロボットのセット（最新状態も同じ形式のハッシュ）
+    # 再開用バッファ: ストリームごとのリスト + 先頭情報
+
+    # 自分が保持しているロックだけを延長する
+    EXTEND_LOCK_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) and 1 or 0
+    """
+
+    STREAM_TTL = 600  # 配信が止まったストリームの再開用バッファを残す秒数
+    durable = True
+
+    def __init__(self, url="redis://127.0.0.1:6379/1", prefix="robot_state", client=None, **options):
+        super().__init__(**options)
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+        self.token = uuid.uuid4().hex  # ロック所有者の識別子
+
+    def _key(self, *parts):
+        return ":".join((self.prefix,) + parts)
+
+    @staticmethod
+    def _dump_sample(sample):
+        sample = dict(sample)
+        sample["timestamp"] = sample["timestamp"].isoformat()
+        return json.dumps(sample)
+
+    @staticmethod
+    def _load_sample(raw):
+        sample = json.loads(raw)
+        sample["timestamp"] = parse_datetime(sample["timestamp"])
+        return sample
+
+    async def append_history(self, unique_robot_id, samples):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(self._key("history", unique_robot_id), *[self._dump_sample(sample) for sample in samples])
+            pipe.sadd(self._key("history_robots"), unique_robot_id)
+            length, _ = await pipe.execute()
+        return length
+
+    async def prepend_history(self, unique_robot_id, samples):
+        if not samples:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(self._key("history", unique_robot_id), *[self._dump_sample(sample) for sample in reversed(samples)])
+            pipe.sadd(self._key("history_robots"), unique_robot_id)
+            await pipe.execute()
+
+    async def has_history(self):
+        return await self.redis.scard(self._key("history_robots")) > 0
+
+    async def pop_history(self, unique_robot_ids=None):
+        if unique_robot_ids is None:
+            unique_robot_ids = [uid.decode("utf-8") for uid in await self.redis.smembers(self._key("history_robots"))]
+        snapshot = {}
+        for unique_robot_id in unique_robot_ids:
+            key = self._key("history", unique_robot_id)
+            # LRANGE と DEL を MULTI で実行し、他ワーカーと同じ行を二重に取り出さない
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.lrange(key, 0, -1)
+                pipe.delete(key)
+                pipe.srem(self._key("history_robots"), unique_robot_id)
+                raw_samples, _, _ = await pipe.execute()
+            if raw_samples:
+                snapshot[unique_robot_id] = [self._load_sample(raw) for raw in raw_samples]
+        return snapshot
+
+    @staticmethod
+    def _dump_fields(meta, state):
+        fields = {f"m:{key}": json.dumps(value) for key, value in meta.items()}
+        fields.update({f"s:{key}": json.dumps(value) for key, value in state.items()})
+        return fields
+
+    @staticmethod
+    def _load_fields(raw_fields):
+        entry = {"meta": {}, "state": {}, "removed": []}
+        for field, raw in raw_fields.items():
+            kind, key = field.decode("utf-8").split(":", 1)
+            if kind == "m":
+                entry["meta"][key] = json.loads(raw)
+            elif kind == "s":
+                entry["state"][key] = json.loads(raw)
+            else:
+                entry["removed"].append(key)
+        entry["removed"].sort()
+        return entry
+
+    async def merge_frontend(self, unique_robot_id, meta, state_changes, removed=()):
+        key = self._key("frontend", unique_robot_id)
+        fields = self._dump_fields(meta, state_changes)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            # 空の mapping を渡すと redis.DataError になる（削除だけの更新など）
+            if fields:
+                pipe.hset(key, mapping=fields)
+            if state_changes:
+                pipe.hdel(key, *[f"r:{field}" for field in state_changes])
+            if removed:
+                pipe.hdel(key, *[f"s:{field}" for field in removed])
+                pipe.hset(key, mapping={f"r:{field}": 1 for field in removed})
+            pipe.sadd(self._key("frontend_robots"), unique_robot_id)
+            await pipe.execute()
+
+    async def pop_frontend(self):
+        unique_robot_ids = [uid.decode("utf-8") for uid in await self.redis.smembers(self._key("frontend_robots"))]
+        if not unique_robot_ids:
+            return {}
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for unique_robot_id in unique_robot_ids:
+                pipe.hgetall(self._key("frontend", unique_robot_id))
+                pipe.delete(self._key("frontend", unique_robot_id))
+            pipe.srem(self._key("frontend_robots"), *unique_robot_ids)
+            results = await pipe.execute()
+        return {
+            unique_robot_id: self._load_fields(raw_fields)
+            for unique_robot_id, raw_fields in zip(unique_robot_ids, results[0:-1:2])
+            if raw_fields
+        }
+
+    async def update_latest(self, updates):
+        if not updates:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for unique_robot_id, update in updates.items():
+                key = self._key("latest", unique_robot_id)
+                fields = self._dump_fields(update["meta"], update["state"])
+                if fields:
+                    pipe.hset(key, mapping=fields)
+                if update["removed"]:
+                    pipe.hdel(key, *[f"s:{field}" for field in update["removed"]])
+            await pipe.execute()
+
+    async def get_latest(self, unique_robot_ids):
+        unique_robot_ids = list(unique_robot_ids)
+        if not unique_robot_ids:
+            return {}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for unique_robot_id in unique_robot_ids:
+                pipe.hgetall(self._key("latest", unique_robot_id))
+            results = await pipe.execute()
+        latest = {}
+        for unique_robot_id, raw_fields in zip(unique_robot_ids, results):
+            if raw_fields:
+                entry = self._load_fields(raw_fields)
+                latest[unique_robot_id] = {"meta": entry["meta"], "state": entry["state"]}
+        return latest
+
+    async def append_streams(self, epoch, entries):
+        # リスト "<seq> <text>" と先頭情報 "<epoch> <seq>"。配信が止まったストリームは期限切れで消える
+        if not entries:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for stream, (seq, text) in entries.items():
+                key = self._key("stream", stream)
+                if seq == 1:
+                    pipe.delete(key)
+                pipe.rpush(key, f"{seq} {text}")
+                pipe.ltrim(key, -settings.ROBOT_FRONTEND_RESUME_BUFFER, -1)
+                pipe.expire(key, self.STREAM_TTL)
+                pipe.set(self._key("stream_head", stream), f"{epoch} {seq}", ex=self.STREAM_TTL)
+            await pipe.execute()
+
+    async def read_stream(self, stream):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(self._key("stream_head", stream))
+            pipe.lrange(self._key("stream", stream), 0, -1)
+            head, raw_entries = await pipe.execute()
+        if head is None:
+            return {"epoch": None, "seq": 0, "entries": []}
+        epoch, seq = head.decode("utf-8").split(" ")
+        entries = []
+        for raw in raw_entries:
+            entry_seq, text = raw.decode("utf-8").split(" ", 1)
+            entries.append((int(entry_seq), text))
+        return {"epoch": epoch, "seq": int(seq), "entries": entries}
+
+    async def acquire_lock(self, name, ttl):
+        acquired = await self.redis.eval(
+            self.EXTEND_LOCK_SCRIPT, 1, self._key("lock", name), self.token, int(ttl * 1000)
+        )
+        return bool(acquired)
+
+    async def sizes(self):
+        unique_robot_ids = await self.redis.smembers(self._key("history_robots"))
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for unique_robot_id in unique_robot_ids:
+                pipe.llen(self._key("history", unique_robot_id.decode("utf-8")))
+            pipe.scard(self._key("frontend_robots"))
+            results = await pipe.execute()
+        return {
+            "history_rows": sum(results[:-1]),
+            "history_robots": len(unique_robot_ids),
+            "frontend_robots": results[-1],
+        }
+
+
+_state_buffer = None
+
+
+def get_state_buffer():
+    # settings.ROBOT_STATE_BUFFER で指定されたバックエンドをプロセスごとに1つ生成する
+    global _state_buffer
+    if _state_buffer is None:
+        config = getattr(settings, "ROBOT_STATE_BUFFER", {})
+        backend = import_string(config.get("BACKEND", "api.buffers.InMemoryStateBuffer"))
+        _state_buffer = backend(**config.get("OPTIONS", {}))
+        logger.info(f"Robot state buffer backend: {backend.__name__}")
+    return _state_buffer
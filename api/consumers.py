@@ -1,31 +1,102 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
 from channels.layers import get_channel_layer
-from django.utils.timezone import now
-from django.db import transaction
-from .models import Robot, RobotStateHistory
+from django.utils.timezone import now, is_naive, make_aware
+from django.utils.dateparse import parse_datetime
+from .models import Robot
+from . import registry
+from .history import write_state_history, maintain_history
+from django.conf import settings
+from .buffers import get_state_buffer
+from .spool import get_spool, load_spooled, sync_and_close
+from .fleet import FleetAggregator, get_fleet_fields
+from .spatial import get_spatial_index, get_position_fields, extract_position
+from .alerts import AlertEngine, load_alert_rules
+from .db import shutdown_executors
+from .policies import get_policy
+from .liveness import liveness_monitor
+from .admission import admission_controller, BACKOFF_CLOSE_CODE
+from .sessions import session_recorder, write_sessions
+from .current_state import invalidate_robot_cache
+from .timeseries import replay_rows
+from . import metrics
+from .db import db_sync_to_async, DBExecutorConsumerMixin
 from django.contrib.auth.models import User
 import time
 import json
+import re
+import shutil
+import uuid
+import hashlib
 import asyncio
 import logging
+from datetime import datetime, timezone as dt_timezone
+from urllib.parse import parse_qsl
+
+try:
+    import msgpack
+except ImportError:  # MessagePack でのフロントエンド配信は任意
+    msgpack = None
 
 # ロギング設定
 logger = logging.getLogger(__name__)
-connected_robots = set()
+connected_robots = {}  # { unique_robot_id: 接続中の RobotStateConsumer }
+
+
+def parse_sample_timestamp(value, received_at):
+    # デバイス側の時刻を datetime に変換する（未指定・未来すぎる時刻は受信時刻を使う）
+    # 履歴の保持期間より古い時刻は None（保存してもすぐに削除され、ロールアップ済みの区間に混ざるため破棄する）
+    if value is None:
+        return received_at
+    if msgpack is not None and isinstance(value, msgpack.Timestamp):
+        timestamp = value.to_datetime()
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        timestamp = datetime.fromtimestamp(value, tz=dt_timezone.utc)
+    else:
+        timestamp = parse_datetime(str(value))
+        if timestamp is None:
+            raise ValueError(f"Invalid timestamp: {value!r}")
+        if is_naive(timestamp):
+            timestamp = make_aware(timestamp, dt_timezone.utc)
+    skew = (timestamp - received_at).total_seconds()
+    if skew > settings.ROBOT_MAX_CLOCK_SKEW:
+        metrics.SAMPLE_TIMESTAMPS_ADJUSTED.inc(1, "clamped")
+        return received_at
+    retention_days = settings.ROBOT_HISTORY_RETENTION_DAYS
+    if retention_days and -skew > retention_days * 86400:
+        metrics.SAMPLE_TIMESTAMPS_ADJUSTED.inc(1, "dropped")
+        return None
+    return timestamp
+
+# 履歴キャッシュとフロントエンド更新バッファは settings.ROBOT_STATE_BUFFER のバックエンドに保持する
+LATEST_CHUNK_SIZE = 500  # 最新状態をバッファから1度に読むロボット数
+
+# フロントエンド配信グループ
+FRONTEND_OWNER_GROUP_PREFIX = "frontend_owner_"  # ダッシュボード（所有者単位）
+FRONTEND_ROBOT_GROUP_PREFIX = "frontend_robot_"  # 詳細ページ（ロボット単位）
+_valid_group_name = re.compile(r"^[a-zA-Z0-9_.\-]{1,80}$")
 
-# グローバルキャッシュ
-shared_robot_cache = {}  # { unique_robot_id: [データキャッシュリスト] }
-shared_frontend_data_buffer = {}  # フロントエンド更新用キャッシュ
+def _group_name(prefix, key):
+    # channels のグループ名に使えない文字を含む場合はハッシュ化する
+    key = str(key)
+    if _valid_group_name.match(key):
+        return f"{prefix}{key}"
+    return f"{prefix}{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
 
-class RobotStateConsumer(AsyncWebsocketConsumer):
+def owner_group_name(username):
+    return _group_name(FRONTEND_OWNER_GROUP_PREFIX, username)
+
+def robot_group_name(unique_robot_id):
+    return _group_name(FRONTEND_ROBOT_GROUP_PREFIX, unique_robot_id)
+
+class RobotStateConsumer(DBExecutorConsumerMixin, AsyncWebsocketConsumer):
     # WebSocket関連設定
     frontend_update_interval = 0.2  # フロントエンド更新間隔（秒）
-    flush_interval = 30  # DBフラッシュ間隔（秒）
-    robot_connection_times = {}  # { unique_robot_id: 接続開始時刻 }
+    flush_interval = settings.ROBOT_FLUSH_INTERVAL  # DBフラッシュ間隔（秒）
     max_cache_size = 100  # キャッシュの最大サイズ
-    ping_interval = 60  # サーバーからpingを送信する間隔（秒）
+    ping_interval = 60  # この秒数受信がなければサーバーからpingを送信する
     pong_timeout = 10  # クライアントがpongを返さなかった場合に切断するまでのタイムアウト（秒）
+    dead_close_code = 4004  # 応答がなく切断した場合のクローズコード
+    throttle_notice_interval = 1.0  # 受信制限中の {"type": "throttle"} の送信間隔（秒）
 
     async def connect(self):
         query_string = self.scope.get("query_string", b"").decode("utf-8")
@@ -36,100 +107,293 @@ class RobotStateConsumer(AsyncWebsocketConsumer):
             logger.error("Connection refused: Missing unique_robot_id")
             return
 
-        try:
-            await self.create_robot_if_not_exists(
-                unique_robot_id=self.unique_robot_id,
-                robot_id="unknown",
-                owner="unknown"
-            )
-            
-        except Exception as e:
-            logger.error(f"Error during robot creation: {e}")
-            await self.close(code=4002)
-            return
+        # 再接続ではレジストリに登録済みのため DB を使わない
+        robot_entry = registry.get_robot(self.unique_robot_id)
+        if robot_entry is None:
+            if not await admission_controller.acquire_handshake():
+                logger.warning(f"Connection from {self.unique_robot_id} deferred: too many pending handshakes")
+                await self.reject_with_backoff()
+                return
+            try:
+                robot_entry = await self.create_robot_if_not_exists(
+                    unique_robot_id=self.unique_robot_id,
+                    robot_id="unknown",
+                    owner="unknown"
+                )
+
+            except Exception as e:
+                logger.error(f"Error during robot creation: {e}")
+                await self.close(code=4002)
+                return
+            finally:
+                admission_controller.release_handshake()
+
+        self.owner_username = robot_entry["owner"]
+        self.last_update_attempt = None
+        self.rate_limit = admission_controller.robot_bucket()
+        self.throttled_frames = 0  # 最後に受け付けたフレーム以降に破棄したフレーム数
+        self.throttle_notified_at = None
 
-        await self.channel_layer.group_add("robot_states", self.channel_name)
         await self.accept()
 
-        self.robot_connection_times[self.unique_robot_id] = time.time()
+        self.connected_at = time.time()  # 接続時間の表示用
+        self.frames_received = 0
+        self.session_key = session_recorder.open(robot_entry["id"], now())
 
-        # キャッシュ初期化
-        shared_robot_cache.setdefault(self.unique_robot_id, [])
-        shared_frontend_data_buffer.setdefault(self.unique_robot_id, {})
+        self.state_buffer = get_state_buffer()
+        self.persistence_policy = get_policy(self.unique_robot_id, self.owner_username)
+        self.last_persisted = None  # 最後に履歴キャッシュへ追加したサンプル
+        self.frontend_state = {}  # 最後にフロントエンドへ渡した状態（差分計算用）
+        self.frontend_timestamp = None  # frontend_state の時刻（これより古いサンプルは表示に反映しない）
 
-        connected_robots.add(self.unique_robot_id)
+        # 同じロボットの古い接続が残っていても新しい接続を正とする
+        connected_robots[self.unique_robot_id] = self
+        metrics.CONNECTED_ROBOTS.set(len(connected_robots))
+        self.offline = False
+        liveness_monitor.register(self)
+        await self.publish_presence(True, robot_entry["robot_id"])
         logger.info(f"Robot {self.unique_robot_id} connected. Currently connected robots: {len(connected_robots)}")
 
     async def disconnect(self, close_code):
         if self.unique_robot_id:
             try:
-                await self.channel_layer.group_discard("robot_states", self.channel_name)
-                connected_robots.discard(self.unique_robot_id)
+                await self.go_offline(close_code)
 
                 logger.info(f"Robot {self.unique_robot_id} disconnected. Remaining connections: {len(connected_robots)}")
             except Exception as e:
                 logger.error(f"Error during disconnect: {e}")
 
-    async def receive(self, text_data):
+    async def go_offline(self, close_code=None):
+        # 切断時と死活監視のタイムアウト時に1度だけ実行する
+        if getattr(self, "offline", True):
+            return
+        self.offline = True
+        liveness_monitor.unregister(self)
+        session_recorder.close(self.session_key, close_code, self.frames_received)
+        if connected_robots.get(self.unique_robot_id) is self:
+            del connected_robots[self.unique_robot_id]
+            metrics.CONNECTED_ROBOTS.set(len(connected_robots))
+            get_spatial_index().remove(self.unique_robot_id)
+            robot_entry = registry.get_robot(self.unique_robot_id)
+            await self.publish_presence(False, robot_entry["robot_id"] if robot_entry else None)
+
+    async def reject_with_backoff(self, retry_after=None):
+        # 受け付けてから閉じないとクライアントにクローズコードが届かない
+        if retry_after is None:
+            retry_after = admission_controller.retry_after()
+        await self.accept()
+        await self.send(text_data=json.dumps({"type": "backoff", "retry_after": retry_after}))
+        await self.close(code=BACKOFF_CLOSE_CODE)
+
+    def admit_frame(self):
+        # ロボットごと・所有者ごとの受信制限。受け付けない場合は再送までの秒数を返す
+        current_time = time.monotonic()
+        wait = self.rate_limit.take(current_time) if self.rate_limit else 0.0
+        if not wait and self.owner_username != registry.UNKNOWN:
+            owner_bucket = admission_controller.owner_bucket(self.owner_username)
+            wait = owner_bucket.take(current_time) if owner_bucket else 0.0
+            if wait:
+                metrics.MESSAGES_THROTTLED.inc(1, "owner")
+        elif wait:
+            metrics.MESSAGES_THROTTLED.inc(1, "robot")
+        return wait
+
+    async def throttle(self, wait):
+        self.throttled_frames += 1
+        if self.throttled_frames > settings.ROBOT_THROTTLE_CLOSE_AFTER:
+            # 制限を無視して送り続けるロボットは切断して再接続を遅らせる
+            logger.warning(f"Robot {self.unique_robot_id} kept exceeding its message rate. Closing connection.")
+            metrics.ADMISSION_REJECTED.inc(1, "throttle")
+            await self.go_offline(BACKOFF_CLOSE_CODE)
+            await self.send(text_data=json.dumps({"type": "backoff", "retry_after": admission_controller.retry_after(wait)}))
+            await self.close(code=BACKOFF_CLOSE_CODE)
+            return
+        current_time = time.monotonic()
+        if self.throttle_notified_at is None or current_time - self.throttle_notified_at >= self.throttle_notice_interval:
+            self.throttle_notified_at = current_time
+            await self.send(text_data=json.dumps({"type": "throttle", "retry_after": round(wait, 3)}))
+
+    async def close_dead_connection(self):
+        await self.go_offline(self.dead_close_code)
         try:
-            data = json.loads(text_data)
-            if "robot_id" in data and "state" in data and "owner" in data:
+            await self.close(code=self.dead_close_code)
+        except Exception as e:
+            logger.error(f"Error closing dead connection for {self.unique_robot_id}: {e}")
 
-                await self.update_robot_info(
-                    unique_robot_id = self.unique_robot_id,
-                    robot_id = data["robot_id"],
-                    owner = data["owner"]
-                )
-                 
-                connection_time = int(time.time() - self.robot_connection_times[self.unique_robot_id])
-                formatted_connection_time = f"{connection_time // 3600:02}:{(connection_time % 3600) // 60:02}:{connection_time % 60:02}"
-
-                # キャッシュにデータを追加
-                if len(shared_robot_cache[self.unique_robot_id]) == 0 or (now() - shared_robot_cache[self.unique_robot_id][-1]['timestamp']).total_seconds() >= 5:
-                    shared_robot_cache[self.unique_robot_id].append({
-                        "robot_id": data["robot_id"],
-                        "state": data["state"],
-                        "timestamp": now(),
-                    })
+    async def publish_presence(self, online, robot_id):
+        # オンライン/オフラインの変化は状態の差分と同じ経路でフロントエンドへ配信する
+        meta = {"owner": self.owner_username, "online": online}
+        if robot_id is not None:
+            meta["robot_id"] = robot_id
+        await self.state_buffer.merge_frontend(self.unique_robot_id, meta, {})
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # 受信フォーマット
+        #   {"robot_id", "owner", "state", "timestamp"?}                    1サンプル
+        #   {"robot_id", "owner", "samples": [{"state", "timestamp"}, ...], "seq"?}  複数サンプル
+        # timestamp はデバイス側の時刻（UNIX秒または ISO 8601）。省略時は受信時刻を使う
+        # バイナリフレームは同じ構造の MessagePack として扱う。seq を付けると {"type": "ack"} を返す
+        # 受信制限を超えたフレームはデコードせずに破棄し、{"type": "throttle", "retry_after"} を返す
+        started = time.perf_counter()
+        self.last_activity = time.monotonic()  # pong に限らず受信があれば生存とみなす
+        if getattr(self, "offline", True):
+            return
+        wait = self.admit_frame()
+        if wait:
+            await self.throttle(wait)
+            return
+        self.throttled_frames = 0
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+            if "robot_id" in data and "owner" in data and ("state" in data or "samples" in data):
+                metrics.MESSAGES_RECEIVED.inc(1, self.unique_robot_id)
+                self.frames_received += 1
+                await self.resolve_robot(data["robot_id"], data["owner"])
 
-                # キャッシュサイズ制限の確認
-                if len(shared_robot_cache[self.unique_robot_id]) > self.max_cache_size:
-                    logger.warning(f"Cache size exceeded for {self.unique_robot_id}. Flushing immediately.")
-                    await self.flush_cache_to_db(self.unique_robot_id)
-
-                # フロントエンド用の更新データをキャッシュ
-                shared_frontend_data_buffer[self.unique_robot_id] = {
-                    "unique_robot_id": self.unique_robot_id,
-                    "robot_id": data["robot_id"],
-                    "owner": data["owner"],
-                    "state": json.dumps(data["state"]) if isinstance(data["state"], dict) else data["state"],
-                    "connection_time": formatted_connection_time,
-                    "timestamp": now().isoformat(),
-                }
+                received_at = now()
+                if "samples" in data:
+                    samples = [
+                        (sample["state"], parse_sample_timestamp(sample.get("timestamp"), received_at))
+                        for sample in data["samples"]
+                    ]
+                else:
+                    samples = [(data["state"], parse_sample_timestamp(data.get("timestamp"), received_at))]
+                metrics.SAMPLES_RECEIVED.inc(len(samples))
+                samples = sorted((sample for sample in samples if sample[1] is not None), key=lambda sample: sample[1])
+
+                if samples:
+                    await self.process_samples(data["robot_id"], samples)
+                if "seq" in data:
+                    await self.send_frame({"type": "ack", "seq": data["seq"], "accepted": len(samples)}, bytes_data is not None)
 
             elif "pong" in data:
                 # クライアントからpongが送られた場合
                 self.last_pong_time = time.time()
             else:
                 logger.error("Invalid data received: Missing 'robot_id' or 'state'")
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decoding JSON: {e}")
+        except (json.JSONDecodeError, ValueError) as e:
+            logger.error(f"Error decoding frame: {e}")
         except Exception as e:
             logger.error(f"Error processing WebSocket data: {e}")
+        finally:
+            metrics.RECEIVE_SECONDS.observe(time.perf_counter() - started)
+
+    def decode_frame(self, text_data, bytes_data):
+        if text_data is not None:
+            return json.loads(text_data)
+        if msgpack is None:
+            raise ValueError("Binary frame received but msgpack is not installed")
+        return msgpack.unpackb(bytes_data)
+
+    async def send_frame(self, data, binary):
+        if binary and msgpack is not None:
+            await self.send(bytes_data=msgpack.packb(data))
+        else:
+            await self.send(text_data=json.dumps(data))
+
+    async def resolve_robot(self, robot_id, owner):
+        # 識別情報はレジストリから取得し、未確定の場合のみ DB を更新する
+        robot_entry = registry.get_robot(self.unique_robot_id)
+        if robot_entry is None:
+            robot_entry = await self.load_robot_info(self.unique_robot_id)
+            self.last_update_attempt = None
+
+        update_attempt = (robot_id, owner)
+        if robot_entry is not None and not robot_entry["resolved"] and update_attempt != self.last_update_attempt:
+            self.last_update_attempt = update_attempt
+            robot_entry = await self.update_robot_info(
+                unique_robot_id = self.unique_robot_id,
+                robot_id = robot_id,
+                owner = owner
+            )
+
+        if robot_entry is not None and robot_entry["owner"] != self.owner_username:
+            self.owner_username = robot_entry["owner"]
+            self.persistence_policy = get_policy(self.unique_robot_id, self.owner_username)
+
+    async def process_samples(self, robot_id, samples):
+        # samples: [(state, timestamp), ...]（時刻順）
+        # 接続内で前のフレームより古いサンプルは保存ポリシーの間隔判定で間引かれ、表示にも反映しない
+        connection_time = int(time.time() - self.connected_at)
+        formatted_connection_time = f"{connection_time // 3600:02}:{(connection_time % 3600) // 60:02}:{connection_time % 60:02}"
+
+        # 保存ポリシーに従ってキャッシュにデータを追加
+        persisted = []
+        for state, timestamp in samples:
+            if self.persistence_policy.should_persist(self.last_persisted, state, timestamp):
+                self.last_persisted = {"state": state, "timestamp": timestamp}
+                persisted.append({"robot_id": robot_id, "state": state, "timestamp": timestamp})
+        if persisted:
+            # 先に先行書き込みログへ追記してからキャッシュに入れる（フラッシュ前に停止しても失わない）
+            spool = get_spool()
+            if spool:
+                spool.append(self.unique_robot_id, persisted)
+            cache_size = await self.state_buffer.append_history(self.unique_robot_id, persisted)
+
+            # キャッシュサイズ制限の確認
+            if cache_size > self.max_cache_size:
+                logger.warning(f"Cache size exceeded for {self.unique_robot_id}. Flushing immediately.")
+                await SharedTasks.flush_robots([self.unique_robot_id])
 
-    @sync_to_async
+        # フロントエンド用の更新データは変化したキーだけをキャッシュ（フレーム内の変化は1つにまとめる）
+        state_changes = {}
+        removed = set()
+        samples = [
+            (state, timestamp) for state, timestamp in samples
+            if self.frontend_timestamp is None or timestamp >= self.frontend_timestamp
+        ]
+        if not samples:
+            return
+        for state, timestamp in samples:
+            state = state if isinstance(state, dict) else {"value": state}
+            for key, value in state.items():
+                if key not in self.frontend_state or self.frontend_state[key] != value:
+                    state_changes[key] = value
+                    removed.discard(key)
+            for key in self.frontend_state:
+                if key not in state:
+                    state_changes.pop(key, None)
+                    removed.add(key)
+            self.frontend_state = state
+        self.frontend_timestamp = samples[-1][1]
+
+        # 現在位置の索引を更新（位置を含まない状態の場合は直前の位置のまま）
+        position = extract_position(self.frontend_state, get_position_fields())
+        if position is not None:
+            get_spatial_index().update(self.unique_robot_id, self.owner_username, *position)
+        await self.state_buffer.merge_frontend(self.unique_robot_id, {
+            "robot_id": robot_id,
+            "owner": self.owner_username,
+            "connection_time": formatted_connection_time,
+            "timestamp": samples[-1][1].isoformat(),
+        }, state_changes, sorted(removed))
+
+    @db_sync_to_async("create_robot")
     def create_robot_if_not_exists(self, unique_robot_id, robot_id, owner):
 
         owner_instance, _ = User.objects.get_or_create(username=owner if owner else "unknown")
-        Robot.objects.get_or_create(
+        robot, created = Robot.objects.select_related("owner").get_or_create(
             unique_robot_id=unique_robot_id,
             defaults={"robot_id": robot_id, "owner": owner_instance, "last_connected": now()}
         )
+        if created:
+            invalidate_robot_cache(unique_robot_id, robot.owner_id)
+        return registry.register_robot(robot)
+
+    @db_sync_to_async("load_robot")
+    def load_robot_info(self, unique_robot_id):
+        # レジストリが無効化された後に一度だけ DB から読み直す
+        robot = Robot.objects.select_related("owner").filter(unique_robot_id=unique_robot_id).first()
+        if robot is None:
+            logger.info(f"Robot with unique_robot_id {unique_robot_id} does not exist.")
+            return None
+        return registry.register_robot(robot)
     
-    @sync_to_async
+    @db_sync_to_async("update_robot")
     def update_robot_info(self, unique_robot_id, robot_id, owner):
         try:
-            robot = Robot.objects.get(unique_robot_id=unique_robot_id)
+            robot = Robot.objects.select_related("owner").get(unique_robot_id=unique_robot_id)
+            previous_owner_id = robot.owner_id
             updated = False
 
             if robot.robot_id == "unknown" and robot_id != "unknown":
@@ -145,90 +409,767 @@ class RobotStateConsumer(AsyncWebsocketConsumer):
                     logger.info(f"Owner '{owner}' does not exist. Skipping update for robot {unique_robot_id}.")
             if updated:
                 robot.save()
+                invalidate_robot_cache(unique_robot_id, previous_owner_id)
+                invalidate_robot_cache(owner_id=robot.owner_id)
                 logger.info(f"Robot {unique_robot_id} updated: robot_id={robot.robot_id}, owner={robot.owner.username}")
             else:
-                logger.info(f"No update needed for robot {unique_robot_id}.")
+                logger.debug(f"No update needed for robot {unique_robot_id}.")
+            return registry.register_robot(robot)
 
         except Robot.DoesNotExist:
+            registry.invalidate_robot(unique_robot_id)
             logger.info(f"Robot with unique_robot_id {unique_robot_id} does not exist. Skipping update.")
         except Exception as e:
             logger.info(f"Error updating robot info: {e}")
+        return registry.get_robot(unique_robot_id)
 
 class SharedTasks:
     @staticmethod
     async def flush_to_db():
         while True:
-            await asyncio.sleep(30)  # 30秒間隔で実行
+            await asyncio.sleep(RobotStateConsumer.flush_interval)
             try:
                 # キャッシュが空ならスキップ
-                if not any(shared_robot_cache.values()):
+                if not await get_state_buffer().has_history():
                     #logger.debug("No data in cache to flush to DB. Skipping...")
                     continue
 
-                # ORM 操作を非同期対応に
-                await sync_to_async(SharedTasks._flush_to_db_sync)()
-                logger.info("Flushed data to DB.")
+                await SharedTasks.flush_robots()
             except Exception as e:
                 logger.error(f"Error flushing to DB: {e}")
 
     @staticmethod
-    def _flush_to_db_sync():
-        # ORM の操作は同期で実行
-        with transaction.atomic():
-            for unique_robot_id, cache in list(shared_robot_cache.items()):
-                if cache:  # キャッシュが空の場合はスキップ
-                    RobotStateHistory.objects.bulk_create([
-                        RobotStateHistory(
-                            robot=Robot.objects.get(unique_robot_id=unique_robot_id),
-                            state=data["state"],
-                            timestamp=data["timestamp"]
-                        )
-                        for data in cache
-                    ])
-                    shared_robot_cache[unique_robot_id] = []  # キャッシュをクリア
+    async def flush_sessions():
+        # 接続セッションの記録は ROBOT_SESSION_FLUSH_INTERVAL ごとにまとめて書き込む
+        while True:
+            await asyncio.sleep(settings.ROBOT_SESSION_FLUSH_INTERVAL)
+            if not session_recorder.has_pending():
+                continue
+            snapshot = session_recorder.take()
+            try:
+                await db_sync_to_async("flush_sessions", pool="background")(write_sessions)(snapshot)
+            except Exception as e:
+                session_recorder.restore(snapshot)
+                logger.error(f"Error writing connection sessions: {e}")
+
+    @staticmethod
+    async def flush_robots(unique_robot_ids=None):
+        # キャッシュはバックエンドからアトミックに取り出す（他ワーカーと二重に書き込まない）
+        state_buffer = get_state_buffer()
+        # 全件フラッシュではセグメントを切り替え、書き込みが終わったら切り替え前のセグメントを削除する
+        spool = get_spool()
+        sealed = None
+        if spool and unique_robot_ids is None:
+            sealed, handle = spool.rotate()
+            # 書き込みに失敗した場合に残すセグメントなので、切り替え前の分をディスクへ同期しておく
+            try:
+                await asyncio.to_thread(sync_and_close, handle)
+            except Exception as e:
+                logger.error(f"Error syncing sealed spool segment: {e}")
+        snapshot = await state_buffer.pop_history(unique_robot_ids)
+        if not snapshot:
+            if sealed:
+                spool.discard(sealed)
+            return None
+
+        # ORM 操作を非同期対応に
+        try:
+            stats = await db_sync_to_async("flush", pool="background")(write_state_history)(snapshot)
+        except Exception:
+            # DB に接続できないなどで全く書き込めなかった場合はキャッシュに戻す（セグメントは残す）
+            for unique_robot_id, rows in snapshot.items():
+                await state_buffer.prepend_history(unique_robot_id, rows)
+            raise
+
+        # 書き込みに失敗した行はキャッシュの先頭に戻して次回再試行する（回数の上限を超えた行は write_state_history が隔離する）
+        for unique_robot_id, rows in stats["failed"].items():
+            if sealed:
+                spool.append(unique_robot_id, rows)
+            await state_buffer.prepend_history(unique_robot_id, rows)
+        if sealed:
+            spool.discard(sealed)
+        return stats
+
+    @staticmethod
+    async def sync_spool():
+        # 先行書き込みログを ROBOT_SPOOL_SYNC_INTERVAL ごとにディスクへ同期する（OS ごと停止した場合に備える）
+        while True:
+            await asyncio.sleep(settings.ROBOT_SPOOL_SYNC_INTERVAL)
+            spool = get_spool()
+            handle = spool.sync_handle() if spool else None
+            if handle is None:
+                continue
+            try:
+                await asyncio.to_thread(sync_and_close, handle)
+            except Exception as e:
+                logger.error(f"Error syncing state spool: {e}")
+
+    @staticmethod
+    async def recover_spool():
+        # 正常終了しなかったプロセスの先行書き込みログを読み戻し、自分のログとキャッシュに移してから書き込む
+        spool = get_spool()
+        if spool is None:
+            return
+        orphans = spool.orphaned_directories()
+        if not orphans:
+            return
+        try:
+            snapshot = await db_sync_to_async("recover_spool", pool="background")(load_spooled)(
+                [directory for directory, _ in orphans]
+            )
+            state_buffer = get_state_buffer()
+            for unique_robot_id, samples in snapshot.items():
+                spool.append(unique_robot_id, samples)
+                await state_buffer.append_history(unique_robot_id, samples)
+            # 読み戻した行がディスクに残ってから停止したプロセスのディレクトリを削除する
+            _, handle = spool.rotate()
+            await asyncio.to_thread(sync_and_close, handle)
+            for directory, _ in orphans:
+                shutil.rmtree(directory, ignore_errors=True)
+        finally:
+            for _, lock_file in orphans:
+                lock_file.close()
+
+        rows = sum(len(samples) for samples in snapshot.values())
+        metrics.SPOOL_RECOVERED_ROWS.inc(rows)
+        logger.info(f"Recovered {rows} spooled rows for {len(snapshot)} robots from {len(orphans)} stopped processes.")
+        if rows:
+            await SharedTasks.flush_robots()
+
+    @staticmethod
+    async def shutdown():
+        # 終了時にキャッシュと接続セッションを書き込み、先行書き込みログを閉じる
+        # 書き込めなかった場合はログを残し、次の起動時に読み戻す
+        flushed = True
+        try:
+            while await get_state_buffer().has_history():
+                stats = await SharedTasks.flush_robots()
+                if stats is None:
+                    break
+                if stats["failed"]:
+                    flushed = False
+                    break
+        except Exception as e:
+            flushed = False
+            logger.error(f"Error flushing history on shutdown: {e}")
+
+        if session_recorder.has_pending():
+            try:
+                await db_sync_to_async("flush_sessions", pool="background")(write_sessions)(session_recorder.take())
+            except Exception as e:
+                logger.error(f"Error writing connection sessions on shutdown: {e}")
+
+        spool = get_spool()
+        if spool:
+            await asyncio.to_thread(spool.close, flushed)
+            if not flushed:
+                logger.warning(f"State spool kept at {spool.directory} for replay on next startup.")
+        shutdown_executors()
+
+    @staticmethod
+    async def maintain_history():
+        # ロールアップの更新と保持期間を過ぎた履歴の削除
+        while True:
+            await asyncio.sleep(settings.ROBOT_HISTORY_MAINTENANCE_INTERVAL)
+            try:
+                if not await get_state_buffer().acquire_lock("maintain_history", ttl=settings.ROBOT_HISTORY_MAINTENANCE_INTERVAL):
+                    continue
+                await db_sync_to_async("maintain_history", pool="background")(maintain_history)()
+            except Exception as e:
+                logger.error(f"Error maintaining history: {e}")
 
     @staticmethod
     async def send_to_frontend(channel_layer):
+        # 購読グループ（ストリーム）ごとに seq を振り、再接続したクライアントが続きから受け取れるようにする
+        # 配信を担当し始めるたびに epoch を変える（他のプロセスが振った seq と混ざらない）
+        # 所有者ごとのフリート集計も各ロボットの最新状態から更新し、変化した所有者へ送る
+        # アラートのルールも変化したロボットの最新状態にまとめて適用し、発生・解消を購読グループへ送る
+        epoch = None
+        stream_seq = {}  # { stream: 最後に振った seq }
+        fleet = None
+        fleet_fields = get_fleet_fields()
+        fleet_refreshed = 0.0
+        alerts = AlertEngine()
+        alerts_loaded = alerts_swept = 0.0
+        alerts_loading = None  # ルールを読み込み中のタスク
+        latest_loading = None  # 引き継いだときに全ロボットの最新状態を読み込むタスク
+        pruning = None  # 削除されたロボットを外すために登録済みのロボットを読み込むタスク
+        pruned = 0.0
         while True:
             await asyncio.sleep(0.2)  # 0.2秒間隔で実行
             try:
-                # フロントエンドバッファが空ならスキップ
-                if not shared_frontend_data_buffer:
+                # 配信はクラスタ内で1プロセスだけが行う
+                state_buffer = get_state_buffer()
+                if not await state_buffer.acquire_lock("send_to_frontend", ttl=5):
+                    epoch = None
+                    continue
+                if epoch is None:
+                    epoch = uuid.uuid4().hex[:12]
+                    stream_seq = {}
+                    fleet = FleetAggregator(fleet_fields) if fleet_fields else None
+                    alerts = AlertEngine()
+                    alerts_loaded = alerts_swept = 0.0
+                    # 引き継ぐ前から届いていないロボットも集計・評価できるよう、最新状態を読み込んで初期値にする
+                    for task in (latest_loading, pruning):
+                        if task is not None:
+                            task.cancel()
+                    latest_loading = asyncio.create_task(SharedTasks.load_latest_states(state_buffer))
+                    pruning = None
+                    pruned = time.monotonic()
+                if latest_loading is not None and latest_loading.done():
+                    try:
+                        SharedTasks.seed_latest_states(latest_loading.result(), fleet, alerts)
+                    except Exception as e:
+                        logger.error(f"Error loading latest states: {e}")
+                    latest_loading = None
+                # 削除されたロボットを一定間隔で集計とアラートから外す（削除はどのプロセスの API でも行われる）
+                if pruning is None and time.monotonic() - pruned >= settings.ROBOT_FLEET_PRUNE_INTERVAL:
+                    pruned = time.monotonic()
+                    pruning = asyncio.create_task(SharedTasks.load_robot_ids())
+                if pruning is not None and pruning.done():
+                    try:
+                        unique_robot_ids = pruning.result()
+                        if fleet is not None:
+                            fleet.prune(unique_robot_ids)
+                        alerts.prune(unique_robot_ids)
+                    except Exception as e:
+                        logger.error(f"Error pruning deleted robots: {e}")
+                    pruning = None
+
+                # 新しく接続したクライアントにも届くよう、変化がなくても一定間隔で全所有者の集計を送る
+                if fleet is not None and time.monotonic() - fleet_refreshed >= settings.ROBOT_FLEET_REFRESH_INTERVAL:
+                    fleet_refreshed = time.monotonic()
+                    await SharedTasks.send_fleet_summaries(channel_layer, fleet.take_summaries(everyone=True))
+
+                # ルールは一定間隔で読み込み、変更されたものだけコンパイルし直す
+                # DB の混雑で配信が止まらないよう、読み込みは待たずに次のティック以降で反映する
+                if alerts_loading is None and time.monotonic() - alerts_loaded >= settings.ROBOT_ALERT_RULE_REFRESH_INTERVAL:
+                    alerts_loaded = time.monotonic()
+                    alerts_loading = asyncio.create_task(
+                        db_sync_to_async("load_alert_rules", pool="background")(load_alert_rules)()
+                    )
+                if alerts_loading is not None and alerts_loading.done():
+                    try:
+                        alerts.load(alerts_loading.result())
+                    except Exception as e:
+                        logger.error(f"Error loading alert rules: {e}")
+                    alerts_loading = None
+                # 時間に依存するルールはメッセージが届かなくても評価する
+                if alerts.rules and time.monotonic() - alerts_swept >= settings.ROBOT_ALERT_SWEEP_INTERVAL:
+                    alerts_swept = time.monotonic()
+                    await SharedTasks.evaluate_alerts(channel_layer, alerts, None)
+
+                # フロントエンドバッファを取り出してクリア
+                frontend_data = await state_buffer.pop_frontend()
+                if not frontend_data:
                     #logger.debug("No data in frontend buffer to send. Skipping...")
                     continue
+                started = time.perf_counter()
 
-                logger.debug(f"Sending to frontend: {shared_frontend_data_buffer}")
-                await channel_layer.group_send(
-                    "frontend_updates",
-                    {
-                        "type": "send_to_client",
-                        "data": list(shared_frontend_data_buffer.values()),
-                    },
-                )
-                shared_frontend_data_buffer.clear()  # フロントエンドバッファをクリア
+                logger.debug(f"Sending to frontend: {frontend_data}")
+                await state_buffer.update_latest(frontend_data)
+                if fleet is not None or alerts.rules:
+                    current_time = time.time()
+                    for unique_robot_id, entry in (await state_buffer.get_latest(frontend_data.keys())).items():
+                        meta = entry["meta"]
+                        if fleet is not None and meta.get("owner"):
+                            fleet.update(unique_robot_id, meta["owner"], meta.get("online", True), entry["state"])
+                        if alerts.rules:
+                            # 接続・切断の通知だけの場合はメッセージを受け取った時刻を更新しない
+                            received = "timestamp" in frontend_data[unique_robot_id]["meta"]
+                            alerts.observe(
+                                unique_robot_id, meta.get("owner"), meta.get("robot_id"), entry["state"],
+                                current_time, received,
+                            )
+
+                # 購読グループごとに自分のロボットの差分だけを送る
+                groups = {}
+                for unique_robot_id, update in frontend_data.items():
+                    data = frontend_entry(unique_robot_id, update["meta"], update["state"], update["removed"])
+                    groups.setdefault(robot_group_name(unique_robot_id), []).append(data)
+                    if data.get("owner"):
+                        groups.setdefault(owner_group_name(data["owner"]), []).append(data)
+
+                # エンコードはグループごとに1回だけ行い、各コンシューマーはそのまま送信する
+                messages = {}
+                entries = {}
+                for group, data_list in groups.items():
+                    seq = stream_seq[group] = stream_seq.get(group, 0) + 1
+                    messages[group] = group_message(
+                        "send_to_client", {"type": "delta", "epoch": epoch, "seq": seq, "robots": data_list}
+                    )
+                    entries[group] = (seq, messages[group]["text"])
+                await state_buffer.append_streams(epoch, entries)
+                await asyncio.gather(*[
+                    channel_layer.group_send(group, message)
+                    for group, message in messages.items()
+                ])
+                if fleet is not None:
+                    await SharedTasks.send_fleet_summaries(channel_layer, fleet.take_summaries())
+                if alerts.rules:
+                    await SharedTasks.evaluate_alerts(channel_layer, alerts, frontend_data.keys())
+
+                metrics.BROADCAST_ROBOTS.observe(len(frontend_data))
+                metrics.BROADCAST_GROUPS.observe(len(groups))
+                metrics.BROADCAST_BYTES.inc(sum(len(message["text"]) for message in messages.values()))
+                metrics.BROADCAST_SECONDS.observe(time.perf_counter() - started)
             except Exception as e:
                 logger.error(f"Error sending to frontend: {e}")
 
 
-class FrontendConsumer(AsyncWebsocketConsumer):
+    @staticmethod
+    async def load_robot_ids():
+        # 登録済みの全ロボットの unique_robot_id の集合
+        return set(await db_sync_to_async("load_robot_ids", pool="background")(
+            lambda: list(Robot.objects.values_list("unique_robot_id", flat=True))
+        )())
+
+    @staticmethod
+    async def load_latest_states(state_buffer):
+        # 登録済みの全ロボットの最新状態 { unique_robot_id: {"meta", "state"} }
+        unique_robot_ids = list(await SharedTasks.load_robot_ids())
+        latest = {}
+        for i in range(0, len(unique_robot_ids), LATEST_CHUNK_SIZE):
+            latest.update(await state_buffer.get_latest(unique_robot_ids[i:i + LATEST_CHUNK_SIZE]))
+        return latest
+
+    @staticmethod
+    def seed_latest_states(latest, fleet, alerts):
+        # 最後にメッセージを受け取った時刻は保存されている状態の時刻を使う（silent_for を引き継ぐ）
+        current_time = time.time()
+        for unique_robot_id, entry in latest.items():
+            meta = entry["meta"]
+            if fleet is not None and meta.get("owner"):
+                fleet.seed(unique_robot_id, meta["owner"], meta.get("online", True), entry["state"])
+            try:
+                timestamp = parse_datetime(meta.get("timestamp") or "")
+            except ValueError:
+                timestamp = None
+            seen_at = min(timestamp.timestamp(), current_time) if timestamp else current_time
+            alerts.seed(unique_robot_id, meta.get("owner"), meta.get("robot_id"), entry["state"], seen_at)
+
+    @staticmethod
+    async def send_fleet_summaries(channel_layer, summaries):
+        # {"type": "fleet", "owner", "total", "online", "fields": {数値: {"count", "avg", "min", "max"}, 文字列: {"counts"}}}
+        if not summaries:
+            return
+        await asyncio.gather(*[
+            channel_layer.group_send(
+                owner_group_name(owner),
+                group_message("send_fleet", {"type": "fleet", "owner": owner, **summary}),
+            )
+            for owner, summary in summaries.items()
+        ])
+        metrics.FLEET_SUMMARIES_SENT.inc(len(summaries))
+
+    @staticmethod
+    async def evaluate_alerts(channel_layer, alerts, unique_robot_ids):
+        # unique_robot_ids: このティックで変化したロボット（None は一定間隔の見回り）
+        # {"type": "alert", "status": "firing" | "resolved", "rule_id", "rule", "owner", "unique_robot_id", "robot_id", "at"}
+        # をロボットと所有者の購読グループへ送る
+        phase = "sweep" if unique_robot_ids is None else "tick"
+        started = time.perf_counter()
+        current_time = time.time()
+        if unique_robot_ids is None:
+            events, evaluations = alerts.sweep(current_time)
+        else:
+            events, evaluations = alerts.evaluate(unique_robot_ids, current_time)
+        metrics.ALERT_EVALUATION_SECONDS.observe(time.perf_counter() - started, phase)
+        metrics.ALERT_EVALUATIONS.inc(evaluations, phase)
+        if not events:
+            return
+
+        sends = []
+        for event in events:
+            message = group_message("send_alert", {
+                "type": "alert",
+                **event,
+                "at": datetime.fromtimestamp(event["at"], tz=dt_timezone.utc).isoformat(),
+            })
+            sends.append(channel_layer.group_send(robot_group_name(event["unique_robot_id"]), message))
+            if event["owner"]:
+                sends.append(channel_layer.group_send(owner_group_name(event["owner"]), message))
+            metrics.ALERTS.inc(1, event["status"])
+            logger.info(f"Alert {event['status']}: rule {event['rule_id']} ({event['rule']}) robot {event['unique_robot_id']}")
+        await asyncio.gather(*sends)
+
+
+def group_message(handler, message):
+    # 購読グループへ送るメッセージ {"type": ハンドラ, "text": JSON, "bytes": MessagePack}
+    # ?encoding=msgpack のコンシューマーがフレームごとに変換し直さないよう、msgpack があれば両方を1回ずつエンコードする
+    event = {"type": handler, "text": json.dumps(message)}
+    if msgpack is not None:
+        event["bytes"] = msgpack.packb(message)
+    return event
+
+
+def frontend_entry(unique_robot_id, meta, state, removed=()):
+    # フロントエンドへ送る1ロボット分のデータ（state は変化したキーのみ、removed は削除されたキー）
+    data = {"unique_robot_id": unique_robot_id, **meta, "state": state}
+    if removed:
+        data["removed"] = list(removed)
+    return data
+
+
+def merge_frontend_entry(pending, entry):
+    # 未送信の差分に新しい差分を重ねる（同じキーは後勝ち、削除は後から届いた値で打ち消す）
+    state = pending["state"]
+    removed = set(pending.get("removed", ()))
+    pending.update({key: value for key, value in entry.items() if key not in ("state", "removed")})
+    state.update(entry["state"])
+    removed.difference_update(entry["state"])
+    for key in entry.get("removed", ()):
+        state.pop(key, None)
+        removed.add(key)
+    if removed:
+        pending["removed"] = sorted(removed)
+    else:
+        pending.pop("removed", None)
+
+
+class FrontendConsumer(DBExecutorConsumerMixin, AsyncWebsocketConsumer):
+    # フロントエンド配信プロトコル
+    #   {"type": "snapshot", "epoch", "seq", "robots": [...]}  接続直後に購読対象の最新状態を送る
+    #   {"type": "delta", "epoch", "seq", "robots": [...]}     以降は変化したキーだけを送る
+    #   {"type": "fleet", "owner", "total", "online", "fields"}  所有者単位の購読にはフリート集計も送る
+    #   {"type": "alert", "status", "rule_id", "rule", "unique_robot_id", ...}  アラートの発生・解消（再開時には送り直さない）
+    # 再接続時に ?epoch=...&seq=... で最後に受け取った位置を指定すると、再開用バッファに残っていれば
+    # 取りこぼした delta だけを送り直す（残っていなければ snapshot を送る）
+    # 同じ epoch で seq が受け取り済み以下の delta は重複なのでクライアント側で捨てる
+    # ?encoding=msgpack を指定するとバイナリ（MessagePack）で送る
+    #
+    # 配信は接続ごとの送信タスクで行い、送信中に届いた差分はロボットごとに1つへ合成する
+    # （送信中1フレーム + 合成済み1フレームまでしか溜めない）
+    # 最も古い未送信の差分が ROBOT_FRONTEND_MAX_LAG 秒を超えたクライアントは切断する
+    #
+    # リプレイ: ?mode=replay&unique_robot_id=...&since=...&until=...&speed=10
+    #   所有者のみ。履歴を speed 倍速で {"type": "replay", "robots": [...]} として送り、最後に {"type": "replay_end"}
+    #   クライアントから {"action": "pause" | "resume"} / {"action": "speed", "speed": 倍率} で操作できる
+    LAGGING_CLOSE_CODE = 4008
+    REPLAY_MAX_SPEED = 1000
+    REPLAY_MAX_WAIT = 2.0  # 履歴の空白期間はこの秒数に縮める
+    MAX_PENDING_ALERTS = 100  # 未送信のアラートの上限（超えたら古いものから捨てる）
+
     async def connect(self):
-        self.group_name = "frontend_updates"
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # 詳細ページは unique_robot_id 単位、ダッシュボードはログインユーザー単位で購読する
+        params = dict(parse_qsl(self.scope.get("query_string", b"").decode("utf-8")))
+        unique_robot_id = params.get("unique_robot_id")
+        user = self.scope.get("user")
+
+        self.use_msgpack = params.get("encoding") == "msgpack"
+        if self.use_msgpack and msgpack is None:
+            logger.warning("msgpack is not installed. Falling back to JSON for frontend updates.")
+            self.use_msgpack = False
+
+        self.group_names = []
+        self.writer = None
+        self.replay_task = None
+        if params.get("mode") == "replay":
+            await self.start_replay(params, user)
+            return
+        if unique_robot_id:
+            # ロボット単位の購読は所有者のみ
+            if user is None or not user.is_authenticated or await self.get_owned_robot(user, unique_robot_id) is None:
+                await self.close(code=4003)
+                logger.error(f"Frontend connection refused: robot {unique_robot_id} is not owned by the user")
+                return
+            self.group_names.append(robot_group_name(unique_robot_id))
+        elif user is not None and user.is_authenticated:
+            self.group_names.append(owner_group_name(user.username))
+        else:
+            await self.close(code=4003)
+            logger.error("Frontend connection refused: no subscription target")
+            return
+
+        for group_name in self.group_names:
+            await self.channel_layer.group_add(group_name, self.channel_name)
         await self.accept()
-        logger.info(f"Frontend WebSocket connected: {self.channel_name}")
+        metrics.FRONTEND_CONNECTIONS.inc()
+        logger.info(f"Frontend WebSocket connected: {self.channel_name} groups={self.group_names}")
+
+        # 再開できれば取りこぼした差分だけを送り、できなければ最新状態のスナップショットを送る
+        stream = await get_state_buffer().read_stream(self.group_names[0])
+        missed = self.missed_frames(stream, params.get("epoch"), params.get("seq"))
+        if missed is not None:
+            metrics.FRONTEND_RESUMES.inc(1, "resumed")
+            for text in missed:
+                await self.send_message(text)
+        else:
+            metrics.FRONTEND_RESUMES.inc(1, "snapshot")
+            if unique_robot_id:
+                subscribed_robot_ids = [unique_robot_id]
+            else:
+                subscribed_robot_ids = await self.get_owner_robot_ids(user)
+            latest = await get_state_buffer().get_latest(subscribed_robot_ids)
+            await self.send_message(json.dumps({
+                "type": "snapshot",
+                "epoch": stream["epoch"],
+                "seq": stream["seq"],
+                "robots": [
+                    frontend_entry(unique_robot_id, entry["meta"], entry["state"])
+                    for unique_robot_id, entry in latest.items()
+                ],
+            }))
+
+        self.pending_frame = None  # 未送信の配信が1件だけならデコードせずにグループメッセージのまま保持する
+        self.pending_fleet = None  # 未送信のフリート集計（最新の1件だけ）
+        self.pending_alerts = []  # 未送信のアラート（合成せずに順に送る）
+        self.pending_robots = None  # 2件以上溜まったらロボットごとに合成する { unique_robot_id: entry }
+        self.pending_since = None  # 未送信の差分が最初に届いた時刻
+        self.sending_since = None  # 送信中のフレームに含まれる最も古い差分が届いた時刻
+        self.pending_event = asyncio.Event()
+        self.writer = asyncio.create_task(self.write_loop())
+
+    @staticmethod
+    def missed_frames(stream, epoch, seq):
+        # 再開できる場合は seq より後のフレーム（取りこぼしがなければ空）、できない場合は None
+        if not epoch or epoch != stream["epoch"] or not str(seq).isdigit():
+            return None
+        seq = int(seq)
+        if seq > stream["seq"]:
+            return None
+        missed = [text for entry_seq, text in stream["entries"] if entry_seq > seq]
+        if seq < stream["seq"] and (not missed or stream["entries"][0][0] > seq + 1):
+            return None  # 再開用バッファから溢れている
+        return missed
+
+    @db_sync_to_async("owner_robot_ids")
+    def get_owner_robot_ids(self, user):
+        return list(Robot.objects.filter(owner=user).values_list("unique_robot_id", flat=True))
+
+    @db_sync_to_async("owned_robot")
+    def get_owned_robot(self, user, unique_robot_id):
+        return Robot.objects.filter(owner=user, unique_robot_id=unique_robot_id).values_list("id", "robot_id").first()
+
+    async def start_replay(self, params, user):
+        robot = None
+        if user is not None and user.is_authenticated and params.get("unique_robot_id"):
+            robot = await self.get_owned_robot(user, params["unique_robot_id"])
+        since = parse_datetime(params.get("since", ""))
+        until = parse_datetime(params["until"]) if params.get("until") else None
+        try:
+            speed = float(params.get("speed", 1))
+        except ValueError:
+            speed = 0
+        if robot is None or since is None or not 0 < speed <= self.REPLAY_MAX_SPEED:
+            await self.close(code=4003)
+            logger.error("Frontend replay refused: invalid robot or parameters")
+            return
+
+        await self.accept()
+        self.replay_speed = speed
+        self.replay_running = asyncio.Event()
+        self.replay_running.set()
+        self.replay_task = asyncio.create_task(self.replay(
+            params["unique_robot_id"], robot, make_aware(since) if is_naive(since) else since,
+            (make_aware(until) if is_naive(until) else until) if until else None,
+        ))
+
+    async def replay(self, unique_robot_id, robot, since, until):
+        # 履歴の時刻と経過時間の対応（anchor）から送信時刻を決め、送信時刻が来た行をまとめて1フレームで送る
+        robot_pk, robot_id = robot
+        loop = asyncio.get_running_loop()
+        cursor = (since, 0)
+        self.replay_anchor = None  # (経過時間の基準, 履歴時刻の基準)
+        try:
+            while True:
+                rows = await db_sync_to_async("replay")(replay_rows)(robot_pk, cursor, until)
+                if not rows:
+                    break
+                cursor = (rows[-1][1], rows[-1][0])
+                frame = []
+                for _, timestamp, state in rows:
+                    await self.replay_running.wait()
+                    if self.replay_anchor is None:
+                        self.replay_anchor = (loop.time(), timestamp)
+                    wall, anchor = self.replay_anchor
+                    delay = wall + (timestamp - anchor).total_seconds() / self.replay_speed - loop.time()
+                    if delay > self.REPLAY_MAX_WAIT:
+                        # 空白期間を詰める
+                        self.replay_anchor = (loop.time() + self.REPLAY_MAX_WAIT, timestamp)
+                        delay = self.REPLAY_MAX_WAIT
+                    if delay > 0:
+                        if frame:
+                            await self.send_replay_frame(frame)
+                            frame = []
+                        await asyncio.sleep(delay)
+                    frame.append({
+                        "unique_robot_id": unique_robot_id,
+                        "robot_id": robot_id,
+                        "timestamp": timestamp.isoformat(),
+                        "state": state,
+                    })
+                if frame:
+                    await self.send_replay_frame(frame)
+            await self.send_message(json.dumps({"type": "replay_end"}))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error replaying history for {unique_robot_id}: {e}")
+
+    async def send_replay_frame(self, frame):
+        await self.send_message(json.dumps({"type": "replay", "robots": frame}))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # リプレイの操作（ライブ配信では受信したメッセージは使わない）
+        if self.replay_task is None or not text_data:
+            return
+        try:
+            command = json.loads(text_data)
+            action = command.get("action")
+            if action == "pause":
+                self.replay_running.clear()
+                self.replay_anchor = None
+            elif action == "resume":
+                self.replay_anchor = None
+                self.replay_running.set()
+            elif action == "speed":
+                speed = float(command["speed"])
+                if 0 < speed <= self.REPLAY_MAX_SPEED:
+                    self.replay_speed = speed
+                    self.replay_anchor = None
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Invalid replay command: {e}")
+
+    async def send_message(self, text, binary=None):
+        # binary: 配信タスクがエンコードした MessagePack（ない場合はここで変換する）
+        if self.use_msgpack:
+            await self.send(bytes_data=binary if binary is not None else msgpack.packb(json.loads(text)))
+        else:
+            await self.send(text_data=text)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if getattr(self, "group_names", None):
+            metrics.FRONTEND_CONNECTIONS.dec()
+        if getattr(self, "replay_task", None) is not None:
+            self.replay_task.cancel()
+        self.stop_writer()
+        for group_name in getattr(self, "group_names", []):
+            await self.channel_layer.group_discard(group_name, self.channel_name)
         logger.info(f"Frontend WebSocket disconnected: {self.channel_name}")
 
+    def stop_writer(self):
+        if self.writer is None:
+            return
+        self.writer.cancel()
+        self.writer = None
+        if self.pending_frame is not None or self.pending_robots is not None:
+            metrics.FRONTEND_FRAMES_DROPPED.inc()
+        self.pending_frame = self.pending_robots = self.pending_fleet = None
+        self.pending_alerts = []
+
     async def send_to_client(self, event):
-        try:
-            await self.send(text_data=json.dumps(event["data"]))
-        except Exception as e:
-            logger.error(f"Error sending data to frontend: {e}")
+        # チャンネルレイヤーの受信キューを詰まらせないよう、ここではソケットへの書き込みを待たない
+        if self.writer is None:
+            metrics.FRONTEND_FRAMES_DROPPED.inc()
+            return
+
+        if self.pending_frame is None and self.pending_robots is None:
+            self.pending_frame = event
+            self.pending_since = time.monotonic()
+        else:
+            if self.pending_robots is None:
+                self.pending_robots = {}
+                self.coalesce(self.pending_frame["text"])
+                self.pending_frame = None
+            self.coalesce(event["text"])
+            metrics.FRONTEND_FRAMES_COALESCED.inc()
+        self.pending_event.set()
+
+        oldest = self.sending_since or self.pending_since
+        lag = time.monotonic() - oldest
+        if lag > settings.ROBOT_FRONTEND_MAX_LAG:
+            logger.warning(f"Frontend {self.channel_name} is {lag:.1f}s behind. Disconnecting.")
+            metrics.FRONTEND_LAGGING_DISCONNECTS.inc()
+            self.stop_writer()
+            await self.close(code=self.LAGGING_CLOSE_CODE)
+
+    async def send_fleet(self, event):
+        # フリート集計は差分ではないので合成せず、未送信の古い集計を置き換える
+        if self.writer is None:
+            return
+        self.pending_fleet = event
+        self.pending_event.set()
+
+    async def send_alert(self, event):
+        if self.writer is None:
+            return
+        if len(self.pending_alerts) >= self.MAX_PENDING_ALERTS:
+            self.pending_alerts.pop(0)
+            metrics.FRONTEND_FRAMES_DROPPED.inc()
+        self.pending_alerts.append(event)
+        self.pending_event.set()
+
+    def coalesce(self, text):
+        message = json.loads(text)
+        self.pending_head = {"epoch": message.get("epoch"), "seq": message.get("seq")}  # 合成したフレームの位置は最後の delta
+        for entry in message["robots"]:
+            pending = self.pending_robots.get(entry["unique_robot_id"])
+            if pending is None:
+                self.pending_robots[entry["unique_robot_id"]] = entry
+            else:
+                merge_frontend_entry(pending, entry)
+
+    async def write_loop(self):
+        while True:
+            await self.pending_event.wait()
+            self.pending_event.clear()
+            frame, robots, fleet = self.pending_frame, self.pending_robots, self.pending_fleet
+            if frame is None and robots is None and fleet is None and not self.pending_alerts:
+                continue
+            frames = []  # グループメッセージ {"text", "bytes"?}
+            if frame is not None or robots is not None:
+                self.pending_frame = self.pending_robots = None
+                self.sending_since, self.pending_since = self.pending_since, None
+                if robots is not None:
+                    # 合成したフレームはこの接続だけのものなので、使う形式だけをエンコードする
+                    message = {"type": "delta", **self.pending_head, "robots": list(robots.values())}
+                    if self.use_msgpack:
+                        frame = {"text": None, "bytes": msgpack.packb(message)}
+                    else:
+                        frame = {"text": json.dumps(message)}
+                frames.append(frame)
+            if self.pending_alerts:
+                frames.extend(self.pending_alerts)
+                self.pending_alerts = []
+            if fleet is not None:
+                self.pending_fleet = None
+                frames.append(fleet)
+
+            for frame in frames:
+                started = time.perf_counter()
+                try:
+                    await self.send_message(frame["text"], frame.get("bytes"))
+                except Exception as e:
+                    logger.error(f"Error sending data to frontend: {e}")
+                metrics.FRONTEND_SEND_SECONDS.observe(time.perf_counter() - started)
+                metrics.FRONTEND_FRAMES_SENT.inc()
+            self.sending_since = None
 
 # サーバー起動時にタスクを開始
+background_tasks = []
+
+
 async def start_tasks(channel_layer):
     logger.info("start_tasks called with channel_layer: %s", channel_layer)
-    asyncio.create_task(SharedTasks.flush_to_db())
-    asyncio.create_task(SharedTasks.send_to_frontend(channel_layer))
+    try:
+        await SharedTasks.recover_spool()
+    except Exception as e:
+        logger.error(f"Error recovering state spool: {e}")
+    background_tasks.extend([
+        asyncio.create_task(SharedTasks.flush_to_db()),
+        asyncio.create_task(SharedTasks.maintain_history()),
+        asyncio.create_task(SharedTasks.send_to_frontend(channel_layer)),
+        asyncio.create_task(liveness_monitor.run()),
+        asyncio.create_task(SharedTasks.flush_sessions()),
+        asyncio.create_task(SharedTasks.sync_spool()),
+    ])
+
+
+async def stop_tasks():
+    # 定期タスクを止めてから、残っているキャッシュを書き込む
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await SharedTasks.shutdown()
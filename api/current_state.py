@@ -0,0 +1,136 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+from django.utils.timezone import localtime
+from .models import Robot, RobotCurrentState, RobotConnectionSession, RobotStateHistory
+from .sessions import online_cutoff
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_CHUNK_SIZE = 500
+
+
+def dashboard_cache_key(owner_id):
+    return f"robot_dashboard:{owner_id}"
+
+
+def detail_cache_key(unique_robot_id):
+    return f"robot_detail:{unique_robot_id}"
+
+
+def invalidate_robot_cache(unique_robot_id=None, owner_id=None):
+    # Robot の追加・更新・削除と最新状態の更新時に呼ぶ
+    keys = []
+    if unique_robot_id is not None:
+        keys.append(detail_cache_key(unique_robot_id))
+    if owner_id is not None:
+        keys.append(dashboard_cache_key(owner_id))
+    if keys:
+        cache.delete_many(keys)
+
+
+def update_current_states(latest):
+    # latest: { Robot.pk: {"state", "timestamp"} }（書き込んだ履歴のうちロボットごとに最新の1件）
+    # 既存の記録より新しいものだけを反映し、反映したロボットのキャッシュを無効化する
+    robot_pks = list(latest)
+    existing = {}
+    for i in range(0, len(robot_pks), LOOKUP_CHUNK_SIZE):
+        existing.update(
+            RobotCurrentState.objects.filter(robot_id__in=robot_pks[i:i + LOOKUP_CHUNK_SIZE])
+            .values_list("robot_id", "timestamp")
+        )
+
+    creates, updates = [], []
+    for robot_pk, data in latest.items():
+        current = RobotCurrentState(robot_id=robot_pk, state=data["state"], timestamp=data["timestamp"])
+        if robot_pk not in existing:
+            creates.append(current)
+        elif data["timestamp"] > existing[robot_pk]:
+            updates.append(current)
+    # 他のワーカーと同時に作成した場合は先に書いた方を残す
+    RobotCurrentState.objects.bulk_create(creates, ignore_conflicts=True, batch_size=settings.ROBOT_FLUSH_BATCH_SIZE)
+    RobotCurrentState.objects.bulk_update(updates, ["state", "timestamp"], batch_size=settings.ROBOT_FLUSH_BATCH_SIZE)
+
+    changed = [current.robot_id for current in creates + updates]
+    for i in range(0, len(changed), LOOKUP_CHUNK_SIZE):
+        for unique_robot_id, owner_id in Robot.objects.filter(
+            id__in=changed[i:i + LOOKUP_CHUNK_SIZE]
+        ).values_list("unique_robot_id", "owner_id"):
+            invalidate_robot_cache(unique_robot_id, owner_id)
+    return len(changed)
+
+
+def backfill_current_states(include_existing=False, chunk_size=LOOKUP_CHUNK_SIZE):
+    # 各ロボットの最新の履歴から RobotCurrentState を作る（テーブル追加前の履歴を持つロボット用）
+    # include_existing: 記録済みのロボットも対象にする（履歴の方が新しい場合だけ反映する）
+    robots = Robot.objects.order_by("id")
+    if not include_existing:
+        robots = robots.filter(current_state__isnull=True)
+    latest_history = RobotStateHistory.objects.filter(robot=OuterRef("pk")).order_by("-timestamp", "-id").values("id")[:1]
+
+    updated = 0
+    last_pk = 0
+    while True:
+        chunk = list(
+            robots.filter(id__gt=last_pk)
+            .annotate(latest_history_id=Subquery(latest_history))
+            .values_list("id", "latest_history_id")[:chunk_size]
+        )
+        if not chunk:
+            return updated
+        last_pk = chunk[-1][0]
+        history_ids = [history_id for _, history_id in chunk if history_id is not None]
+        latest = {
+            robot_pk: {"state": state, "timestamp": timestamp}
+            for robot_pk, state, timestamp in RobotStateHistory.objects.filter(id__in=history_ids)
+            .values_list("robot_id", "state", "timestamp")
+        }
+        if latest:
+            updated += update_current_states(latest)
+
+
+def format_timestamp(timestamp, default):
+    return localtime(timestamp).strftime("%Y/%m/%d %H:%M:%S") if timestamp else default
+
+
+def get_dashboard_robots(user):
+    # ダッシュボードの行データ（ロボットと最新状態は1クエリで取得してキャッシュする）
+    # 接続状態はセッションの開始・終了や生存記録の途絶で変わるので、キャッシュせずにリクエストごとに求める
+    key = dashboard_cache_key(user.id)
+    robots = cache.get(key)
+    if robots is None:
+        robots = []
+        for robot in Robot.objects.filter(owner=user).select_related("current_state").order_by("id"):
+            current = getattr(robot, "current_state", None)
+            robots.append({
+                "unique_robot_id": robot.unique_robot_id,
+                "robot_id": robot.robot_id,
+                "last_connected": format_timestamp(robot.last_connected, "Never"),
+                "latest_timestamp": format_timestamp(current.timestamp if current else None, "No Data"),
+                "latest_state": current.state if current else None,
+            })
+        cache.set(key, robots, settings.ROBOT_DASHBOARD_CACHE_TTL)
+
+    online = set(
+        RobotConnectionSession.objects.filter(
+            robot__owner=user, disconnected_at__isnull=True, last_seen_at__gte=online_cutoff()
+        ).values_list("robot__unique_robot_id", flat=True)
+    )
+    return [dict(robot, online=robot["unique_robot_id"] in online) for robot in robots]
+
+
+def get_detail_robot(unique_robot_id):
+    # 詳細ページの Robot（最新状態を含む）。存在しない場合は None
+    key = detail_cache_key(unique_robot_id)
+    robot = cache.get(key)
+    if robot is not None:
+        return robot
+
+    robot = Robot.objects.select_related("owner", "current_state").filter(unique_robot_id=unique_robot_id).first()
+    if robot is None:
+        return None
+    current = getattr(robot, "current_state", None)
+    robot.latest_timestamp = format_timestamp(current.timestamp if current else None, "No Data")
+    cache.set(key, robot, settings.ROBOT_DASHBOARD_CACHE_TTL)
+    return robot
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from channels.consumer import get_handler_name
+from django.conf import settings
+from django.db import connections
+from . import metrics
+import functools
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# コンシューマー・定期タスクから DB を呼び出すためのスレッドプール
+# sync_to_async の既定 (thread_sensitive=True) では全ての呼び出しが1つのスレッドに直列化され、
+# 接続直後のロボット登録が他のロボットの処理や30秒ごとのフラッシュの後ろに並んでしまう
+# 用途ごとに上限付きのプールを分け、各スレッドは自分の DB 接続を使い回す
+#   interactive: ロボットの登録・識別情報の更新、フロントエンドの問い合わせ（短いクエリ）
+#   background: 履歴のフラッシュ・集計・セッションの書き込み（長いトランザクション）
+DB_POOLS = ("interactive", "background")
+
+_executors = {}
+
+
+def get_executor(pool):
+    # イベントループのスレッドからのみ呼ばれるためロックは不要
+    size = settings.ROBOT_DB_POOL_SIZES[pool]
+    if connections["default"].vendor == "sqlite":
+        # SQLite は書き込みが1つずつしかできず、スレッドを分けるとフラッシュとロックを奪い合って遅くなるため1スレッドにまとめる
+        pool, size = "sqlite", 1
+    executor = _executors.get(pool)
+    if executor is None:
+        executor = _executors[pool] = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"robot-db-{pool}")
+        logger.info(f"DB executor '{pool}' started with {size} threads")
+    return executor
+
+
+def shutdown_executors(wait=True):
+    for pool in list(_executors):
+        _executors.pop(pool).shutdown(wait=wait)
+
+
+def discard_broken_connections():
+    # プールのスレッドはリクエストの終了処理を通らないため、エラーが起きて使えなくなった接続だけをここで捨てる
+    for connection in connections.all(initialized_only=True):
+        if connection.connection is not None and connection.errors_occurred:
+            if connection.is_usable():
+                connection.errors_occurred = False
+            else:
+                connection.close()
+
+
+def db_sync_to_async(operation, pool="interactive"):
+    # sync_to_async と同じように使い、指定したプールのスレッドで実行する
+    # スレッドの待ち時間と実行時間を記録する
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            enqueued = time.perf_counter()
+            metrics.DB_POOL_PENDING.inc(1, pool)
+
+            def run():
+                metrics.SYNC_TO_ASYNC_WAIT_SECONDS.observe(time.perf_counter() - enqueued, operation)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    discard_broken_connections()
+
+            try:
+                return await sync_to_async(run, thread_sensitive=False, executor=get_executor(pool))()
+            finally:
+                metrics.DB_POOL_PENDING.dec(1, pool)
+                metrics.SYNC_TO_ASYNC_SECONDS.observe(time.perf_counter() - enqueued, operation)
+        return wrapper
+    return decorator
+
+
+class DBExecutorConsumerMixin:
+    # Channels はメッセージごとに共有の同期スレッドで close_old_connections を実行するため、
+    # そのスレッドで DB 処理が動いていると全ての受信がその後ろに並ぶ
+    # DB 呼び出しを全て db_sync_to_async のプールで行うコンシューマーではこの切り替えを省く
+
+    async def dispatch(self, message):
+        handler = getattr(self, get_handler_name(message), None)
+        if handler:
+            await handler(message)
+        else:
+            raise ValueError(f"No handler for message type {message['type']}")
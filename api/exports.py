@@ -0,0 +1,177 @@
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from .models import RobotStateHistory
+import csv
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 2000  # サーバーサイドカーソルで1回に読む行数
+EXPORT_FLUSH_BYTES = 64 * 1024  # この大きさごとにレスポンスへ書き出す
+
+EXPORT_CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_queryset(robots, since=None, until=None):
+    queryset = RobotStateHistory.objects.filter(robot__in=robots)
+    if since:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until:
+        queryset = queryset.filter(timestamp__lt=until)
+    # robot と timestamp の複合インデックス順に読み、行ごとの Robot 取得を避けるため値だけを取り出す
+    return queryset.order_by("robot_id", "timestamp").values_list(
+        "robot__unique_robot_id", "robot__robot_id", "timestamp", "state"
+    )
+
+
+def iter_rows(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def _project(state, fields):
+    if not isinstance(state, dict):
+        return [None for _ in fields]
+    return [state.get(field) for field in fields]
+
+
+def iter_ndjson(rows, fields=None):
+    buffer = io.StringIO()
+    for unique_robot_id, robot_id, timestamp, state in rows:
+        if fields:
+            state = dict(zip(fields, _project(state, fields)))
+        buffer.write(json.dumps({
+            "unique_robot_id": unique_robot_id,
+            "robot_id": robot_id,
+            "timestamp": timestamp.isoformat(),
+            "state": state,
+        }, ensure_ascii=False))
+        buffer.write("\n")
+        if buffer.tell() >= EXPORT_FLUSH_BYTES:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def iter_csv(rows, fields=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["unique_robot_id", "robot_id", "timestamp"] + (list(fields) if fields else ["state"]))
+    for unique_robot_id, robot_id, timestamp, state in rows:
+        values = _project(state, fields) if fields else [json.dumps(state, ensure_ascii=False)]
+        writer.writerow([unique_robot_id, robot_id, timestamp.isoformat()] + values)
+        if buffer.tell() >= EXPORT_FLUSH_BYTES:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    # ParquetWriter の出力を溜めて、行グループごとに取り出す
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def iter_parquet(rows, fields=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # 列指向形式。pyarrow がインストールされている場合のみ利用できる
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImproperlyConfigured("Parquet export requires pyarrow.")
+
+    columns = [
+        ("unique_robot_id", pa.string()),
+        ("robot_id", pa.string()),
+        ("timestamp", pa.timestamp("us", tz="UTC")),
+    ]
+    if fields:
+        # 指定されたフィールドは数値列として書き出す（数値でない値は null）
+        columns += [(field, pa.float64()) for field in fields]
+    else:
+        columns.append(("state", pa.string()))
+    schema = pa.schema(columns)
+
+    def to_number(value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        return None
+
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                writer.write_table(_parquet_table(pa, schema, batch, fields, to_number))
+                batch = []
+                yield sink.drain()
+        if batch:
+            writer.write_table(_parquet_table(pa, schema, batch, fields, to_number))
+    yield sink.drain()
+
+
+def _parquet_table(pa, schema, batch, fields, to_number):
+    data = {
+        "unique_robot_id": [row[0] for row in batch],
+        "robot_id": [row[1] for row in batch],
+        "timestamp": [row[2] for row in batch],
+    }
+    if fields:
+        projected = [_project(row[3], fields) for row in batch]
+        for index, field in enumerate(fields):
+            data[field] = [to_number(values[index]) for values in projected]
+    else:
+        data["state"] = [json.dumps(row[3], ensure_ascii=False) for row in batch]
+    return pa.Table.from_pydict(data, schema=schema)
+
+
+EXPORT_WRITERS = {
+    "ndjson": iter_ndjson,
+    "csv": iter_csv,
+    "parquet": iter_parquet,
+}
+
+
+def iter_export(queryset, export_format, fields=None):
+    return EXPORT_WRITERS[export_format](iter_rows(queryset), fields=fields)
+
+
+async def aiter_export(chunks):
+    # ASGI で StreamingHttpResponse に同期イテレータを渡すと全件を list 化してしまうため、
+    # 1チャンクずつ同じ DB スレッドで読み進める非同期イテレータに変換する
+    chunks = iter(chunks)
+    next_chunk = sync_to_async(lambda: next(chunks, None), thread_sensitive=True)
+    while True:
+        chunk = await next_chunk()
+        if chunk is None:
+            break
+        yield chunk
@@ -0,0 +1,179 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .schema import STATE_FIELD_TYPES, typed_value
+from array import array
+from collections import Counter
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+NAN = float("nan")
+
+
+class OwnerAggregate:
+    # 1人の所有者のロボットの最新状態を集計する
+    # ロボットごとにスロット番号を割り当て、数値フィールドは array('d') の列に持つ（値がなければ NaN）
+    # 合計と件数は更新のたびに差し引きし、最小・最大は外れた値が最小・最大だった場合だけ再計算する
+    # 差し引きを繰り返すと合計に丸め誤差が溜まるので、定期的な全件配信のときに列から計算し直す (refresh)
+    # 集計の対象はオンラインのロボットだけ
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.slots = {}  # { unique_robot_id: スロット番号 }
+        self.free = []
+        self.online = bytearray()
+        self.columns = {field: array("d") for field, field_type in fields.items() if field_type == "number"}
+        self.texts = {field: [] for field, field_type in fields.items() if field_type == "text"}
+        self.sums = dict.fromkeys(self.columns, 0.0)
+        self.counts = dict.fromkeys(self.columns, 0)
+        self.minimum = dict.fromkeys(self.columns, math.inf)
+        self.maximum = dict.fromkeys(self.columns, -math.inf)
+        self.stale = set()  # 最小・最大の再計算が必要なフィールド
+        self.text_counts = {field: Counter() for field in self.texts}
+        self.online_count = 0
+
+    def _slot(self, unique_robot_id):
+        index = self.slots.get(unique_robot_id)
+        if index is not None:
+            return index
+        if self.free:
+            index = self.free.pop()
+        else:
+            index = len(self.online)
+            self.online.append(0)
+            for column in self.columns.values():
+                column.append(NAN)
+            for values in self.texts.values():
+                values.append(None)
+        self.slots[unique_robot_id] = index
+        return index
+
+    def update(self, unique_robot_id, online, state):
+        index = self._slot(unique_robot_id)
+        was_online = self.online[index]
+        self.online[index] = 1 if online else 0
+        self.online_count += self.online[index] - was_online
+        state = state if isinstance(state, dict) else {}
+
+        for field, column in self.columns.items():
+            old = column[index]
+            new = typed_value(state.get(field), "number")
+            new = NAN if new is None or not math.isfinite(new) else new  # inf は合計を壊すので値なしとして扱う
+            column[index] = new
+            if was_online and old == old:
+                self.sums[field] -= old
+                self.counts[field] -= 1
+                if old <= self.minimum[field] or old >= self.maximum[field]:
+                    self.stale.add(field)
+            if online and new == new:
+                self.sums[field] += new
+                self.counts[field] += 1
+                self.minimum[field] = min(self.minimum[field], new)
+                self.maximum[field] = max(self.maximum[field], new)
+
+        for field, values in self.texts.items():
+            old = values[index]
+            new = typed_value(state.get(field), "text")
+            values[index] = new
+            if was_online and old is not None:
+                self.text_counts[field][old] -= 1
+                if not self.text_counts[field][old]:
+                    del self.text_counts[field][old]
+            if online and new is not None:
+                self.text_counts[field][new] += 1
+
+    def remove(self, unique_robot_id):
+        if unique_robot_id not in self.slots:
+            return
+        self.update(unique_robot_id, False, {})
+        self.free.append(self.slots.pop(unique_robot_id))
+
+    def _recompute(self, field):
+        values = [value for value, online in zip(self.columns[field], self.online) if online and value == value]
+        self.minimum[field] = min(values, default=math.inf)
+        self.maximum[field] = max(values, default=-math.inf)
+        return values
+
+    def refresh(self):
+        # 合計・件数・最小・最大をすべて列から計算し直す（合計は math.fsum で誤差なく足す）
+        for field in self.columns:
+            values = self._recompute(field)
+            self.sums[field] = math.fsum(values)
+            self.counts[field] = len(values)
+        self.stale.clear()
+
+    def summary(self):
+        for field in self.stale:
+            self._recompute(field)
+        self.stale.clear()
+        fields = {}
+        for field in self.columns:
+            count = self.counts[field]
+            fields[field] = {
+                "count": count,
+                "avg": self.sums[field] / count if count else None,
+                "min": self.minimum[field] if count else None,
+                "max": self.maximum[field] if count else None,
+            }
+        for field, counts in self.text_counts.items():
+            fields[field] = {"counts": dict(counts)}
+        return {"total": len(self.slots), "online": self.online_count, "fields": fields}
+
+
+class FleetAggregator:
+    # 所有者ごとの集計。配信タスクが各ロボットの最新状態を渡し、変化した所有者の集計だけを返す
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.owners = {}  # { owner: OwnerAggregate }
+        self.robot_owners = {}  # { unique_robot_id: owner }
+        self.dirty = set()
+
+    def update(self, unique_robot_id, owner, online, state):
+        previous = self.robot_owners.get(unique_robot_id)
+        if previous is not None and previous != owner:
+            # 所有者が変わったロボットは前の所有者の集計から外す
+            self.owners[previous].remove(unique_robot_id)
+            self.dirty.add(previous)
+        aggregate = self.owners.get(owner)
+        if aggregate is None:
+            aggregate = self.owners[owner] = OwnerAggregate(self.fields)
+        aggregate.update(unique_robot_id, online, state)
+        self.robot_owners[unique_robot_id] = owner
+        self.dirty.add(owner)
+
+    def seed(self, unique_robot_id, owner, online, state):
+        # 配信を引き継いだときの初期値（引き継いだ後にすでに更新したロボットは上書きしない）
+        if unique_robot_id not in self.robot_owners:
+            self.update(unique_robot_id, owner, online, state)
+
+    def remove(self, unique_robot_id):
+        # 削除されたロボットを集計から外す
+        owner = self.robot_owners.pop(unique_robot_id, None)
+        if owner is not None:
+            self.owners[owner].remove(unique_robot_id)
+            self.dirty.add(owner)
+
+    def prune(self, unique_robot_ids):
+        # unique_robot_ids（登録済みのロボット）に含まれないロボットを外す
+        for unique_robot_id in [uid for uid in self.robot_owners if uid not in unique_robot_ids]:
+            self.remove(unique_robot_id)
+
+    def take_summaries(self, everyone=False):
+        # { owner: 集計 }（everyone=True の場合は変化していない所有者も含め、合計を計算し直してから返す）
+        owners = list(self.owners) if everyone else self.dirty
+        if everyone:
+            for aggregate in self.owners.values():
+                aggregate.refresh()
+        summaries = {owner: self.owners[owner].summary() for owner in owners if owner in self.owners}
+        self.dirty = set()
+        return summaries
+
+
+def get_fleet_fields():
+    fields = getattr(settings, "ROBOT_FLEET_FIELDS", {}) or {}
+    for key, field_type in fields.items():
+        if field_type not in STATE_FIELD_TYPES:
+            raise ImproperlyConfigured(f"ROBOT_FLEET_FIELDS: unknown type '{field_type}' for '{key}'.")
+    return dict(fields)
@@ -0,0 +1,349 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils.timezone import now
+from .models import (
+    Robot, RobotStateHistory, RobotStateRollup, RobotStateValue, RobotHeatmapTile, HistoryCheckpoint,
+    RobotStateDeadLetter,
+)
+from . import metrics
+from .current_state import update_current_states
+from .schema import get_state_schema, extract_state_values
+from .spatial import accumulate_heatmap, save_heatmap_tiles
+from datetime import timedelta
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# IN 句 1回あたりの最大件数（SQLite の変数上限対策）
+LOOKUP_CHUNK_SIZE = 500
+
+
+def resolve_robot_ids(unique_robot_ids):
+    # unique_robot_id -> Robot.pk をまとめて解決する
+    unique_robot_ids = list(unique_robot_ids)
+    robot_ids = {}
+    for i in range(0, len(unique_robot_ids), LOOKUP_CHUNK_SIZE):
+        chunk = unique_robot_ids[i:i + LOOKUP_CHUNK_SIZE]
+        robot_ids.update(
+            Robot.objects.filter(unique_robot_id__in=chunk).values_list("unique_robot_id", "id")
+        )
+    return robot_ids
+
+
+def write_dead_letters(dead_letters):
+    # dead_letters: [(unique_robot_id, 行, エラー), ...]
+    # 隔離テーブルにも書き込めない場合は行の内容をログに残して破棄する
+    try:
+        RobotStateDeadLetter.objects.bulk_create([
+            RobotStateDeadLetter(
+                unique_robot_id=unique_robot_id,
+                timestamp=data.get("timestamp"),
+                payload=json.dumps(data, default=str),
+                error=error,
+                attempts=data.get("attempts", 0),
+            )
+            for unique_robot_id, data, error in dead_letters
+        ])
+    except Exception as e:
+        logger.error(f"Error writing dead-lettered state history: {e}")
+        for unique_robot_id, data, error in dead_letters:
+            logger.error(f"Discarded state history row for {unique_robot_id}: {json.dumps(data, default=str)} ({error})")
+
+
+def write_state_history(cache_snapshot, batch_size=None):
+    # cache_snapshot: { unique_robot_id: [{"state", "timestamp", ...}] }
+    # バッチの書き込みに失敗した場合は1行ずつ書き直し、それでも書き込めない行だけを stats["failed"] に入れて返す
+    # （呼び出し側でキャッシュに戻す）。行ごとの試行回数は "attempts" に数え、ROBOT_FLUSH_MAX_ATTEMPTS 回に
+    # 達した行は再試行せずに RobotStateDeadLetter へ隔離する（常に失敗する行が後続の行を妨げ続けないように）
+    batch_size = batch_size or settings.ROBOT_FLUSH_BATCH_SIZE
+    started = time.perf_counter()
+    stats = {
+        "rows": 0, "dropped": 0, "batches": 0, "duration": 0.0, "rows_per_sec": 0.0, "failed": {}, "dead_lettered": 0,
+    }
+
+    robot_ids = resolve_robot_ids(uid for uid, cache in cache_snapshot.items() if cache)
+
+    rows = []
+    sources = []
+    for unique_robot_id, cache in cache_snapshot.items():
+        if not cache:
+            continue
+        robot_pk = robot_ids.get(unique_robot_id)
+        if robot_pk is None:
+            # 削除済みのロボットの履歴は書き込めないので破棄する
+            stats["dropped"] += len(cache)
+            logger.warning(f"Robot {unique_robot_id} does not exist. Dropped {len(cache)} cached rows.")
+            continue
+        for data in cache:
+            rows.append(RobotStateHistory(robot_id=robot_pk, state=data["state"], timestamp=data["timestamp"]))
+            sources.append((unique_robot_id, data))
+
+    # バッチごとに短いトランザクションで書き込む（スキーマで指定したキーはサイドテーブルにも書く）
+    schema = get_state_schema()
+    latest = {}  # { Robot.pk: 書き込めた行のうち最新のもの }
+
+    def write_batch(batch):
+        with transaction.atomic():
+            RobotStateHistory.objects.bulk_create(batch)
+            if schema:
+                RobotStateValue.objects.bulk_create([
+                    value
+                    for row in batch
+                    for value in extract_state_values(row.robot_id, row.state, row.timestamp, schema)
+                ], batch_size=batch_size)
+        stats["rows"] += len(batch)
+        for row in batch:
+            if row.robot_id not in latest or row.timestamp > latest[row.robot_id]["timestamp"]:
+                latest[row.robot_id] = {"state": row.state, "timestamp": row.timestamp}
+
+    dead_letters = []
+    for i in range(0, len(rows), batch_size):
+        try:
+            write_batch(rows[i:i + batch_size])
+            stats["batches"] += 1
+        except Exception as e:
+            logger.error(f"Error writing state history batch: {e}. Retrying the batch row by row.")
+            for row, (unique_robot_id, data) in zip(rows[i:i + batch_size], sources[i:i + batch_size]):
+                try:
+                    write_batch([row])
+                except Exception as row_error:
+                    attempts = data.get("attempts", 0) + 1
+                    if attempts >= settings.ROBOT_FLUSH_MAX_ATTEMPTS:
+                        logger.error(
+                            f"State history row for {unique_robot_id} at {data['timestamp']} failed {attempts} times. "
+                            f"Moving it to the dead-letter table: {row_error}"
+                        )
+                        dead_letters.append((unique_robot_id, dict(data, attempts=attempts), str(row_error)))
+                    else:
+                        stats["failed"].setdefault(unique_robot_id, []).append(dict(data, attempts=attempts))
+    if dead_letters:
+        write_dead_letters(dead_letters)
+        stats["dead_lettered"] = len(dead_letters)
+
+    # 最新状態テーブルを更新する（失敗しても履歴は書き込み済みなので再試行しない）
+    if latest:
+        try:
+            update_current_states(latest)
+        except Exception as e:
+            logger.error(f"Error updating current robot states: {e}")
+
+    stats["duration"] = time.perf_counter() - started
+    metrics.FLUSH_ROWS.observe(stats["rows"])
+    metrics.FLUSH_SECONDS.observe(stats["duration"])
+    metrics.FLUSH_ROWS_WRITTEN.inc(stats["rows"])
+    metrics.FLUSH_ROWS_DROPPED.inc(stats["dropped"])
+    metrics.FLUSH_ROWS_FAILED.inc(sum(len(failed) for failed in stats["failed"].values()))
+    metrics.FLUSH_ROWS_DEAD_LETTERED.inc(stats["dead_lettered"])
+    if stats["duration"] > 0:
+        stats["rows_per_sec"] = stats["rows"] / stats["duration"]
+    if stats["rows"]:
+        logger.info(
+            f"Flushed {stats['rows']} rows in {stats['batches']} batches "
+            f"({stats['duration'] * 1000:.1f} ms, {stats['rows_per_sec']:.0f} rows/sec)."
+        )
+    return stats
+
+
+# ロールアップの集計単位
+ROLLUP_RESOLUTIONS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+}
+ROLLUP_CHUNK_SIZE = 5000  # 1トランザクションで集計する履歴の行数
+ROLLUP_HORIZON = "rollup_horizon"  # HistoryCheckpoint.name
+EXPIRE_CHUNK_SIZE = 5000  # 1回の DELETE で削除する行数
+
+
+def bucket_start(timestamp, resolution):
+    if resolution == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(second=0, microsecond=0)
+
+
+def numeric_fields(state):
+    # 状態のうち数値のフィールドだけを集計対象にする
+    if not isinstance(state, dict):
+        return {}
+    return {
+        key: value for key, value in state.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+
+def merge_field_stats(stats, value, timestamp):
+    timestamp = timestamp.isoformat()
+    if not stats:
+        return {"min": value, "max": value, "sum": value, "count": 1, "last": value, "last_at": timestamp}
+    stats["min"] = min(stats["min"], value)
+    stats["max"] = max(stats["max"], value)
+    stats["sum"] += value
+    stats["count"] += 1
+    if timestamp >= stats["last_at"]:
+        stats["last"] = value
+        stats["last_at"] = timestamp
+    return stats
+
+
+def rollup_watermark():
+    # 集計済みの RobotStateHistory.id の最大値
+    return RobotStateRollup.objects.aggregate(watermark=Max("last_history_id"))["watermark"] or 0
+
+
+def rollup_horizon(current_time=None, commit_lag=None):
+    # 集計してよい RobotStateHistory.id の上限（まだ集計できない場合は None）
+    # PostgreSQL / MySQL では id はコミット前に採番されるため、並行するフラッシュでは小さい id の行が後からコミットされる
+    # watermark をそのまま最新の id まで進めると、後からコミットされた行は watermark より下に入って集計されない
+    # そこで実行のたびに id の最大値を記録し、commit_lag 秒以上前に記録した値までだけを集計する
+    # （それ以下の id は記録した時点で採番済みなので、commit_lag 秒後にはコミットかロールバックが済んでいる）
+    current_time = current_time or now()
+    commit_lag = settings.ROBOT_ROLLUP_COMMIT_LAG if commit_lag is None else commit_lag
+    latest_id = RobotStateHistory.objects.aggregate(latest=Max("id"))["latest"] or 0
+    if not commit_lag:
+        return latest_id
+
+    with transaction.atomic():
+        checkpoint, created = HistoryCheckpoint.objects.select_for_update().get_or_create(
+            name=ROLLUP_HORIZON, defaults={"history_id": latest_id, "recorded_at": current_time},
+        )
+        if created or current_time - checkpoint.recorded_at < timedelta(seconds=commit_lag):
+            return None
+        horizon = checkpoint.history_id
+        checkpoint.history_id, checkpoint.recorded_at = latest_id, current_time
+        checkpoint.save(update_fields=["history_id", "recorded_at"])
+    return horizon
+
+
+def build_rollups(chunk_size=ROLLUP_CHUNK_SIZE, commit_lag=None):
+    # 前回の集計以降に追加された履歴を id 順に読み、分・時間単位のロールアップに加算する
+    # タイムスタンプではなく id を基準にするので、遅れて書き込まれた履歴も取りこぼさない
+    # 読むのはコミット済みが確実な id (rollup_horizon) までで、それより新しい行は次回に集計する
+    # 位置のヒートマップも同じ行から集計し、同じトランザクションで書き込む（ロールアップの watermark を共有する）
+    horizon = rollup_horizon(commit_lag=commit_lag)
+    if horizon is None:
+        return 0
+    watermark = rollup_watermark()
+    total = 0
+    while True:
+        rows = list(
+            RobotStateHistory.objects.filter(id__gt=watermark, id__lte=horizon)
+            .order_by("id")
+            .values_list("id", "robot_id", "state", "timestamp")[:chunk_size]
+        )
+        if not rows:
+            break
+        watermark = rows[-1][0]
+
+        buckets = {}  # { (robot_id, resolution, bucket_start): {"count", "stats"} }
+        for history_id, robot_id, state, timestamp in rows:
+            fields = numeric_fields(state)
+            for resolution in ROLLUP_RESOLUTIONS:
+                bucket = buckets.setdefault(
+                    (robot_id, resolution, bucket_start(timestamp, resolution)),
+                    {"count": 0, "stats": {}},
+                )
+                bucket["count"] += 1
+                for key, value in fields.items():
+                    bucket["stats"][key] = merge_field_stats(bucket["stats"].get(key), value, timestamp)
+        heatmap = accumulate_heatmap(rows)
+
+        with transaction.atomic():
+            existing = {
+                (rollup.robot_id, rollup.resolution, rollup.bucket_start): rollup
+                for rollup in RobotStateRollup.objects.select_for_update().filter(
+                    robot_id__in={key[0] for key in buckets},
+                    bucket_start__in={key[2] for key in buckets},
+                )
+            }
+            created, updated = [], []
+            for key, bucket in buckets.items():
+                rollup = existing.get(key)
+                if rollup is None:
+                    created.append(RobotStateRollup(
+                        robot_id=key[0], resolution=key[1], bucket_start=key[2],
+                        count=bucket["count"], stats=bucket["stats"], last_history_id=watermark,
+                    ))
+                    continue
+                rollup.count += bucket["count"]
+                for field, field_stats in bucket["stats"].items():
+                    merged = rollup.stats.get(field)
+                    if merged is None:
+                        rollup.stats[field] = field_stats
+                        continue
+                    merged["min"] = min(merged["min"], field_stats["min"])
+                    merged["max"] = max(merged["max"], field_stats["max"])
+                    merged["sum"] += field_stats["sum"]
+                    merged["count"] += field_stats["count"]
+                    if field_stats["last_at"] >= merged["last_at"]:
+                        merged["last"] = field_stats["last"]
+                        merged["last_at"] = field_stats["last_at"]
+                rollup.last_history_id = watermark
+                updated.append(rollup)
+            RobotStateRollup.objects.bulk_create(created)
+            RobotStateRollup.objects.bulk_update(updated, ["count", "stats", "last_history_id"])
+            save_heatmap_tiles(heatmap)
+        total += len(rows)
+    return total
+
+
+def _delete_in_chunks(queryset, chunk_size=EXPIRE_CHUNK_SIZE):
+    # 大きな DELETE で書き込みロックを長時間保持しないよう、id を区切って削除する
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list("id", flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            deleted += queryset.model.objects.filter(id__in=ids).delete()[0]
+
+
+def expire_history(current_time=None):
+    # 保持期間を過ぎた生データとロールアップを削除する
+    # 生データは集計済み（id が watermark 以下）で、かつ時間単位の区間が保持期間の境界より前に終わっているものだけ
+    # （1つの区間の生データを途中までだけ消さない）
+    current_time = current_time or now()
+    deleted = {"history": 0, "values": 0, "heatmap": 0}
+
+    retention_days = settings.ROBOT_HISTORY_RETENTION_DAYS
+    if retention_days:
+        deleted["history"] = _delete_in_chunks(
+            RobotStateHistory.objects.filter(
+                timestamp__lt=bucket_start(current_time - timedelta(days=retention_days), "hour"),
+                id__lte=rollup_watermark(),
+            ).order_by()
+        )
+        # サイドテーブルは生データと同じ保持期間
+        deleted["values"] = _delete_in_chunks(
+            RobotStateValue.objects.filter(timestamp__lt=current_time - timedelta(days=retention_days)).order_by()
+        )
+
+    if settings.ROBOT_HEATMAP_RETENTION_DAYS:
+        deleted["heatmap"] = _delete_in_chunks(
+            RobotHeatmapTile.objects.filter(
+                bucket_start__lt=current_time - timedelta(days=settings.ROBOT_HEATMAP_RETENTION_DAYS)
+            ).order_by()
+        )
+
+    for resolution, retention_days in settings.ROBOT_ROLLUP_RETENTION_DAYS.items():
+        deleted[resolution] = 0
+        if retention_days:
+            deleted[resolution] = _delete_in_chunks(
+                RobotStateRollup.objects.filter(
+                    resolution=resolution,
+                    bucket_start__lt=current_time - timedelta(days=retention_days),
+                ).order_by()
+            )
+    return deleted
+
+
+def maintain_history():
+    started = time.perf_counter()
+    rolled_up = build_rollups()
+    deleted = expire_history()
+    logger.info(
+        f"History maintenance: rolled up {rolled_up} rows, expired {deleted} "
+        f"({(time.perf_counter() - started) * 1000:.1f} ms)."
+    )
+    return {"rolled_up": rolled_up, "deleted": deleted}
@@ -0,0 +1,111 @@
+from . import metrics
+import asyncio
+import math
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    # ハッシュ化タイマーホイール
+    # 期限を tick 単位のスロットに振り分け、tick ごとに1スロットだけ調べる（接続数に比例した走査をしない）
+    # 1周より先の期限はスロットに残り、期限が来た周で取り出される
+
+    def __init__(self, tick=1.0, size=128):
+        self.tick = tick
+        self.slots = [{} for _ in range(size)]  # [{ key: 期限 }]
+        self.positions = {}  # { key: スロット番号 }
+        self.current_tick = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        # 期限を含む tick の次のスロットに置く（そのスロットを調べる時点で期限を過ぎている）
+        tick = math.ceil(deadline / self.tick)
+        if self.current_tick is not None:
+            tick = max(tick, self.current_tick + 1)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.positions[key] = index
+
+    def cancel(self, key):
+        index = self.positions.pop(key, None)
+        if index is not None:
+            self.slots[index].pop(key, None)
+
+    def advance(self, current_time):
+        # current_time までに期限が来たキーを取り出す
+        target = math.floor(current_time / self.tick)
+        if self.current_tick is None:
+            self.current_tick = target - 1
+        expired = []
+        # 長時間止まっていた場合でも1周分を調べれば十分
+        start = max(self.current_tick + 1, target - len(self.slots) + 1)
+        for tick in range(start, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= current_time:
+                    del slot[key]
+                    del self.positions[key]
+                    expired.append(key)
+        self.current_tick = target
+        return expired
+
+
+class LivenessMonitor:
+    # プロセス内のロボット接続の死活監視
+    # 受信のたびに最終受信時刻を更新するだけにし、期限が来た接続だけを調べる
+    #   ping_interval 秒受信がなければ {"type": "ping"} を送る
+    #   その後 pong_timeout 秒以内に何も届かなければ切断してオフラインにする
+
+    def __init__(self, tick=1.0, size=128):
+        self.wheel = TimerWheel(tick, size)
+
+    def register(self, consumer):
+        consumer.last_activity = time.monotonic()
+        consumer.ping_sent_at = None
+        self.wheel.schedule(consumer, consumer.last_activity + consumer.ping_interval)
+
+    def unregister(self, consumer):
+        self.wheel.cancel(consumer)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            try:
+                expired = self.wheel.advance(time.monotonic())
+                if expired:
+                    await asyncio.gather(*[self.check(consumer) for consumer in expired])
+            except Exception as e:
+                logger.error(f"Error checking robot liveness: {e}")
+
+    async def check(self, consumer):
+        if consumer.offline:
+            return
+        current_time = time.monotonic()
+        if consumer.ping_sent_at is not None and consumer.last_activity < consumer.ping_sent_at:
+            # ping を送った後に何も届いていない
+            logger.warning(f"Robot {consumer.unique_robot_id} did not answer ping. Closing connection.")
+            metrics.LIVENESS_TIMEOUTS.inc()
+            await consumer.close_dead_connection()
+            return
+
+        consumer.ping_sent_at = None
+        idle = current_time - consumer.last_activity
+        if idle < consumer.ping_interval:
+            self.wheel.schedule(consumer, consumer.last_activity + consumer.ping_interval)
+            return
+
+        try:
+            await consumer.send(text_data='{"type": "ping"}')
+        except Exception as e:
+            logger.error(f"Error sending ping to robot {consumer.unique_robot_id}: {e}")
+        consumer.ping_sent_at = current_time
+        metrics.LIVENESS_PINGS.inc()
+        self.wheel.schedule(consumer, current_time + consumer.pong_timeout)
+
+
+liveness_monitor = LivenessMonitor()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from api.current_state import backfill_current_states
+
+
+class Command(BaseCommand):
+    help = "各ロボットの最新の履歴から最新状態テーブル (RobotCurrentState) を作成します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="最新状態が記録済みのロボットも対象にする（履歴の方が新しい場合だけ更新する）",
+        )
+        parser.add_argument("--chunk-size", type=int, default=500, help="1度に処理するロボット数")
+
+    def handle(self, *args, **options):
+        updated = backfill_current_states(include_existing=options["all"], chunk_size=options["chunk_size"])
+        self.stdout.write(f"Backfilled current state for {updated} robots.")
@@ -0,0 +1,241 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.urls import path
+from api.consumers import RobotStateConsumer, FrontendConsumer, SharedTasks
+from api.models import Robot, RobotStateHistory
+from api.spool import get_spool
+import asyncio
+import json
+import random
+import time
+
+BENCH_OWNER = "bench"
+BENCH_ROBOT_PREFIX = "bench-"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+class BenchRobotStateConsumer(RobotStateConsumer):
+    # receive の処理時間を計測する
+    stats = None
+
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        await super().receive(text_data, bytes_data)
+        self.stats["frames"] += 1
+        self.stats["processed"] += self.stats["batch"]
+        self.stats["receive_latency"].append(time.perf_counter() - started)
+
+
+class Command(BaseCommand):
+    help = "ロボット取り込み WebSocket (ws/robots/) の負荷試験を行い、スループットと遅延を計測します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--robots", type=int, default=50, help="同時接続するロボット数")
+        parser.add_argument("--frontends", type=int, default=5, help="同時接続するフロントエンド数")
+        parser.add_argument("--rate", type=float, default=5.0, help="ロボット1台あたりの送信レート（メッセージ/秒）")
+        parser.add_argument("--batch", type=int, default=1, help="1フレームに含めるサンプル数（2以上で samples 形式）")
+        parser.add_argument("--duration", type=float, default=10.0, help="計測時間（秒）")
+        parser.add_argument("--flush-interval", type=float, default=5.0, help="DB フラッシュ間隔（秒）")
+        parser.add_argument(
+            "--subscription", choices=["owner", "robot"], default="owner",
+            help="フロントエンドの購読方法（owner: ダッシュボード / robot: 詳細ページ）",
+        )
+        parser.add_argument(
+            "--channel-layer", choices=["memory", "settings"], default="memory",
+            help="memory: InMemoryChannelLayer / settings: settings.CHANNEL_LAYERS をそのまま使う",
+        )
+        parser.add_argument(
+            "--policy", choices=["settings", "keep_all"], default="settings",
+            help="keep_all を指定すると全サンプルを保存して書き込み負荷を計測する",
+        )
+        parser.add_argument("--cleanup", action="store_true", help="終了後にベンチマーク用のロボットと履歴を削除する")
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options["channel_layer"] == "memory":
+            overrides["CHANNEL_LAYERS"] = {
+                "default": {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 10000}},
+            }
+        # 取り込み性能を測るため受信制限は外す
+        overrides["ROBOT_RATE_LIMITS"] = {"robot": {"rate": 0, "burst": 0}, "owner": {"rate": 0, "burst": 0}}
+        if options["policy"] == "keep_all":
+            overrides["ROBOT_PERSISTENCE_POLICY"] = {"default": {"mode": "keep_all"}}
+
+        owner, _ = User.objects.get_or_create(username=BENCH_OWNER)
+        rows_before = RobotStateHistory.objects.filter(robot__unique_robot_id__startswith=BENCH_ROBOT_PREFIX).count()
+
+        with override_settings(**overrides):
+            stats = asyncio.run(self.run(owner, options))
+
+        rows_written = RobotStateHistory.objects.filter(
+            robot__unique_robot_id__startswith=BENCH_ROBOT_PREFIX
+        ).count() - rows_before
+        self.report(stats, rows_written, options)
+
+        if options["cleanup"]:
+            Robot.objects.filter(unique_robot_id__startswith=BENCH_ROBOT_PREFIX).delete()
+            self.stdout.write("Benchmark robots and history removed.")
+
+    async def run(self, owner, options):
+        stats = {
+            "sent": 0,
+            "processed": 0,
+            "frames": 0,
+            "batch": options["batch"],
+            "connect_latency": [],
+            "receive_latency": [],
+            "e2e_latency": [],
+            "frontend_messages": 0,
+            "frontend_bytes": 0,
+            "flushes": [],
+        }
+        BenchRobotStateConsumer.stats = stats
+        application = URLRouter([
+            path("ws/robots/", BenchRobotStateConsumer.as_asgi()),
+            path("ws/frontend/", FrontendConsumer.as_asgi()),
+        ])
+        robot_ids = [f"{BENCH_ROBOT_PREFIX}{i}" for i in range(options["robots"])]
+
+        async def connect_robot(unique_robot_id):
+            # 全ロボットを同時に接続し、接続完了までの時間を計測する
+            communicator = WebsocketCommunicator(application, f"/ws/robots/?unique_robot_id={unique_robot_id}")
+            connect_started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=30)
+            stats["connect_latency"].append(time.perf_counter() - connect_started)
+            return (unique_robot_id, communicator) if connected else None
+
+        robots = [robot for robot in await asyncio.gather(*map(connect_robot, robot_ids)) if robot]
+
+        frontends = []
+        for i in range(options["frontends"]):
+            if options["subscription"] == "robot":
+                url = f"/ws/frontend/?unique_robot_id={robot_ids[i % len(robot_ids)]}"
+            else:
+                url = "/ws/frontend/"
+            communicator = WebsocketCommunicator(application, url)
+            communicator.scope["user"] = owner
+            connected, _ = await communicator.connect(timeout=30)
+            if connected:
+                frontends.append(communicator)
+
+        broadcaster = asyncio.create_task(SharedTasks.send_to_frontend(get_channel_layer()))
+        deadline = time.monotonic() + options["duration"]
+        started = time.perf_counter()
+
+        def sample():
+            return {
+                "speed": random.random(),
+                "current": random.random(),
+                "pos_x": random.uniform(0, 20),
+                "pos_y": random.uniform(0, 20),
+                "bench_sent": time.time(),
+            }
+
+        async def robot_loop(unique_robot_id, communicator):
+            # --batch 件ごとにまとめて送る（送信レートはサンプル数で維持する）
+            interval = options["batch"] / options["rate"]
+            await asyncio.sleep(random.random() * interval)
+            while time.monotonic() < deadline:
+                if options["batch"] > 1:
+                    message = {
+                        "robot_id": unique_robot_id,
+                        "owner": BENCH_OWNER,
+                        "samples": [
+                            {"state": sample(), "timestamp": time.time() - (options["batch"] - 1 - i) / options["rate"]}
+                            for i in range(options["batch"])
+                        ],
+                    }
+                else:
+                    message = {"robot_id": unique_robot_id, "owner": BENCH_OWNER, "state": sample()}
+                await communicator.send_to(text_data=json.dumps(message))
+                stats["sent"] += options["batch"]
+                await asyncio.sleep(interval)
+
+        async def frontend_loop(communicator):
+            while time.monotonic() < deadline + 1:
+                # receive_output はタイムアウトするとコンシューマーを停止するため、先に空かどうかを確認する
+                if await communicator.receive_nothing(timeout=0.05, interval=0.005):
+                    continue
+                output = await communicator.receive_output()
+                text = output.get("text")
+                if not text:
+                    continue
+                received = time.time()
+                stats["frontend_messages"] += 1
+                stats["frontend_bytes"] += len(text)
+                for data in json.loads(text).get("robots", []):
+                    sent = data.get("state", {}).get("bench_sent")
+                    if sent:
+                        stats["e2e_latency"].append(received - sent)
+
+        async def flush_loop():
+            while time.monotonic() < deadline:
+                await asyncio.sleep(options["flush_interval"])
+                flush_stats = await SharedTasks.flush_robots()
+                if flush_stats:
+                    stats["flushes"].append(flush_stats)
+
+        await asyncio.gather(
+            *[robot_loop(unique_robot_id, communicator) for unique_robot_id, communicator in robots],
+            *[frontend_loop(communicator) for communicator in frontends],
+            flush_loop(),
+        )
+        stats["elapsed"] = time.perf_counter() - started
+
+        # 残りのキャッシュを書き込む
+        flush_stats = await SharedTasks.flush_robots()
+        if flush_stats:
+            stats["flushes"].append(flush_stats)
+
+        broadcaster.cancel()
+        spool = get_spool()
+        if spool:
+            spool.close(remove=True)
+        for _, communicator in robots:
+            await communicator.disconnect()
+        for communicator in frontends:
+            await communicator.disconnect()
+        stats["robots"] = len(robots)
+        stats["frontends"] = len(frontends)
+        return stats
+
+    def report(self, stats, rows_written, options):
+        elapsed = options["duration"] or 1  # ロボットが送信していた時間
+        ms = 1000
+        flush_durations = [flush["duration"] for flush in stats["flushes"]]
+        lines = [
+            f"robots={stats['robots']} frontends={stats['frontends']} rate={options['rate']}/s "
+            f"duration={stats['elapsed']:.1f}s channel_layer={options['channel_layer']} policy={options['policy']}",
+            f"ingest: sent={stats['sent']} processed={stats['processed']} frames={stats['frames']} "
+            f"({stats['processed'] / elapsed:.0f} samples/sec, batch={options['batch']})",
+            f"connect latency ms: p50={percentile(stats['connect_latency'], 50) * ms:.2f} "
+            f"p95={percentile(stats['connect_latency'], 95) * ms:.2f} "
+            f"p99={percentile(stats['connect_latency'], 99) * ms:.2f} "
+            f"max={max(stats['connect_latency'], default=0) * ms:.2f}",
+            f"receive latency ms: p50={percentile(stats['receive_latency'], 50) * ms:.2f} "
+            f"p95={percentile(stats['receive_latency'], 95) * ms:.2f} "
+            f"p99={percentile(stats['receive_latency'], 99) * ms:.2f} "
+            f"max={max(stats['receive_latency'], default=0) * ms:.2f}",
+            f"robot->browser latency ms: p50={percentile(stats['e2e_latency'], 50) * ms:.1f} "
+            f"p95={percentile(stats['e2e_latency'], 95) * ms:.1f} "
+            f"p99={percentile(stats['e2e_latency'], 99) * ms:.1f} "
+            f"(samples={len(stats['e2e_latency'])})",
+            f"frontend: messages={stats['frontend_messages']} bytes={stats['frontend_bytes']} "
+            f"({stats['frontend_bytes'] / elapsed / 1024:.1f} KiB/sec)",
+            f"flush: count={len(flush_durations)} "
+            f"p50={percentile(flush_durations, 50) * ms:.1f}ms max={max(flush_durations, default=0) * ms:.1f}ms",
+            f"db rows written: {rows_written}",
+        ]
+        for line in lines:
+            self.stdout.write(line)
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
+from api.models import Robot
+from api.exports import EXPORT_WRITERS, export_queryset, iter_export, parquet_available
+import sys
+
+
+class Command(BaseCommand):
+    help = "ロボット状態履歴を NDJSON / CSV / Parquet 形式でストリーミング出力します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--robots", help="unique_robot_id のカンマ区切り（省略時は全ロボット）")
+        parser.add_argument("--owner", help="所有者のユーザー名で絞り込む")
+        parser.add_argument("--since", help="開始日時（ISO 8601）")
+        parser.add_argument("--until", help="終了日時（ISO 8601、この時刻を含まない）")
+        parser.add_argument("--format", default="ndjson", choices=list(EXPORT_WRITERS))
+        parser.add_argument("--fields", help="出力する状態のキーのカンマ区切り")
+        parser.add_argument("--output", "-o", help="出力ファイル（省略時は標準出力）")
+
+    def parse_datetime(self, value, name):
+        if not value:
+            return None
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            raise CommandError(f"--{name} must be an ISO 8601 datetime.")
+        return make_aware(timestamp) if is_naive(timestamp) else timestamp
+
+    def handle(self, *args, **options):
+        if options["format"] == "parquet" and not parquet_available():
+            raise CommandError("Parquet export requires pyarrow.")
+
+        robots = Robot.objects.all()
+        if options["robots"]:
+            robots = robots.filter(unique_robot_id__in=options["robots"].split(","))
+        if options["owner"]:
+            robots = robots.filter(owner__username=options["owner"])
+        fields = [field for field in options["fields"].split(",") if field] if options["fields"] else None
+
+        queryset = export_queryset(
+            robots,
+            since=self.parse_datetime(options["since"], "since"),
+            until=self.parse_datetime(options["until"], "until"),
+        )
+        output = open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        try:
+            for chunk in iter_export(queryset, options["format"], fields=fields):
+                output.write(chunk)
+        finally:
+            if options["output"]:
+                output.close()
+            else:
+                output.flush()
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from api.history import build_rollups, expire_history
+
+
+class Command(BaseCommand):
+    help = "ロボット状態履歴のロールアップを更新し、保持期間を過ぎたデータを削除します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--skip-rollups", action="store_true", help="ロールアップの更新を行わない")
+        parser.add_argument("--skip-expire", action="store_true", help="期限切れデータの削除を行わない")
+        parser.add_argument(
+            "--commit-lag", type=int, default=None,
+            help="コミット待ちとみなす秒数（既定は ROBOT_ROLLUP_COMMIT_LAG。書き込みが止まっている場合は 0 を指定できる）",
+        )
+
+    def handle(self, *args, **options):
+        if not options["skip_rollups"]:
+            rolled_up = build_rollups(commit_lag=options["commit_lag"])
+            self.stdout.write(f"Rolled up {rolled_up} history rows.")
+        if not options["skip_expire"]:
+            deleted = expire_history()
+            self.stdout.write(f"Expired: {deleted}")
@@ -0,0 +1,207 @@
+import bisect
+import threading
+import time
+
+# Prometheus のテキスト形式で出力する軽量なメトリクス
+# 値はプロセスごとに保持する（ワーカーごとに /metrics を収集する）
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = list(self.values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, amount=1, *label_values):
+        self.inc(-amount, *label_values)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self.values.items()]
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.label_names, label_values, [('le', le)])} {cumulative}"
+                )
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# 取り込み
+MESSAGES_RECEIVED = Counter("robot_messages_received_total", "State messages received per robot.", ["robot"])
+SAMPLES_RECEIVED = Counter("robot_samples_received_total", "State samples received (a batched frame carries several).")
+SAMPLE_TIMESTAMPS_ADJUSTED = Counter(
+    "robot_sample_timestamps_adjusted_total",
+    "Device timestamps replaced with the receive time (clamped) or outside history retention (dropped).",
+    ["action"],
+)
+RECEIVE_SECONDS = Histogram("robot_receive_seconds", "Time spent in RobotStateConsumer.receive.")
+CONNECTED_ROBOTS = Gauge("robot_connected", "Robot WebSocket connections in this process.")
+PENDING_HANDSHAKES = Gauge("robot_pending_handshakes", "Robot handshakes currently holding an admission slot.")
+ADMISSION_REJECTED = Counter(
+    "robot_admission_rejected_total", "Robot connections closed with a backoff code.", ["reason"]
+)
+MESSAGES_THROTTLED = Counter("robot_messages_throttled_total", "Robot frames dropped by rate limits.", ["scope"])
+LIVENESS_PINGS = Counter("robot_liveness_pings_total", "Pings sent to idle robots.")
+LIVENESS_TIMEOUTS = Counter("robot_liveness_timeouts_total", "Robot connections closed for not answering a ping.")
+SYNC_TO_ASYNC_WAIT_SECONDS = Histogram(
+    "robot_sync_to_async_wait_seconds", "Time a DB call waited before a pool thread picked it up.", ["operation"]
+)
+SYNC_TO_ASYNC_SECONDS = Histogram(
+    "robot_sync_to_async_seconds", "Total time of a DB call made through the DB executor.", ["operation"]
+)
+DB_POOL_PENDING = Gauge("robot_db_pool_pending", "DB calls queued or running per executor pool.", ["pool"])
+
+# バッファ
+HISTORY_CACHE_ROWS = Gauge("robot_history_cache_rows", "State samples waiting to be flushed to the DB.")
+HISTORY_CACHE_ROBOTS = Gauge("robot_history_cache_robots", "Robots with samples waiting to be flushed.")
+FRONTEND_PENDING_ROBOTS = Gauge("robot_frontend_pending_robots", "Robots with updates waiting to be broadcast.")
+SPATIAL_INDEX_ROBOTS = Gauge("robot_spatial_index_robots", "Robots with a live position in this worker's spatial index.")
+
+# 先行書き込みログ
+SPOOL_BYTES_WRITTEN = Counter("robot_spool_bytes_written_total", "Bytes appended to the local state spool.")
+SPOOL_SEGMENTS = Gauge("robot_spool_segments", "Spool segment files not yet discarded.")
+SPOOL_RECOVERED_ROWS = Counter("robot_spool_recovered_rows_total", "Samples replayed from spools left by stopped processes.")
+
+# DB フラッシュ
+FLUSH_ROWS = Histogram(
+    "robot_flush_rows", "History rows written per flush.", buckets=(1, 10, 100, 1000, 10000, 100000)
+)
+FLUSH_SECONDS = Histogram("robot_flush_seconds", "Duration of a history flush.")
+FLUSH_ROWS_WRITTEN = Counter("robot_flush_rows_written_total", "History rows written to the DB.")
+FLUSH_ROWS_DROPPED = Counter("robot_flush_rows_dropped_total", "History rows dropped because the robot no longer exists.")
+FLUSH_ROWS_FAILED = Counter("robot_flush_rows_failed_total", "History rows that failed to write and were queued for retry.")
+FLUSH_ROWS_DEAD_LETTERED = Counter(
+    "robot_flush_rows_dead_lettered_total", "History rows moved to the dead-letter table after repeated write failures."
+)
+
+# フロントエンド配信
+BROADCAST_GROUPS = Histogram(
+    "robot_broadcast_groups", "Groups sent to per broadcast tick.", buckets=(1, 5, 10, 50, 100, 500, 1000, 5000)
+)
+BROADCAST_ROBOTS = Histogram(
+    "robot_broadcast_robots", "Robots with updates per broadcast tick.", buckets=(1, 5, 10, 50, 100, 500, 1000, 5000)
+)
+BROADCAST_SECONDS = Histogram("robot_broadcast_seconds", "Duration of a broadcast tick.")
+BROADCAST_BYTES = Counter("robot_broadcast_bytes_total", "Encoded bytes handed to the channel layer.")
+FLEET_SUMMARIES_SENT = Counter("robot_fleet_summaries_sent_total", "Per-owner fleet summaries broadcast.")
+
+# アラート
+ALERT_RULES = Gauge("robot_alert_rules", "Compiled alert rules loaded by the broadcaster.")
+ALERT_RULE_ERRORS = Counter("robot_alert_rule_errors_total", "Alert rules that failed to compile.")
+ALERT_EVALUATIONS = Counter("robot_alert_evaluations_total", "Rule evaluations against robot states.", ["phase"])
+ALERT_EVALUATION_SECONDS = Histogram(
+    "robot_alert_evaluation_seconds", "Time spent evaluating alert rules per tick.", ["phase"]
+)
+ALERTS = Counter("robot_alerts_total", "Alert events broadcast.", ["status"])
+FRONTEND_CONNECTIONS = Gauge("robot_frontend_connections", "Frontend WebSocket connections in this process.")
+FRONTEND_RESUMES = Counter(
+    "robot_frontend_resumes_total", "Frontend connections by how they were brought up to date.", ["result"]
+)
+FRONTEND_FRAMES_SENT = Counter("robot_frontend_frames_sent_total", "Frames written to frontend sockets.")
+FRONTEND_FRAMES_COALESCED = Counter(
+    "robot_frontend_frames_coalesced_total", "Broadcasts merged into a pending frame because the client was still busy."
+)
+FRONTEND_FRAMES_DROPPED = Counter(
+    "robot_frontend_frames_dropped_total", "Pending frames discarded because the client disconnected or was closed."
+)
+FRONTEND_SEND_SECONDS = Histogram("robot_frontend_send_seconds", "Time to write one frame to a frontend socket.")
+FRONTEND_LAGGING_DISCONNECTS = Counter(
+    "robot_frontend_lagging_disconnects_total", "Frontend clients closed for falling too far behind."
+)
+
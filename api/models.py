@@ -5,7 +5,7 @@ class Robot(models.Model):
     unique_robot_id = models.CharField(max_length=255, unique=True, db_index=True)  # ロボットUUID
     robot_id = models.CharField(max_length=255)  # ユーザー指定ロボットID
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="robots")  # 所有者
-    last_connected = models.DateTimeField(auto_now=True)  # 最終接続時刻
+    last_connected = models.DateTimeField(null=True, blank=True)  # 最終接続時刻（接続セッションの書き込み時に更新）
 
     def __str__(self):
         return f"{self.robot_id} ({self.owner.username})"
@@ -20,3 +20,144 @@ class RobotStateHistory(models.Model):
 
     class Meta:
         ordering = ["-timestamp"]
+        indexes = [
+            # ロボット単位の履歴をキーセットページネーションで読むための複合インデックス
+            models.Index(fields=["robot", "-timestamp", "-id"], name="robot_history_robot_ts_idx"),
+        ]
+
+class RobotStateDeadLetter(models.Model):
+    # 書き込みを繰り返し失敗した履歴の行（再試行を続けると同じロボットの後続の行を妨げるため隔離する）
+    unique_robot_id = models.CharField(max_length=255, db_index=True)  # ロボットUUID
+    timestamp = models.DateTimeField(null=True, blank=True)  # 状態が送信された時刻
+    payload = models.TextField()  # 行の内容（JSON。DB に書き込めなかった値も読めるよう文字列で保存する）
+    error = models.TextField()  # 最後に発生したエラー
+    attempts = models.PositiveIntegerField(default=0)  # 書き込みを試みた回数
+    created_at = models.DateTimeField(auto_now_add=True)  # 隔離した時刻
+
+    def __str__(self):
+        return f"{self.unique_robot_id} at {self.timestamp}"
+
+    class Meta:
+        ordering = ["-created_at"]
+
+class RobotStateRollup(models.Model):
+    RESOLUTION_CHOICES = [("minute", "minute"), ("hour", "hour")]
+
+    robot = models.ForeignKey(Robot, on_delete=models.CASCADE, related_name="state_rollups")  # ロボットとの関連
+    resolution = models.CharField(max_length=16, choices=RESOLUTION_CHOICES)  # 集計単位
+    bucket_start = models.DateTimeField()  # 集計区間の開始時刻
+    count = models.PositiveIntegerField(default=0)  # 集計したサンプル数
+    stats = models.JSONField(default=dict)  # { フィールド名: {"min", "max", "sum", "count", "last", "last_at"} }
+    last_history_id = models.BigIntegerField(default=0)  # 集計済みの RobotStateHistory.id の最大値
+
+    def __str__(self):
+        return f"{self.robot.robot_id} {self.resolution} {self.bucket_start}"
+
+    class Meta:
+        ordering = ["-bucket_start"]
+        constraints = [
+            models.UniqueConstraint(fields=["robot", "resolution", "bucket_start"], name="unique_robot_rollup_bucket"),
+        ]
+        indexes = [
+            models.Index(fields=["resolution", "bucket_start"]),
+        ]
+
+class HistoryCheckpoint(models.Model):
+    # 履歴の保守処理が次回の実行まで持ち越す位置（ロールアップで集計してよい id の上限の候補など）
+    name = models.CharField(max_length=64, unique=True)  # 用途
+    history_id = models.BigIntegerField(default=0)  # 記録した時点の RobotStateHistory.id の最大値
+    recorded_at = models.DateTimeField()  # 記録した時刻
+
+    def __str__(self):
+        return f"{self.name}: {self.history_id} at {self.recorded_at}"
+
+class RobotConnectionSession(models.Model):
+    robot = models.ForeignKey(Robot, on_delete=models.CASCADE, related_name="connection_sessions")  # ロボットとの関連
+    session_key = models.UUIDField(unique=True)  # 接続時にプロセス内で採番する識別子（書き込みをまとめるため）
+    connected_at = models.DateTimeField()  # 接続時刻
+    disconnected_at = models.DateTimeField(null=True, blank=True)  # 切断時刻（接続中は null）
+    last_seen_at = models.DateTimeField()  # 接続中のワーカーが最後に生存を記録した時刻
+    close_code = models.IntegerField(null=True, blank=True)  # WebSocket のクローズコード
+    messages = models.PositiveIntegerField(default=0)  # 接続中に受信したフレーム数
+
+    def __str__(self):
+        return f"{self.robot.robot_id} {self.connected_at} - {self.disconnected_at or 'online'}"
+
+    @property
+    def uptime(self):
+        return ((self.disconnected_at or self.last_seen_at) - self.connected_at).total_seconds()
+
+    class Meta:
+        ordering = ["-connected_at"]
+        indexes = [
+            models.Index(fields=["robot", "-connected_at"], name="robot_session_robot_conn_idx"),
+            # 接続中のセッションの生存確認・期限切れの判定用
+            models.Index(fields=["disconnected_at", "last_seen_at"], name="robot_session_open_idx"),
+        ]
+
+class RobotCurrentState(models.Model):
+    # 最新の保存済み状態（履歴の書き込み時に更新する非正規化テーブル。画面表示で履歴を集計しないため）
+    robot = models.OneToOneField(Robot, on_delete=models.CASCADE, primary_key=True, related_name="current_state")
+    state = models.JSONField()  # 最新の状態データ
+    timestamp = models.DateTimeField()  # 最新の状態が送信された時刻
+    updated_at = models.DateTimeField(auto_now=True)  # 更新時刻
+
+    def __str__(self):
+        return f"{self.robot.robot_id} at {self.timestamp}"
+
+class RobotStateValue(models.Model):
+    # settings.ROBOT_STATE_SCHEMA で指定した状態のキーを型付きで保存するサイドテーブル（JSON を解析せずに検索するため）
+    robot = models.ForeignKey(Robot, on_delete=models.CASCADE, related_name="state_values")  # ロボットとの関連
+    key = models.CharField(max_length=64)  # 状態のキー
+    timestamp = models.DateTimeField()  # 状態が送信された時刻
+    number = models.FloatField(null=True, blank=True)  # 型が number のキーの値
+    text = models.CharField(max_length=255, null=True, blank=True)  # 型が text のキーの値
+
+    def __str__(self):
+        return f"{self.robot.robot_id} {self.key}={self.number if self.number is not None else self.text} at {self.timestamp}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["key", "number", "timestamp"], name="robot_state_value_number_idx"),
+            models.Index(fields=["key", "text", "timestamp"], name="robot_state_value_text_idx"),
+            models.Index(fields=["robot", "key", "-timestamp"], name="robot_state_value_robot_idx"),
+            models.Index(fields=["timestamp"], name="robot_state_value_ts_idx"),  # 保持期間の削除用
+        ]
+
+class RobotHeatmapTile(models.Model):
+    # 位置のヒートマップのタイル（所有者・1時間ごとに、タイル内のセルごとの履歴サンプル数を集計したもの）
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="heatmap_tiles")  # 所有者
+    bucket_start = models.DateTimeField()  # 集計区間（1時間）の開始時刻
+    tile_x = models.IntegerField()  # タイルの列（x / ROBOT_HEATMAP_TILE_SIZE の切り捨て）
+    tile_y = models.IntegerField()  # タイルの行（y / ROBOT_HEATMAP_TILE_SIZE の切り捨て）
+    count = models.PositiveIntegerField(default=0)  # タイル内のサンプル数
+    cells = models.JSONField(default=dict)  # { "セル番号": サンプル数 }（セル番号 = 行 * ROBOT_HEATMAP_TILE_CELLS + 列）
+
+    def __str__(self):
+        return f"{self.owner.username} ({self.tile_x}, {self.tile_y}) {self.bucket_start}"
+
+    class Meta:
+        ordering = ["-bucket_start"]
+        constraints = [
+            models.UniqueConstraint(fields=["owner", "bucket_start", "tile_x", "tile_y"], name="unique_heatmap_tile"),
+        ]
+        indexes = [
+            models.Index(fields=["owner", "tile_x", "tile_y", "bucket_start"], name="heatmap_tile_lookup_idx"),
+            models.Index(fields=["bucket_start"], name="heatmap_tile_bucket_idx"),  # 保持期間の削除用
+        ]
+
+class AlertRule(models.Model):
+    # 状態の条件で通知するアラートのルール（配信タスクが一定間隔で読み込み、評価関数にコンパイルする）
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="alert_rules")  # 所有者（所有者のロボットに適用する）
+    robot = models.ForeignKey(Robot, on_delete=models.CASCADE, null=True, blank=True, related_name="alert_rules")  # 対象ロボット（null は所有者の全ロボット）
+    name = models.CharField(max_length=255)  # 通知に表示する名前
+    condition = models.JSONField()  # 条件（書式は api.alerts を参照）
+    cooldown = models.PositiveIntegerField(default=60)  # 同じロボットで再び通知するまでの最短秒数
+    enabled = models.BooleanField(default=True)  # 無効にしたルールは評価しない
+    updated_at = models.DateTimeField(auto_now=True)  # 更新時刻（変更されたルールだけコンパイルし直すため）
+
+    def __str__(self):
+        return f"{self.name} ({self.owner.username})"
+
+    class Meta:
+        ordering = ["id"]
@@ -0,0 +1,129 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# settings.ROBOT_PERSISTENCE_POLICY の例:
+# {
+#     "default": {"mode": "interval", "interval": 5},
+#     "owners": {"alice": {"mode": "on_change", "max_interval": 60}},
+#     "robots": {"<unique_robot_id>": {"mode": "deadband", "fields": {"pos_x": 0.1, "pos_y": 0.1}}},
+# }
+DEFAULT_POLICY = {"mode": "interval", "interval": 5}
+
+
+class PersistencePolicy:
+    # 受信した状態を RobotStateHistory に保存するかどうかを判定する
+    # min_interval: これより短い間隔では保存しない / max_interval: 変化がなくてもこの間隔で保存する
+
+    def __init__(self, min_interval=0, max_interval=None, **options):
+        if options:
+            raise ImproperlyConfigured(f"Unknown persistence policy options: {', '.join(options)}")
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval) if max_interval is not None else None
+
+    def should_persist(self, previous, state, timestamp):
+        # previous: 最後に保存したサンプル {"state", "timestamp"}（未保存なら None）
+        if previous is None:
+            return True
+        elapsed = (timestamp - previous["timestamp"]).total_seconds()
+        if elapsed < self.min_interval:
+            return False
+        if self.max_interval is not None and elapsed >= self.max_interval:
+            return True
+        return self.changed(previous["state"], state, elapsed)
+
+    def changed(self, previous_state, state, elapsed):
+        raise NotImplementedError
+
+
+class KeepAllPolicy(PersistencePolicy):
+    def changed(self, previous_state, state, elapsed):
+        return True
+
+
+class IntervalPolicy(PersistencePolicy):
+    def __init__(self, interval=5, **options):
+        super().__init__(**options)
+        self.interval = float(interval)
+
+    def changed(self, previous_state, state, elapsed):
+        return elapsed >= self.interval
+
+
+class OnChangePolicy(PersistencePolicy):
+    # 状態が変化したときだけ保存する（ignore のキーは比較しない）
+    def __init__(self, ignore=(), **options):
+        super().__init__(**options)
+        self.ignore = frozenset(ignore)
+
+    def changed(self, previous_state, state, elapsed):
+        if not isinstance(state, dict) or not isinstance(previous_state, dict):
+            return state != previous_state
+        if not self.ignore:
+            return state != previous_state
+        keys = (previous_state.keys() | state.keys()) - self.ignore
+        return any(previous_state.get(key) != state.get(key) for key in keys)
+
+
+class DeadbandPolicy(OnChangePolicy):
+    # fields の数値が閾値以上変化したときだけ保存する
+    # fields 以外のキーは値が変化したときに保存する（ignore で除外可能）
+    def __init__(self, fields=None, **options):
+        super().__init__(**options)
+        self.fields = {key: float(threshold) for key, threshold in (fields or {}).items()}
+        self.ignore = self.ignore | frozenset(self.fields)
+
+    def changed(self, previous_state, state, elapsed):
+        if not isinstance(state, dict) or not isinstance(previous_state, dict):
+            return state != previous_state
+        for key, threshold in self.fields.items():
+            old, new = previous_state.get(key), state.get(key)
+            try:
+                if abs(float(new) - float(old)) >= threshold:
+                    return True
+            except (TypeError, ValueError):
+                if old != new:
+                    return True
+        return super().changed(previous_state, state, elapsed)
+
+
+POLICY_MODES = {
+    "keep_all": KeepAllPolicy,
+    "interval": IntervalPolicy,
+    "on_change": OnChangePolicy,
+    "deadband": DeadbandPolicy,
+}
+
+_policy_cache = {}  # { 設定のJSON: PersistencePolicy }
+
+
+def build_policy(config):
+    config = dict(config)
+    mode = config.pop("mode", "interval")
+    if mode not in POLICY_MODES:
+        raise ImproperlyConfigured(f"Unknown persistence policy mode: {mode}")
+    return POLICY_MODES[mode](**config)
+
+
+def get_policy(unique_robot_id, owner=None):
+    # ロボット単位 > 所有者単位 > 既定 の順に設定を探す
+    config = getattr(settings, "ROBOT_PERSISTENCE_POLICY", {})
+    policy_config = (
+        config.get("robots", {}).get(unique_robot_id)
+        or (owner and config.get("owners", {}).get(owner))
+        or config.get("default")
+        or DEFAULT_POLICY
+    )
+    cache_key = json.dumps(policy_config, sort_keys=True)
+    policy = _policy_cache.get(cache_key)
+    if policy is None:
+        try:
+            policy = build_policy(policy_config)
+        except (ImproperlyConfigured, TypeError, ValueError) as e:
+            logger.error(f"Invalid persistence policy for robot {unique_robot_id}: {e}. Using default.")
+            policy = build_policy(DEFAULT_POLICY)
+        _policy_cache[cache_key] = policy
+    return policy
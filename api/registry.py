@@ -0,0 +1,58 @@
+from django.conf import settings
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ロボット識別情報のプロセス内キャッシュ（最近使った順）
+# { unique_robot_id: {"id", "unique_robot_id", "robot_id", "owner", "resolved", "expires_at"} }
+# REST API での更新・削除は処理したワーカーでしか無効化できないため、他のワーカーでも
+# ROBOT_REGISTRY_TTL 秒後には DB から読み直す。件数は ROBOT_REGISTRY_MAX_SIZE までにし、古いものから捨てる
+# 登録は DB プールのスレッド、参照はイベントループとビューのスレッドから呼ばれるためロックを取る
+robot_registry = OrderedDict()
+_lock = threading.Lock()
+
+UNKNOWN = "unknown"
+
+
+def register_robot(robot):
+    # Robot インスタンス（owner をロード済み）から識別情報を登録する
+    owner = robot.owner.username
+    entry = {
+        "id": robot.id,
+        "unique_robot_id": robot.unique_robot_id,
+        "robot_id": robot.robot_id,
+        "owner": owner,
+        # robot_id と owner が確定していれば、以降 DB を更新する必要はない
+        "resolved": robot.robot_id != UNKNOWN and owner != UNKNOWN,
+        "expires_at": time.monotonic() + settings.ROBOT_REGISTRY_TTL,
+    }
+    with _lock:
+        robot_registry[robot.unique_robot_id] = entry
+        robot_registry.move_to_end(robot.unique_robot_id)
+        while len(robot_registry) > settings.ROBOT_REGISTRY_MAX_SIZE:
+            robot_registry.popitem(last=False)
+    return entry
+
+
+def get_robot(unique_robot_id):
+    # 期限切れの場合は None（呼び出し側で DB から読み直して登録する）
+    with _lock:
+        entry = robot_registry.get(unique_robot_id)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= time.monotonic():
+            del robot_registry[unique_robot_id]
+            return None
+        robot_registry.move_to_end(unique_robot_id)
+        return entry
+
+
+def invalidate_robot(unique_robot_id):
+    # REST API などで Robot が更新・削除されたときに呼ぶ
+    with _lock:
+        entry = robot_registry.pop(unique_robot_id, None)
+    if entry is not None:
+        logger.debug(f"Robot registry entry invalidated: {unique_robot_id}")
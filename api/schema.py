@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .models import RobotStateValue
+import logging
+
+logger = logging.getLogger(__name__)
+
+# settings.ROBOT_STATE_SCHEMA の例:
+# {"battery": "number", "pos_x": "number", "pos_y": "number", "status": "text"}
+STATE_FIELD_TYPES = ("number", "text")
+TEXT_MAX_LENGTH = 255
+
+_schema_cache = None
+
+
+def get_state_schema():
+    # { キー: 型 }（設定ごとに1度だけ検証する）
+    global _schema_cache
+    config = getattr(settings, "ROBOT_STATE_SCHEMA", {}) or {}
+    if _schema_cache is not None and _schema_cache[0] is config:
+        return _schema_cache[1]
+    schema = {}
+    for key, field_type in config.items():
+        if field_type not in STATE_FIELD_TYPES:
+            raise ImproperlyConfigured(f"ROBOT_STATE_SCHEMA: unknown type '{field_type}' for '{key}'.")
+        if len(key) > 64:
+            raise ImproperlyConfigured(f"ROBOT_STATE_SCHEMA: key '{key}' is longer than 64 characters.")
+        schema[key] = field_type
+    _schema_cache = (config, schema)
+    return schema
+
+
+def typed_value(value, field_type):
+    # 型に合わない値は保存しない（None を返す）
+    if field_type == "number":
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        return None
+    if isinstance(value, (dict, list)) or value is None:
+        return None
+    return str(value)[:TEXT_MAX_LENGTH]
+
+
+def extract_state_values(robot_pk, state, timestamp, schema):
+    if not schema or not isinstance(state, dict):
+        return []
+    values = []
+    for key, field_type in schema.items():
+        if key not in state:
+            continue
+        value = typed_value(state[key], field_type)
+        if value is None:
+            continue
+        values.append(RobotStateValue(robot_id=robot_pk, key=key, timestamp=timestamp, **{field_type: value}))
+    return values
+
+
+def describe_states(states):
+    # 状態のサンプルから {キー: [型, ...]} を抽出する（スキーマ設定の参考用）
+    types = {}
+    for state in states:
+        if not isinstance(state, dict):
+            continue
+        for key, value in state.items():
+            if isinstance(value, bool):
+                name = "boolean"
+            elif isinstance(value, (int, float)):
+                name = "number"
+            elif isinstance(value, str):
+                name = "text"
+            elif isinstance(value, dict):
+                name = "object"
+            elif isinstance(value, list):
+                name = "array"
+            else:
+                name = "null"
+            types.setdefault(key, set()).add(name)
+    return {key: sorted(names) for key, names in sorted(types.items())}
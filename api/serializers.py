@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import Robot, RobotStateHistory
+from .models import Robot, RobotStateHistory, RobotStateRollup, RobotConnectionSession, RobotStateValue, AlertRule
+from .alerts import compile_condition
 
 # RobotSerializer
 class RobotSerializer(serializers.ModelSerializer):
@@ -8,12 +9,12 @@ class RobotSerializer(serializers.ModelSerializer):
     class Meta:
         model = Robot
         fields = ['unique_robot_id', 'robot_id', 'owner', 'last_connected']
+        read_only_fields = ['last_connected']  # 接続セッションの書き込み時にだけ更新する
 
     def validate(self, data):
+        # owner は読み取り専用で、ビューがログインユーザーを設定する
         if not data.get('robot_id'):
             raise serializers.ValidationError("robot_id は必須です。")
-        if not data.get('owner'):
-            raise serializers.ValidationError("owner は必須です。")
         return data
 
 # RobotStateHistorySerializer
@@ -23,3 +24,64 @@ class RobotStateHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = RobotStateHistory
         fields = ['robot', 'state', 'timestamp']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # ?fields= で指定された状態のキーだけを返す
+        state_fields = self.context.get("state_fields")
+        if state_fields and isinstance(data["state"], dict):
+            data["state"] = {key: data["state"][key] for key in state_fields if key in data["state"]}
+        return data
+
+# RobotStateRollupSerializer
+class RobotStateRollupSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = RobotStateRollup
+        fields = ['resolution', 'bucket_start', 'count', 'stats']
+
+# RobotConnectionSessionSerializer
+class RobotConnectionSessionSerializer(serializers.ModelSerializer):
+    uptime = serializers.FloatField(read_only=True)  # 接続時間（秒）。接続中は最後の生存記録まで
+
+    class Meta:
+        model = RobotConnectionSession
+        fields = ['connected_at', 'disconnected_at', 'last_seen_at', 'uptime', 'close_code', 'messages']
+
+# RobotStateValueSerializer
+class RobotStateValueSerializer(serializers.ModelSerializer):
+    value = serializers.SerializerMethodField()
+
+    class Meta:
+        model = RobotStateValue
+        fields = ['key', 'timestamp', 'value']
+
+    def get_value(self, instance):
+        return instance.number if instance.number is not None else instance.text
+
+# AlertRuleSerializer
+class AlertRuleSerializer(serializers.ModelSerializer):
+    # robot は unique_robot_id で指定する（自分のロボットだけ）
+    robot = serializers.SlugRelatedField(
+        slug_field='unique_robot_id', queryset=Robot.objects.all(), required=False, allow_null=True
+    )
+
+    class Meta:
+        model = AlertRule
+        fields = ['id', 'name', 'robot', 'condition', 'cooldown', 'enabled', 'updated_at']
+        read_only_fields = ['updated_at']
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is not None:
+            fields['robot'].queryset = Robot.objects.filter(owner=request.user)
+        return fields
+
+    def validate_condition(self, value):
+        # 保存前にコンパイルして書式を確認する
+        try:
+            compile_condition(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.timezone import now
+from datetime import timedelta
+from .models import Robot, RobotConnectionSession
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+SESSION_UPDATE_CHUNK_SIZE = 500  # IN 句に渡す session_key の最大数
+
+
+class SessionRecorder:
+    # ロボットの接続・切断をプロセス内に溜め、flush でまとめて DB に書き込む
+    # 受信ごとの DB アクセスは行わない
+
+    def __init__(self):
+        self.opened = {}  # { session_key: {"robot", "connected_at"} }
+        self.closed = {}  # { session_key: {"disconnected_at", "close_code", "messages"} }
+        self.active = set()  # 接続中の session_key（flush ごとに last_seen_at を更新する）
+
+    def open(self, robot_pk, connected_at):
+        session_key = uuid.uuid4()
+        self.opened[session_key] = {"robot": robot_pk, "connected_at": connected_at}
+        self.active.add(session_key)
+        return session_key
+
+    def close(self, session_key, close_code, messages):
+        self.active.discard(session_key)
+        self.closed[session_key] = {"disconnected_at": now(), "close_code": close_code, "messages": messages}
+
+    def has_pending(self):
+        return bool(self.opened or self.closed or self.active)
+
+    def take(self):
+        snapshot = {"opened": self.opened, "closed": self.closed, "active": list(self.active)}
+        self.opened, self.closed = {}, {}
+        return snapshot
+
+    def restore(self, snapshot):
+        # 書き込みに失敗したイベントを戻す（次の flush で再試行する）
+        self.opened = {**snapshot["opened"], **self.opened}
+        self.closed = {**snapshot["closed"], **self.closed}
+
+
+session_recorder = SessionRecorder()
+
+
+def write_sessions(snapshot, current_time=None):
+    current_time = current_time or now()
+    opened, closed = snapshot["opened"], dict(snapshot["closed"])
+    stats = {"opened": 0, "closed": 0, "expired": 0}
+
+    with transaction.atomic():
+        # 削除済みのロボットのセッションは記録しない
+        existing = set(
+            Robot.objects.filter(id__in={session["robot"] for session in opened.values()}).values_list("id", flat=True)
+        )
+        rows = []
+        last_connected = {}
+        for session_key, session in opened.items():
+            end = closed.pop(session_key, {})
+            if session["robot"] not in existing:
+                continue
+            rows.append(RobotConnectionSession(
+                robot_id=session["robot"],
+                session_key=session_key,
+                connected_at=session["connected_at"],
+                last_seen_at=end.get("disconnected_at", current_time),
+                **end,
+            ))
+            last_connected[session["robot"]] = max(
+                last_connected.get(session["robot"], session["connected_at"]), session["connected_at"]
+            )
+        RobotConnectionSession.objects.bulk_create(rows, batch_size=settings.ROBOT_FLUSH_BATCH_SIZE)
+        Robot.objects.bulk_update(
+            [Robot(id=robot_pk, last_connected=connected_at) for robot_pk, connected_at in last_connected.items()],
+            ["last_connected"],
+            batch_size=settings.ROBOT_FLUSH_BATCH_SIZE,
+        )
+        stats["opened"] = len(rows)
+
+        # 以前の flush で作成済みのセッションを閉じる
+        if closed:
+            sessions = list(RobotConnectionSession.objects.filter(session_key__in=list(closed)))
+            for session in sessions:
+                for field, value in closed[session.session_key].items():
+                    setattr(session, field, value)
+                session.last_seen_at = session.disconnected_at
+            RobotConnectionSession.objects.bulk_update(
+                sessions, ["disconnected_at", "close_code", "messages", "last_seen_at"],
+                batch_size=settings.ROBOT_FLUSH_BATCH_SIZE,
+            )
+            stats["closed"] = len(sessions)
+
+        # 接続中のセッションの生存を記録する
+        active = snapshot["active"]
+        for start in range(0, len(active), SESSION_UPDATE_CHUNK_SIZE):
+            RobotConnectionSession.objects.filter(
+                session_key__in=active[start:start + SESSION_UPDATE_CHUNK_SIZE], disconnected_at__isnull=True
+            ).update(last_seen_at=current_time)
+
+        # 生存記録が途絶えたセッション（ワーカーの異常終了など）は最後の記録時刻で閉じる
+        stats["expired"] = RobotConnectionSession.objects.filter(
+            disconnected_at__isnull=True,
+            last_seen_at__lt=current_time - timedelta(seconds=settings.ROBOT_SESSION_STALE_SECONDS),
+        ).update(disconnected_at=F("last_seen_at"))
+
+    if stats["expired"]:
+        logger.warning(f"Closed {stats['expired']} stale connection sessions.")
+    return stats
+
+
+def online_cutoff(current_time=None):
+    # この時刻以降に生存が記録された未切断のセッションを接続中とみなす
+    return (current_time or now()) - timedelta(seconds=settings.ROBOT_SESSION_STALE_SECONDS)
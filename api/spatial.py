@@ -0,0 +1,235 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .models import Robot, RobotHeatmapTile
+import math
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_position_fields():
+    # 位置として扱う状態のキー (x, y)。設定が空の場合は None
+    fields = settings.ROBOT_POSITION_FIELDS
+    if not fields:
+        return None
+    if len(fields) != 2:
+        raise ImproperlyConfigured("ROBOT_POSITION_FIELDS must name exactly two keys (x, y).")
+    return tuple(fields)
+
+
+def extract_position(state, fields):
+    # 状態から (x, y) を取り出す。数値でない・有限でない場合は None
+    if fields is None or not isinstance(state, dict):
+        return None
+    position = []
+    for field in fields:
+        value = state.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return None
+        position.append(float(value))
+    return tuple(position)
+
+
+class SpatialGrid:
+    # 接続中のロボットの現在位置の索引（一様グリッド）
+    # セルごとにロボットの集合を持ち、範囲・近傍の検索では範囲に重なるセルだけを調べる
+    # 受信のたびに更新するので、セルが変わらない移動は位置の書き換えだけで済ませる
+    # 更新はイベントループ、検索は同期ビューのスレッドから呼ばれるため、どちらもロックを取る
+    # （検索はロック内で候補を書き出すだけにし、距離の計算や並べ替えはロックの外で行う）
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # { (列, 行): {unique_robot_id, ...} }
+        self.positions = {}  # { unique_robot_id: (x, y, セル, owner) }
+        self.lock = threading.Lock()
+
+    def _cell(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def _discard(self, unique_robot_id, cell):
+        members = self.cells[cell]
+        members.discard(unique_robot_id)
+        if not members:
+            del self.cells[cell]
+
+    def update(self, unique_robot_id, owner, x, y):
+        cell = self._cell(x, y)
+        with self.lock:
+            previous = self.positions.get(unique_robot_id)
+            if previous is None or previous[2] != cell:
+                if previous is not None:
+                    self._discard(unique_robot_id, previous[2])
+                self.cells.setdefault(cell, set()).add(unique_robot_id)
+            self.positions[unique_robot_id] = (x, y, cell, owner)
+
+    def remove(self, unique_robot_id):
+        with self.lock:
+            previous = self.positions.pop(unique_robot_id, None)
+            if previous is not None:
+                self._discard(unique_robot_id, previous[2])
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _candidates(self, x0, y0, x1, y1):
+        # 範囲に重なるセルのロボットの位置 [(unique_robot_id, (x, y, セル, owner)), ...]（ロック内で呼ぶ）
+        # 範囲内のセル数が使用中のセル数より多い場合は使用中のセルを走査する
+        min_cell, max_cell = self._cell(x0, y0), self._cell(x1, y1)
+        span = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+        if span > len(self.cells):
+            cells = [
+                members for (column, row), members in self.cells.items()
+                if min_cell[0] <= column <= max_cell[0] and min_cell[1] <= row <= max_cell[1]
+            ]
+        else:
+            cells = [
+                self.cells[(column, row)]
+                for column in range(min_cell[0], max_cell[0] + 1)
+                for row in range(min_cell[1], max_cell[1] + 1)
+                if (column, row) in self.cells
+            ]
+        return [(unique_robot_id, self.positions[unique_robot_id]) for members in cells for unique_robot_id in members]
+
+    def within(self, x0, y0, x1, y1, owner=None):
+        # 矩形内のロボット [(unique_robot_id, x, y), ...]
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        with self.lock:
+            candidates = self._candidates(x0, y0, x1, y1)
+        robots = []
+        for unique_robot_id, (x, y, _, robot_owner) in candidates:
+            if (owner is None or robot_owner == owner) and x0 <= x <= x1 and y0 <= y <= y1:
+                robots.append((unique_robot_id, x, y))
+        return robots
+
+    def nearby(self, x, y, radius, owner=None, limit=None):
+        # 点から radius 以内のロボットを近い順に [(unique_robot_id, x, y, 距離), ...]
+        robots = []
+        for unique_robot_id, robot_x, robot_y in self.within(x - radius, y - radius, x + radius, y + radius, owner):
+            distance = math.hypot(robot_x - x, robot_y - y)
+            if distance <= radius:
+                robots.append((unique_robot_id, robot_x, robot_y, distance))
+        robots.sort(key=lambda robot: robot[3])
+        return robots[:limit] if limit else robots
+
+
+_spatial_index = None
+
+
+def get_spatial_index():
+    # プロセス内の索引（このワーカーに接続しているロボットだけを持つ）
+    # 複数ワーカー構成では他のワーカーに接続しているロボットは検索結果に含まれない
+    global _spatial_index
+    if _spatial_index is None:
+        _spatial_index = SpatialGrid(settings.ROBOT_SPATIAL_CELL_SIZE)
+    return _spatial_index
+
+
+# 位置のヒートマップ
+# 地図を ROBOT_HEATMAP_TILE_SIZE 四方のタイルに区切り、タイルを ROBOT_HEATMAP_TILE_CELLS 四方のセルに分けて
+# 所有者・1時間ごとにセル内の履歴サンプル数を数える（履歴のロールアップと同じ処理で加算する）
+# セル番号 = 行 * ROBOT_HEATMAP_TILE_CELLS + 列（件数が 0 のセルは持たない）
+
+def heatmap_cell(x, y):
+    # (タイルの列, タイルの行, セル番号)
+    tile_size, cells = settings.ROBOT_HEATMAP_TILE_SIZE, settings.ROBOT_HEATMAP_TILE_CELLS
+    tile_x, tile_y = math.floor(x / tile_size), math.floor(y / tile_size)
+    column = min(int((x / tile_size - tile_x) * cells), cells - 1)
+    row = min(int((y / tile_size - tile_y) * cells), cells - 1)
+    return tile_x, tile_y, row * cells + column
+
+
+def accumulate_heatmap(rows):
+    # rows: [(history_id, robot_id, state, timestamp), ...]
+    # { (owner_id, 1時間の区間, タイルの列, タイルの行): {"count", "cells": {セル番号: 件数}} }
+    fields = get_position_fields()
+    if fields is None:
+        return {}
+    positions = []
+    for _, robot_id, state, timestamp in rows:
+        position = extract_position(state, fields)
+        if position is not None:
+            positions.append((robot_id, timestamp, position))
+    if not positions:
+        return {}
+
+    owners = dict(Robot.objects.filter(id__in={robot_id for robot_id, _, _ in positions}).values_list("id", "owner_id"))
+    tiles = {}
+    for robot_id, timestamp, (x, y) in positions:
+        owner_id = owners.get(robot_id)
+        if owner_id is None:
+            continue
+        tile_x, tile_y, cell = heatmap_cell(x, y)
+        tile = tiles.setdefault(
+            (owner_id, timestamp.replace(minute=0, second=0, microsecond=0), tile_x, tile_y),
+            {"count": 0, "cells": {}},
+        )
+        tile["count"] += 1
+        tile["cells"][cell] = tile["cells"].get(cell, 0) + 1
+    return tiles
+
+
+def save_heatmap_tiles(tiles):
+    # accumulate_heatmap の結果を既存のタイルに加算する（呼び出し側のトランザクション内で呼ぶ）
+    if not tiles:
+        return
+    existing = {
+        (tile.owner_id, tile.bucket_start, tile.tile_x, tile.tile_y): tile
+        for tile in RobotHeatmapTile.objects.select_for_update().filter(
+            owner_id__in={key[0] for key in tiles},
+            bucket_start__in={key[1] for key in tiles},
+            tile_x__in={key[2] for key in tiles},
+            tile_y__in={key[3] for key in tiles},
+        )
+    }
+    created, updated = [], []
+    for key, accumulated in tiles.items():
+        cells = {str(cell): count for cell, count in accumulated["cells"].items()}
+        tile = existing.get(key)
+        if tile is None:
+            created.append(RobotHeatmapTile(
+                owner_id=key[0], bucket_start=key[1], tile_x=key[2], tile_y=key[3],
+                count=accumulated["count"], cells=cells,
+            ))
+            continue
+        tile.count += accumulated["count"]
+        for cell, count in cells.items():
+            tile.cells[cell] = tile.cells.get(cell, 0) + count
+        updated.append(tile)
+    RobotHeatmapTile.objects.bulk_create(created)
+    RobotHeatmapTile.objects.bulk_update(updated, ["count", "cells"])
+
+
+def query_heatmap(owner, since=None, until=None, bounds=None, zoom=0):
+    # 期間内のタイルを足し合わせて返す
+    # bounds: (x0, y0, x1, y1) に重なるタイルだけ, zoom: セルを 2**zoom 四方ずつまとめる（縮小表示用）
+    tile_size, cells = settings.ROBOT_HEATMAP_TILE_SIZE, settings.ROBOT_HEATMAP_TILE_CELLS
+    factor = 2 ** zoom
+    merged_cells = max(cells // factor, 1)
+
+    queryset = RobotHeatmapTile.objects.filter(owner=owner)
+    if since:
+        queryset = queryset.filter(bucket_start__gte=since.replace(minute=0, second=0, microsecond=0))
+    if until:
+        queryset = queryset.filter(bucket_start__lt=until)
+    if bounds:
+        x0, y0, x1, y1 = bounds
+        queryset = queryset.filter(
+            tile_x__gte=math.floor(min(x0, x1) / tile_size), tile_x__lte=math.floor(max(x0, x1) / tile_size),
+            tile_y__gte=math.floor(min(y0, y1) / tile_size), tile_y__lte=math.floor(max(y0, y1) / tile_size),
+        )
+
+    tiles = {}
+    for tile_x, tile_y, count, tile_cells in queryset.values_list("tile_x", "tile_y", "count", "cells").iterator():
+        tile = tiles.setdefault((tile_x, tile_y), {"tile_x": tile_x, "tile_y": tile_y, "count": 0, "cells": {}})
+        tile["count"] += count
+        for cell, cell_count in tile_cells.items():
+            row, column = divmod(int(cell), cells)
+            cell = min(row // factor, merged_cells - 1) * merged_cells + min(column // factor, merged_cells - 1)
+            tile["cells"][cell] = tile["cells"].get(cell, 0) + cell_count
+    return {
+        "tile_size": tile_size,
+        "cells": merged_cells,
+        "tiles": [tiles[key] for key in sorted(tiles)],
+    }
@@ -0,0 +1,210 @@
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from .models import RobotStateHistory
+from .history import resolve_robot_ids
+from .buffers import get_state_buffer
+from . import metrics
+import fcntl
+import json
+import os
+import shutil
+import socket
+import uuid
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+LOCK_NAME = ".lock"
+
+
+def encode_record(unique_robot_id, samples):
+    # 1行 = "<JSON の CRC32 (16進8桁)> <JSON>\n"（書き込み途中で落ちた行は CRC で見分ける）
+    payload = json.dumps({
+        "u": unique_robot_id,
+        "s": [dict(sample, timestamp=sample["timestamp"].isoformat()) for sample in samples],
+    }, separators=(",", ":")).encode("utf-8")
+    return b"%08x " % zlib.crc32(payload) + payload + b"\n"
+
+
+def decode_record(line):
+    # 壊れた行は None
+    if len(line) < 10 or not line.endswith(b"\n") or line[8:9] != b" ":
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload):
+            return None
+        record = json.loads(payload)
+    except ValueError:
+        return None
+    samples = []
+    for sample in record["s"]:
+        sample["timestamp"] = parse_datetime(sample["timestamp"])
+        samples.append(sample)
+    return record["u"], samples
+
+
+def read_segments(directory):
+    # ディレクトリ内のセグメントを番号順に読み、{ unique_robot_id: [sample, ...] } にまとめる
+    snapshot = {}
+    corrupted = 0
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+            continue
+        with open(os.path.join(directory, name), "rb") as segment:
+            for line in segment:
+                record = decode_record(line)
+                if record is None:
+                    corrupted += 1
+                    continue
+                snapshot.setdefault(record[0], []).extend(record[1])
+    if corrupted:
+        logger.warning(f"Skipped {corrupted} corrupted spool records in {directory}")
+    return snapshot
+
+
+def drop_persisted(snapshot):
+    # フラッシュ後・セグメント削除前に停止した場合の重複を除く（同じロボット・同じ時刻の行は書き込み済み）
+    robot_ids = resolve_robot_ids(snapshot)
+    for unique_robot_id, samples in snapshot.items():
+        robot_pk = robot_ids.get(unique_robot_id)
+        if robot_pk is None or not samples:
+            continue
+        timestamps = [sample["timestamp"] for sample in samples]
+        persisted = set(RobotStateHistory.objects.filter(
+            robot_id=robot_pk, timestamp__gte=min(timestamps), timestamp__lte=max(timestamps)
+        ).values_list("timestamp", flat=True))
+        snapshot[unique_robot_id] = [sample for sample in samples if sample["timestamp"] not in persisted]
+    return {unique_robot_id: samples for unique_robot_id, samples in snapshot.items() if samples}
+
+
+def load_spooled(directories):
+    # 停止したプロセスのディレクトリを読み、まだ書き込まれていないサンプルを返す
+    snapshot = {}
+    for directory in directories:
+        for unique_robot_id, samples in read_segments(directory).items():
+            snapshot.setdefault(unique_robot_id, []).extend(samples)
+    return drop_persisted(snapshot)
+
+
+def sync_and_close(handle):
+    # StateSpool.sync_handle / rotate が返したファイル記述子をディスクへ同期して閉じる（スレッドで呼ぶ）
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+class StateSpool:
+    # 履歴キャッシュに入れるサンプルを先に追記するローカルの先行書き込みログ
+    # プロセスごとに <ROBOT_SPOOL_DIR>/<ホスト名>-<pid>-<乱数>/ を作り、ロックファイルを保持する
+    # 全件フラッシュの直前にセグメントを切り替え、書き込みが終わったら切り替え前のセグメントを削除する
+    # 正常終了しなかったプロセスのディレクトリ（ロックを取れるもの）は起動時に読み戻す
+
+    def __init__(self, root):
+        self.root = root
+        self.directory = os.path.join(root, f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        self.lock_file = None
+        self.segment = None
+        self.segment_number = 0
+        self.dirty = False
+
+    def open(self):
+        # ロックを取ってから名前を付け替え、他のプロセスにロック前のディレクトリを回収されないようにする
+        os.makedirs(self.root, exist_ok=True)
+        staging = os.path.join(self.root, "." + os.path.basename(self.directory))
+        os.makedirs(staging)
+        self.lock_file = open(os.path.join(staging, LOCK_NAME), "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(staging, self.directory)
+        self._open_segment()
+        logger.info(f"State spool opened at {self.directory}")
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{number:012d}{SEGMENT_SUFFIX}")
+
+    def _open_segment(self):
+        self.segment_number += 1
+        # バッファなしで開き、追記ごとに OS へ渡す（プロセスが落ちても失われない）
+        self.segment = open(self._segment_path(self.segment_number), "ab", buffering=0)
+        metrics.SPOOL_SEGMENTS.inc()
+
+    def append(self, unique_robot_id, samples):
+        # 受信処理から呼ばれる。fsync はせず write を1回だけ行う（ページキャッシュへのコピーのみ）
+        data = encode_record(unique_robot_id, samples)
+        self.segment.write(data)
+        self.dirty = True
+        metrics.SPOOL_BYTES_WRITTEN.inc(len(data))
+
+    def sync_handle(self):
+        # 現在のセグメントの fsync 用に複製したファイル記述子を返す（同期中に切り替えられても閉じられない）
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return os.dup(self.segment.fileno())
+
+    def rotate(self):
+        # 以降の追記を新しいセグメントに書き、(切り替え前のセグメント番号, その fsync 用のファイル記述子) を返す
+        # fsync はイベントループを止めないよう、呼び出し側がスレッドで sync_and_close に渡す
+        handle = os.dup(self.segment.fileno())
+        self.segment.close()
+        self.dirty = False
+        sealed = self.segment_number
+        self._open_segment()
+        return sealed, handle
+
+    def discard(self, sealed):
+        # sealed 以前のセグメントを削除する（書き込み済みになったもの）
+        for number in range(1, sealed + 1):
+            try:
+                os.remove(self._segment_path(number))
+                metrics.SPOOL_SEGMENTS.dec()
+            except FileNotFoundError:
+                pass
+
+    def close(self, remove=False):
+        # remove: 全て書き込み済みなのでディレクトリごと削除する（削除するセグメントは fsync しない）
+        # fsync するのは次の起動時に読み戻すために残す場合だけ（終了時にスレッドで呼ぶ）
+        if self.segment is not None:
+            if not remove:
+                os.fsync(self.segment.fileno())
+            self.segment.close()
+            self.segment = None
+        if remove:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            metrics.SPOOL_SEGMENTS.set(0)
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def orphaned_directories(self):
+        # 他のプロセスが残したディレクトリのうち、ロックを取れたもの（持ち主が停止している）
+        orphans = []
+        for name in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, name)
+            if name.startswith(".") or directory == self.directory or not os.path.isdir(directory):
+                continue
+            lock_file = open(os.path.join(directory, LOCK_NAME), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            orphans.append((directory, lock_file))
+        return orphans
+
+
+_spool = None
+
+
+def get_spool():
+    # settings.ROBOT_SPOOL_DIR が空の場合と、状態バッファが永続的な場合（Redis）は None（先行書き込みログを使わない）
+    # 永続的なバッファに残っている行をログから読み戻すと二重に書き込むため
+    global _spool
+    if _spool is None and settings.ROBOT_SPOOL_DIR and not get_state_buffer().durable:
+        _spool = StateSpool(settings.ROBOT_SPOOL_DIR)
+        _spool.open()
+    return _spool
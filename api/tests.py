@@ -1,3 +1,1805 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipUnless
+from . import consumers
+from . import db
+from . import metrics
+from . import spool as spool_module
+from .admission import BACKOFF_CLOSE_CODE, AdmissionController, TokenBucket
+from .alerts import ALERT_FIRING, ALERT_RESOLVED, AlertEngine, compile_condition
+from .buffers import InMemoryStateBuffer, RedisStateBuffer
+from .consumers import FrontendConsumer, RobotStateConsumer, frontend_entry, group_message, parse_sample_timestamp
+from .current_state import dashboard_cache_key, detail_cache_key, update_current_states
+from .fleet import FleetAggregator
+from .policies import build_policy, get_policy
+from .liveness import LivenessMonitor, TimerWheel
+from .schema import extract_state_values
+from . import registry
+from .sessions import SessionRecorder, write_sessions
+from .spatial import SpatialGrid, query_heatmap
+from .history import build_rollups, expire_history, rollup_horizon, write_state_history
+from .models import Robot, RobotConnectionSession, RobotCurrentState, RobotStateDeadLetter, RobotHeatmapTile, RobotStateHistory, RobotStateRollup, RobotStateValue
+from .spool import StateSpool, encode_record, get_spool, load_spooled, read_segments
+from .timeseries import downsample_average, downsample_lttb, lttb_indices, query_series, series_resolution
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.utils.timezone import now
+from django.test.utils import CaptureQueriesContext
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
 
-# Create your tests here.
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# WebsocketCommunicator のテストで Redis を使わない
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+@skipUnless(fakeredis, "fakeredis が必要です")
+class RedisStateBufferTests(SimpleTestCase):
+    # Redis の代わりに fakeredis を使って RedisStateBuffer の読み書きを確かめる
+
+    def setUp(self):
+        self.buffer = RedisStateBuffer(client=fakeredis.FakeAsyncRedis(), prefix="test")
+
+    def sample(self, second, **state):
+        return {"state": state, "timestamp": datetime(2025, 1, 1, 0, 0, second, tzinfo=dt_timezone.utc)}
+
+    async def test_history_pop_and_prepend(self):
+        self.assertEqual(await self.buffer.append_history("r1", [self.sample(1, v=1), self.sample(2, v=2)]), 2)
+        await self.buffer.append_history("r2", [self.sample(3, v=3)])
+        self.assertTrue(await self.buffer.has_history())
+
+        # ロボットを指定した場合はそのロボットだけを取り出す
+        snapshot = await self.buffer.pop_history(["r1"])
+        self.assertEqual([sample["state"]["v"] for sample in snapshot["r1"]], [1, 2])
+        self.assertEqual(snapshot["r1"][0]["timestamp"], self.sample(1)["timestamp"])
+        self.assertNotIn("r2", snapshot)
+
+        # 書き込めなかった行は新しい行より前に戻る
+        await self.buffer.append_history("r1", [self.sample(4, v=4)])
+        await self.buffer.prepend_history("r1", snapshot["r1"])
+        snapshot = await self.buffer.pop_history()
+        self.assertEqual([sample["state"]["v"] for sample in snapshot["r1"]], [1, 2, 4])
+        self.assertEqual([sample["state"]["v"] for sample in snapshot["r2"]], [3])
+        self.assertFalse(await self.buffer.has_history())
+        self.assertEqual(await self.buffer.pop_history(), {})
+
+    async def test_merge_frontend_accumulates_changes(self):
+        await self.buffer.merge_frontend("r1", {"robot_id": "a"}, {"battery": 50, "speed": 1})
+        await self.buffer.merge_frontend("r1", {}, {"battery": 40}, removed=["speed"])
+        self.assertEqual(await self.buffer.pop_frontend(), {
+            "r1": {"meta": {"robot_id": "a"}, "state": {"battery": 40}, "removed": ["speed"]},
+        })
+        # 取り出した後は空になる
+        self.assertEqual(await self.buffer.pop_frontend(), {})
+
+    async def test_merge_frontend_readds_removed_key(self):
+        await self.buffer.merge_frontend("r1", {}, {"battery": 50}, removed=["speed"])
+        await self.buffer.merge_frontend("r1", {}, {"speed": 2})
+        entry = (await self.buffer.pop_frontend())["r1"]
+        self.assertEqual(entry["state"], {"battery": 50, "speed": 2})
+        self.assertEqual(entry["removed"], [])
+
+    async def test_merge_frontend_removal_only(self):
+        # メタ情報も状態の変化もない削除だけの更新（空の mapping で hset しない）
+        await self.buffer.merge_frontend("r1", {}, {}, removed=["speed"])
+        self.assertEqual(await self.buffer.pop_frontend(), {
+            "r1": {"meta": {}, "state": {}, "removed": ["speed"]},
+        })
+
+    async def test_update_and_get_latest(self):
+        await self.buffer.update_latest({
+            "r1": {"meta": {"online": True}, "state": {"battery": 50, "speed": 1}, "removed": []},
+        })
+        await self.buffer.update_latest({
+            "r1": {"meta": {}, "state": {"battery": 40}, "removed": ["speed"]},
+            "r2": {"meta": {"online": False}, "state": {}, "removed": []},
+        })
+        latest = await self.buffer.get_latest(["r1", "r2", "r3"])
+        self.assertEqual(latest, {
+            "r1": {"meta": {"online": True}, "state": {"battery": 40}},
+            "r2": {"meta": {"online": False}, "state": {}},
+        })
+        self.assertEqual(await self.buffer.get_latest([]), {})
+
+    async def test_streams_reset_on_first_seq(self):
+        await self.buffer.append_streams("e1", {"owner": (1, "one")})
+        await self.buffer.append_streams("e1", {"owner": (2, "two")})
+        self.assertEqual(await self.buffer.read_stream("owner"), {
+            "epoch": "e1", "seq": 2, "entries": [(1, "one"), (2, "two")],
+        })
+        # 配信タスクが替わると 1 から数え直し、古い内容は捨てる
+        await self.buffer.append_streams("e2", {"owner": (1, "three")})
+        self.assertEqual(await self.buffer.read_stream("owner"), {"epoch": "e2", "seq": 1, "entries": [(1, "three")]})
+        self.assertEqual(await self.buffer.read_stream("other"), {"epoch": None, "seq": 0, "entries": []})
+
+    async def test_sizes(self):
+        await self.buffer.append_history("r1", [self.sample(1), self.sample(2)])
+        await self.buffer.append_history("r2", [self.sample(3)])
+        await self.buffer.merge_frontend("r1", {}, {"battery": 1})
+        self.assertEqual(await self.buffer.sizes(), {"history_rows": 3, "history_robots": 2, "frontend_robots": 1})
+
+
+class StateSpoolTests(TestCase):
+    # 先行書き込みログの読み戻し
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def samples(self, *seconds):
+        return [{"state": {"v": second}, "timestamp": self.start + timedelta(seconds=second)} for second in seconds]
+
+    def crash(self, spool):
+        # ロックを手放すだけでディレクトリは残す（正常終了しなかったプロセス）
+        spool.segment.close()
+        spool.lock_file.close()
+
+    def test_read_segments_skips_truncated_and_corrupt_records(self):
+        spool = StateSpool(self.root)
+        spool.open()
+        spool.append("r1", self.samples(1, 2))
+        corrupt = bytearray(encode_record("r1", self.samples(3)))
+        corrupt[-3] ^= 1  # CRC が合わない行
+        spool.segment.write(bytes(corrupt))
+        spool.append("r2", self.samples(4))
+        spool.segment.write(encode_record("r1", self.samples(5))[:-7])  # 書き込み途中で落ちた末尾
+        self.crash(spool)
+
+        snapshot = read_segments(spool.directory)
+        self.assertEqual([sample["state"]["v"] for sample in snapshot["r1"]], [1, 2])
+        self.assertEqual(snapshot["r2"], self.samples(4))
+
+    def test_orphaned_directories_only_returns_unlocked(self):
+        stopped, running = StateSpool(self.root), StateSpool(self.root)
+        stopped.open()
+        running.open()
+        self.crash(stopped)
+        recovering = StateSpool(self.root)
+        recovering.open()
+        orphans = recovering.orphaned_directories()
+        self.addCleanup(lambda: [lock_file.close() for _, lock_file in orphans])
+        self.assertEqual([directory for directory, _ in orphans], [stopped.directory])
+        running.close(remove=True)
+        recovering.close(remove=True)
+
+    def test_load_spooled_drops_persisted_rows(self):
+        owner = User.objects.create(username="owner")
+        robot = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=owner)
+        RobotStateHistory.objects.create(robot=robot, state={"v": 1}, timestamp=self.start + timedelta(seconds=1))
+
+        spool = StateSpool(self.root)
+        spool.open()
+        spool.append("r1", self.samples(1, 2))
+        spool.append("unknown", self.samples(3))  # 未登録のロボットは書き込み時に処理する
+        self.crash(spool)
+
+        snapshot = load_spooled([spool.directory])
+        self.assertEqual(snapshot, {"r1": self.samples(2), "unknown": self.samples(3)})
+
+    def test_spool_is_not_used_with_durable_buffer(self):
+        self.addCleanup(setattr, spool_module, "_spool", None)
+        spool_module._spool = None
+        with override_settings(ROBOT_SPOOL_DIR=self.root):
+            with mock.patch("api.spool.get_state_buffer", return_value=RedisStateBuffer(client=object())):
+                self.assertIsNone(get_spool())
+            with mock.patch("api.spool.get_state_buffer", return_value=InMemoryStateBuffer()):
+                spool = get_spool()
+                self.assertIsNotNone(spool)
+                spool.close(remove=True)
+        self.assertFalse(os.listdir(self.root))
+
+
+class CompileConditionTests(SimpleTestCase):
+    # アラート条件のコンパイル
+
+    def evaluate(self, spec, state, silent=0):
+        evaluate, _ = compile_condition(spec)
+        return evaluate(state, silent)
+
+    def test_field_comparisons(self):
+        self.assertTrue(self.evaluate({"field": "battery", "op": "lt", "value": 15}, {"battery": 10}))
+        self.assertFalse(self.evaluate({"field": "battery", "op": "lt", "value": 15}, {"battery": 15}))
+        # 数値でない値・真偽値・有限でない値は比較しない
+        for value in ("10", True, float("nan"), None):
+            self.assertFalse(self.evaluate({"field": "battery", "op": "lt", "value": 15}, {"battery": value}))
+        self.assertTrue(self.evaluate({"field": "status", "op": "eq", "value": "error"}, {"status": "error"}))
+        self.assertFalse(self.evaluate({"field": "status", "op": "ne", "value": "ok"}, {}))
+        self.assertTrue(self.evaluate({"field": "status", "op": "in", "value": ["a", "b"]}, {"status": "b"}))
+
+    @override_settings(ROBOT_POSITION_FIELDS=["x", "y"])
+    def test_combinations(self):
+        spec = {"all": [{"field": "speed", "op": "gt", "value": 1.5}, {"zone": [10, 10, 0, 0]}]}
+        self.assertTrue(self.evaluate(spec, {"speed": 2, "x": 5, "y": 10}))
+        self.assertFalse(self.evaluate(spec, {"speed": 2, "x": 11, "y": 5}))
+        self.assertTrue(self.evaluate({"any": [{"silent_for": 30}, {"not": {"field": "ok", "op": "eq", "value": True}}]}, {}))
+        self.assertFalse(self.evaluate({"not": {"silent_for": 30}}, {}, silent=30))
+
+    def test_uses_time(self):
+        self.assertFalse(compile_condition({"field": "a", "op": "eq", "value": 1})[1])
+        self.assertTrue(compile_condition({"not": {"any": [{"field": "a", "op": "eq", "value": 1}, {"silent_for": 5}]}})[1])
+
+    @override_settings(ROBOT_POSITION_FIELDS=[])
+    def test_invalid_conditions(self):
+        for spec in (
+            None,
+            {},
+            {"unknown": 1},
+            {"field": "", "op": "eq", "value": 1},
+            {"field": "battery", "op": "lt", "value": "15"},
+            {"field": "battery", "op": "gt", "value": float("inf")},
+            {"field": "battery", "op": "like", "value": 1},
+            {"field": "status", "op": "in", "value": "ok"},
+            {"zone": [0, 0, 1]},
+            {"zone": [0, 0, 1, 1]},  # ROBOT_POSITION_FIELDS が未設定
+            {"silent_for": 0},
+            {"all": []},
+            {"any": [{"silent_for": 5}, {"field": 1}]},
+            {"not": {}},
+        ):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                compile_condition(spec)
+
+
+class AlertEngineTests(SimpleTestCase):
+    # ルールの発生・解消とクールダウン
+
+    def setUp(self):
+        self.engine = AlertEngine()
+        self.updated_at = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def rule(self, rule_id, condition, cooldown=0, robot=None, owner="alice"):
+        return {
+            "id": rule_id, "owner__username": owner, "robot__unique_robot_id": robot, "name": f"rule{rule_id}",
+            "condition": condition, "cooldown": cooldown, "updated_at": self.updated_at,
+        }
+
+    def statuses(self, events):
+        return [(event["status"], event["rule_id"], event["unique_robot_id"]) for event in events]
+
+    def observe(self, state, current_time, unique_robot_id="r1"):
+        self.engine.observe(unique_robot_id, "alice", "a", state, current_time, True)
+        return self.statuses(self.engine.evaluate([unique_robot_id], current_time)[0])
+
+    def test_fires_once_and_resolves(self):
+        self.engine.load([self.rule(1, {"field": "battery", "op": "lt", "value": 15})])
+        self.assertEqual(self.observe({"battery": 10}, 0), [(ALERT_FIRING, 1, "r1")])
+        self.assertEqual(self.observe({"battery": 9}, 1), [])
+        self.assertEqual(self.observe({"battery": 50}, 2), [(ALERT_RESOLVED, 1, "r1")])
+        self.assertEqual(self.observe({"battery": 60}, 3), [])
+
+    def test_cooldown_defers_refire_to_sweep(self):
+        self.engine.load([self.rule(1, {"field": "battery", "op": "lt", "value": 15}, cooldown=10)])
+        self.assertEqual(self.observe({"battery": 10}, 0), [(ALERT_FIRING, 1, "r1")])
+        self.assertEqual(self.observe({"battery": 50}, 1), [(ALERT_RESOLVED, 1, "r1")])
+        # クールダウン中は通知せず、見回りで条件が続いていれば通知する
+        self.assertEqual(self.observe({"battery": 10}, 2), [])
+        self.assertEqual(self.statuses(self.engine.sweep(5)[0]), [])
+        self.assertEqual(self.statuses(self.engine.sweep(10)[0]), [(ALERT_FIRING, 1, "r1")])
+        # 条件を満たさなくなった保留は通知しない
+        self.assertEqual(self.observe({"battery": 50}, 11), [(ALERT_RESOLVED, 1, "r1")])
+        self.assertEqual(self.observe({"battery": 10}, 12), [])
+        self.assertEqual(self.observe({"battery": 50}, 13), [])
+        self.assertEqual(self.statuses(self.engine.sweep(30)[0]), [])
+
+    def test_rule_scope(self):
+        self.engine.load([
+            self.rule(1, {"field": "battery", "op": "lt", "value": 15}, robot="r2"),
+            self.rule(2, {"field": "battery", "op": "lt", "value": 15}, owner="bob"),
+        ])
+        self.assertEqual(self.observe({"battery": 10}, 0), [])
+        self.assertEqual(self.observe({"battery": 10}, 0, "r2"), [(ALERT_FIRING, 1, "r2")])
+
+    def test_silent_for_uses_last_received_message(self):
+        self.engine.load([self.rule(1, {"silent_for": 30})])
+        self.engine.observe("r1", "alice", "a", {}, 0, True)
+        # 接続・切断の通知だけでは最後にメッセージを受け取った時刻を更新しない
+        self.engine.observe("r1", "alice", "a", {}, 20, False)
+        self.assertEqual(self.statuses(self.engine.sweep(30)[0]), [(ALERT_FIRING, 1, "r1")])
+        self.assertEqual(self.observe({}, 40), [(ALERT_RESOLVED, 1, "r1")])
+
+    def test_seed_keeps_stored_time(self):
+        self.engine.load([self.rule(1, {"silent_for": 30})])
+        self.engine.seed("r1", "alice", "a", {}, 0)
+        self.engine.observe("r2", "alice", "b", {}, 50, True)
+        self.engine.seed("r2", "alice", "b", {}, 0)  # 引き継いだ後に受け取ったロボットは上書きしない
+        self.assertEqual(self.statuses(self.engine.sweep(60)[0]), [(ALERT_FIRING, 1, "r1")])
+
+    def test_reload_drops_removed_rules(self):
+        self.engine.load([self.rule(1, {"field": "battery", "op": "lt", "value": 15}), self.rule(2, {"bad": 1})])
+        self.assertEqual(list(self.engine.rules), [1])
+        self.observe({"battery": 10}, 0)
+        self.engine.load([])
+        self.assertEqual(self.engine.active, set())
+        self.assertEqual(self.observe({"battery": 10}, 1), [])
+
+
+class FleetAggregatorTests(SimpleTestCase):
+    # 所有者ごとのフリート集計
+
+    def setUp(self):
+        self.fleet = FleetAggregator({"battery": "number", "status": "text"})
+
+    def summary(self, owner="alice"):
+        return self.fleet.take_summaries(everyone=True)[owner]
+
+    def test_updates_replace_previous_values(self):
+        self.fleet.update("r1", "alice", True, {"battery": 20, "status": "ok"})
+        self.fleet.update("r2", "alice", True, {"battery": 40, "status": "ok"})
+        self.fleet.update("r1", "alice", True, {"battery": 60, "status": "charging"})
+        summary = self.summary()
+        self.assertEqual((summary["total"], summary["online"]), (2, 2))
+        self.assertEqual(summary["fields"]["battery"], {"count": 2, "avg": 50.0, "min": 40.0, "max": 60.0})
+        self.assertEqual(summary["fields"]["status"], {"counts": {"ok": 1, "charging": 1}})
+
+        # オフラインのロボットは台数にだけ数える
+        self.fleet.update("r2", "alice", False, {"battery": 40, "status": "ok"})
+        summary = self.summary()
+        self.assertEqual((summary["total"], summary["online"]), (2, 1))
+        self.assertEqual(summary["fields"]["battery"], {"count": 1, "avg": 60.0, "min": 60.0, "max": 60.0})
+
+    def test_non_finite_values_are_ignored(self):
+        self.fleet.update("r1", "alice", True, {"battery": float("inf")})
+        self.fleet.update("r2", "alice", True, {"battery": 30})
+        self.fleet.update("r3", "alice", True, {"battery": float("nan")})
+        self.assertEqual(self.summary()["fields"]["battery"], {"count": 1, "avg": 30.0, "min": 30.0, "max": 30.0})
+        self.fleet.update("r1", "alice", True, {"battery": 10})
+        self.assertEqual(self.summary()["fields"]["battery"], {"count": 2, "avg": 20.0, "min": 10.0, "max": 30.0})
+
+    def test_seed_does_not_overwrite_updates(self):
+        self.fleet.update("r1", "alice", True, {"battery": 80})
+        self.fleet.seed("r1", "alice", True, {"battery": 10})
+        self.fleet.seed("r2", "alice", False, {"battery": 10})
+        summary = self.summary()
+        self.assertEqual((summary["total"], summary["online"]), (2, 1))
+        self.assertEqual(summary["fields"]["battery"]["avg"], 80.0)
+
+    def test_prune_removes_deleted_robots(self):
+        self.fleet.update("r1", "alice", True, {"battery": 20})
+        self.fleet.update("r2", "alice", True, {"battery": 40})
+        self.fleet.update("r3", "bob", True, {"battery": 60})
+        self.fleet.take_summaries()
+        self.fleet.prune({"r2", "r3"})
+        summaries = self.fleet.take_summaries()
+        self.assertEqual(list(summaries), ["alice"])
+        self.assertEqual((summaries["alice"]["total"], summaries["alice"]["online"]), (1, 1))
+        self.assertEqual(summaries["alice"]["fields"]["battery"]["min"], 40.0)
+        # 外したスロットは次のロボットに使う
+        self.fleet.update("r4", "alice", True, {"battery": 10})
+        self.assertEqual(self.summary()["fields"]["battery"], {"count": 2, "avg": 25.0, "min": 10.0, "max": 40.0})
+
+
+    def test_full_refresh_recomputes_drifted_sums(self):
+        self.fleet.update("r1", "alice", True, {"battery": 1e16})
+        self.fleet.update("r2", "alice", True, {"battery": 1.0})
+        self.fleet.update("r1", "alice", True, {"battery": 0})
+        # 差し引きだけでは 1e16 + 1 の丸め誤差が合計に残る
+        self.assertEqual(self.fleet.take_summaries()["alice"]["fields"]["battery"]["avg"], 0.0)
+        # 定期的な全件配信では列から計算し直す
+        self.assertEqual(self.summary()["fields"]["battery"], {"count": 2, "avg": 0.5, "min": 0.0, "max": 1.0})
+        self.fleet.update("r2", "alice", False, {})
+        self.assertEqual(self.summary()["fields"]["battery"], {"count": 1, "avg": 0.0, "min": 0.0, "max": 0.0})
+
+@override_settings(ROBOT_MAX_CLOCK_SKEW=300, ROBOT_HISTORY_RETENTION_DAYS=30)
+class ParseSampleTimestampTests(SimpleTestCase):
+    # デバイス側の時刻の変換
+
+    def setUp(self):
+        self.received_at = datetime(2025, 6, 1, tzinfo=dt_timezone.utc)
+
+    def test_formats(self):
+        expected = self.received_at - timedelta(seconds=10)
+        self.assertEqual(parse_sample_timestamp(expected.timestamp(), self.received_at), expected)
+        self.assertEqual(parse_sample_timestamp(expected.isoformat(), self.received_at), expected)
+        self.assertEqual(parse_sample_timestamp("2025-05-31T23:59:50", self.received_at), expected)  # タイムゾーンなしは UTC
+        self.assertEqual(parse_sample_timestamp(None, self.received_at), self.received_at)
+        with self.assertRaises(ValueError):
+            parse_sample_timestamp("garbage", self.received_at)
+
+    def test_skew_and_retention(self):
+        # 未来すぎる時刻は受信時刻、保持期間より古い時刻は破棄
+        self.assertEqual(parse_sample_timestamp((self.received_at + timedelta(seconds=301)).timestamp(), self.received_at), self.received_at)
+        old = self.received_at - timedelta(days=29)
+        self.assertEqual(parse_sample_timestamp(old.timestamp(), self.received_at), old)
+        self.assertIsNone(parse_sample_timestamp((self.received_at - timedelta(days=31)).timestamp(), self.received_at))
+        with override_settings(ROBOT_HISTORY_RETENTION_DAYS=0):
+            self.assertEqual(parse_sample_timestamp(old.timestamp() - 86400 * 365, self.received_at), old - timedelta(days=365))
+
+
+class StreamResumeTests(SimpleTestCase):
+    # フロントエンドの再接続時に取りこぼした差分だけを送り直す
+
+    def stream(self, *seqs, epoch="e1"):
+        return {"epoch": epoch, "seq": seqs[-1] if seqs else 0, "entries": [(seq, f"frame{seq}") for seq in seqs]}
+
+    def test_missed_frames(self):
+        stream = self.stream(3, 4, 5, 6)
+        self.assertEqual(FrontendConsumer.missed_frames(stream, "e1", "4"), ["frame5", "frame6"])
+        self.assertEqual(FrontendConsumer.missed_frames(stream, "e1", "2"), ["frame3", "frame4", "frame5", "frame6"])
+        self.assertEqual(FrontendConsumer.missed_frames(stream, "e1", "6"), [])  # 取りこぼしなし
+
+    def test_missed_frames_requires_snapshot(self):
+        stream = self.stream(3, 4, 5, 6)
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, "e1", "1"))  # バッファから溢れている
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, "e2", "4"))  # 配信タスクが替わった
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, "e1", "7"))  # サーバーより先の位置
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, None, "4"))
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, "e1", "x"))
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, "e1", None))
+        self.assertIsNone(FrontendConsumer.missed_frames(self.stream(epoch=None), "e1", "0"))
+
+    @override_settings(ROBOT_FRONTEND_RESUME_BUFFER=3)
+    async def test_in_memory_stream_ring(self):
+        buffer = InMemoryStateBuffer()
+        for seq in range(1, 6):
+            await buffer.append_streams("e1", {"owner": (seq, f"frame{seq}")})
+        stream = await buffer.read_stream("owner")
+        self.assertEqual(stream, self.stream(3, 4, 5))
+        self.assertEqual(FrontendConsumer.missed_frames(stream, "e1", "3"), ["frame4", "frame5"])
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, "e1", "1"))
+        # 配信タスクが替わると新しい epoch で数え直す
+        await buffer.append_streams("e2", {"owner": (1, "next")})
+        stream = await buffer.read_stream("owner")
+        self.assertEqual(stream, {"epoch": "e2", "seq": 1, "entries": [(1, "next")]})
+        self.assertIsNone(FrontendConsumer.missed_frames(stream, "e1", "5"))
+
+
+class PersistencePolicyTests(SimpleTestCase):
+    # 履歴の保存ポリシー
+
+    def setUp(self):
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def persisted(self, config, samples):
+        # samples: [(経過秒数, state), ...] のうち保存されるものの経過秒数
+        policy = build_policy(config)
+        previous = None
+        kept = []
+        for seconds, state in samples:
+            timestamp = self.start + timedelta(seconds=seconds)
+            if policy.should_persist(previous, state, timestamp):
+                previous = {"state": state, "timestamp": timestamp}
+                kept.append(seconds)
+        return kept
+
+    def test_keep_all_and_interval(self):
+        samples = [(second, {"v": 1}) for second in range(0, 12)]
+        self.assertEqual(self.persisted({"mode": "keep_all"}, samples), list(range(12)))
+        self.assertEqual(self.persisted({"mode": "interval", "interval": 5}, samples), [0, 5, 10])
+        self.assertEqual(self.persisted({"mode": "keep_all", "min_interval": 4}, samples), [0, 4, 8])
+
+    def test_on_change(self):
+        samples = [(0, {"v": 1, "t": 0}), (1, {"v": 1, "t": 1}), (2, {"v": 2, "t": 2}), (3, {"v": 2}), (20, {"v": 2})]
+        self.assertEqual(self.persisted({"mode": "on_change"}, samples), [0, 1, 2, 3])
+        self.assertEqual(self.persisted({"mode": "on_change", "ignore": ["t"]}, samples), [0, 2])
+        # 変化がなくても max_interval ごとに保存する
+        self.assertEqual(self.persisted({"mode": "on_change", "ignore": ["t"], "max_interval": 10}, samples), [0, 2, 20])
+
+    def test_deadband(self):
+        config = {"mode": "deadband", "fields": {"x": 0.5}}
+        samples = [(0, {"x": 0.0, "s": "ok"}), (1, {"x": 0.4, "s": "ok"}), (2, {"x": 0.6, "s": "ok"}),
+                   (3, {"x": 0.7, "s": "error"}), (4, {"x": "n/a", "s": "error"}), (5, {"x": "n/a", "s": "error"})]
+        # 閾値未満の変化は保存しない。他のキーの変化や数値でない値の変化は保存する
+        self.assertEqual(self.persisted(config, samples), [0, 2, 3, 4])
+
+    def test_invalid_configs(self):
+        for config in ({"mode": "unknown"}, {"mode": "interval", "every": 5}):
+            with self.subTest(config=config), self.assertRaises(ImproperlyConfigured):
+                build_policy(config)
+
+    @override_settings(ROBOT_PERSISTENCE_POLICY={
+        "default": {"mode": "interval", "interval": 7},
+        "owners": {"alice": {"mode": "on_change"}},
+        "robots": {"r1": {"mode": "keep_all"}, "broken": {"mode": "interval", "interval": "x"}},
+    })
+    def test_get_policy_precedence(self):
+        self.assertEqual(type(get_policy("r1", "alice")).__name__, "KeepAllPolicy")
+        self.assertEqual(type(get_policy("r2", "alice")).__name__, "OnChangePolicy")
+        self.assertEqual(get_policy("r2", "bob").interval, 7.0)
+        # 不正な設定は既定のポリシーを使う
+        self.assertEqual(get_policy("broken", "alice").interval, 5.0)
+
+
+class DownsampleTests(SimpleTestCase):
+    # 時系列の間引き
+
+    def setUp(self):
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def test_lttb_keeps_short_series(self):
+        self.assertEqual(lttb_indices([], [], 10), [])
+        self.assertEqual(lttb_indices([0.0], [1.0], 10), [0])
+        self.assertEqual(lttb_indices([0.0, 1.0, 2.0], [1.0, 2.0, 3.0], 3), [0, 1, 2])
+        self.assertEqual(lttb_indices(list(map(float, range(10))), [0.0] * 10, 2), list(range(10)))
+
+    def test_lttb_selects_threshold_points(self):
+        xs = list(map(float, range(1000)))
+        ys = [float(i % 7) for i in range(1000)]
+        for threshold in (3, 10, 999):
+            indices = lttb_indices(xs, ys, threshold)
+            self.assertEqual(len(indices), threshold)
+            self.assertEqual((indices[0], indices[-1]), (0, 999))
+            self.assertEqual(indices, sorted(set(indices)))
+
+    def test_lttb_keeps_spikes(self):
+        xs = list(map(float, range(100)))
+        ys = [0.0] * 100
+        ys[37] = 50.0
+        ys[81] = -20.0
+        indices = lttb_indices(xs, ys, 10)
+        self.assertIn(37, indices)
+        self.assertIn(81, indices)
+
+    def test_downsample_lttb_skips_missing_and_non_numeric(self):
+        rows = [
+            (self.start + timedelta(seconds=i), state)
+            for i, state in enumerate([{"a": 1}, {"a": True, "b": 2}, {"a": "x"}, None, {"a": 3.5}])
+        ]
+        raw_count, series = downsample_lttb(rows, ["a", "b", "c"], 500)
+        self.assertEqual(raw_count, 5)
+        self.assertEqual(series["a"], [[self.start.isoformat(), 1.0], [(self.start + timedelta(seconds=4)).isoformat(), 3.5]])
+        self.assertEqual(series["b"], [[(self.start + timedelta(seconds=1)).isoformat(), 2.0]])
+        self.assertEqual(series["c"], [])
+
+    def test_downsample_average_buckets(self):
+        rows = [(self.start + timedelta(seconds=i), {"a": i}) for i in range(10)]
+        raw_count, series = downsample_average(rows, ["a"], 2, self.start, self.start + timedelta(seconds=10))
+        self.assertEqual(raw_count, 10)
+        self.assertEqual(series["a"], [
+            [self.start.isoformat(), 2.0],
+            [(self.start + timedelta(seconds=5)).isoformat(), 7.0],
+        ])
+
+
+@override_settings(ROBOT_POSITION_FIELDS=[], ROBOT_HISTORY_RETENTION_DAYS=1, ROBOT_HEATMAP_RETENTION_DAYS=0,
+                   ROBOT_ROLLUP_RETENTION_DAYS={"minute": 0, "hour": 0})
+class HistoryRollupTests(TestCase):
+    # 履歴のロールアップと保持期間
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.robot = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=owner)
+        self.start = datetime(2025, 1, 1, 10, 0, tzinfo=dt_timezone.utc)
+
+    def add(self, minutes, **state):
+        return RobotStateHistory.objects.create(robot=self.robot, state=state, timestamp=self.start + timedelta(minutes=minutes))
+
+    def rollup(self, resolution, minutes):
+        return RobotStateRollup.objects.get(
+            robot=self.robot, resolution=resolution, bucket_start=self.start + timedelta(minutes=minutes)
+        )
+
+    def test_build_rollups_is_incremental(self):
+        self.add(0.1, battery=50, status="ok")
+        self.add(0.5, battery=40)
+        self.add(1.5, battery=30)
+        self.assertEqual(build_rollups(commit_lag=0), 3)
+        minute = self.rollup("minute", 0)
+        self.assertEqual(minute.count, 2)
+        self.assertEqual(
+            {key: minute.stats["battery"][key] for key in ("min", "max", "sum", "count", "last")},
+            {"min": 40, "max": 50, "sum": 90, "count": 2, "last": 40},
+        )
+        self.assertNotIn("status", minute.stats)
+        self.assertEqual(self.rollup("hour", 0).count, 3)
+
+        # 集計済みの行は読み直さず、遅れて書き込まれた古い時刻の行も既存の区間に加算する
+        self.assertEqual(build_rollups(commit_lag=0), 0)
+        self.add(0.2, battery=60)
+        self.assertEqual(build_rollups(commit_lag=0), 1)
+        minute = self.rollup("minute", 0)
+        self.assertEqual((minute.count, minute.stats["battery"]["max"], minute.stats["battery"]["last"]), (3, 60, 40))
+        self.assertEqual(self.rollup("hour", 0).count, 4)
+
+    def test_rollup_horizon_waits_for_commit_lag(self):
+        first = self.add(0)
+        current_time = self.start
+        # 初回は最大の id を記録するだけ
+        self.assertIsNone(rollup_horizon(current_time, commit_lag=60))
+        second = self.add(1)
+        self.assertIsNone(rollup_horizon(current_time + timedelta(seconds=30), commit_lag=60))
+        # commit_lag 秒後に、記録した時点の id までを集計してよい
+        self.assertEqual(rollup_horizon(current_time + timedelta(seconds=60), commit_lag=60), first.id)
+        self.assertEqual(rollup_horizon(current_time + timedelta(seconds=120), commit_lag=60), second.id)
+        self.assertEqual(rollup_horizon(commit_lag=0), second.id)
+
+    def test_expire_history_only_removes_rolled_up_whole_hours(self):
+        old = self.add(0)
+        boundary = self.add(90)  # 保持期間の境界を含む時間の区間
+        build_rollups(commit_lag=0)
+        late = self.add(10)  # まだ集計していない
+        current_time = self.start + timedelta(days=1, minutes=100)
+
+        deleted = expire_history(current_time)
+        self.assertEqual(deleted["history"], 1)
+        self.assertEqual(
+            set(RobotStateHistory.objects.values_list("id", flat=True)), {boundary.id, late.id}
+        )
+        self.assertFalse(RobotStateHistory.objects.filter(id=old.id).exists())
+        # ロールアップは残る
+        self.assertEqual(self.rollup("hour", 0).count, 1)
+
+
+@override_settings(ROBOT_POSITION_FIELDS=[], ROBOT_HISTORY_RETENTION_DAYS=30, ROBOT_HEATMAP_RETENTION_DAYS=0,
+                   ROBOT_ROLLUP_RETENTION_DAYS={"minute": 180, "hour": 0})
+class QuerySeriesTests(TestCase):
+    # 時系列の読み出し元（生データとロールアップ）
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.robot = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=owner)
+        self.now = now()
+        self.since = (self.now - timedelta(days=40)).replace(minute=0, second=0, microsecond=0)
+
+    def test_series_resolution(self):
+        day = timedelta(days=1)
+        resolution = lambda since, points: series_resolution(self.now - since, self.now, points, current_time=self.now)
+        # 保持期間内で1点あたりの幅が1分未満なら生データ
+        self.assertIsNone(resolution(day, 2000))
+        self.assertIsNone(series_resolution(None, points=10))
+        # 1点あたりの幅に合わせて最も粗い集計単位
+        self.assertEqual(resolution(day, 500), "minute")
+        self.assertEqual(resolution(day, 10), "hour")
+        # 生データの保持期間より前は、1点あたりの幅が小さくても分単位から読む
+        self.assertEqual(series_resolution(self.now - 40 * day, self.now - 40 * day + timedelta(seconds=60), 500,
+                                           current_time=self.now), "minute")
+        # 分単位の保持期間も過ぎていれば時間単位
+        self.assertEqual(resolution(200 * day, 5000), "hour")
+
+    def test_old_window_is_read_from_rollups(self):
+        # 生データは保持期間を過ぎて削除済みで、ロールアップだけが残っている
+        for minutes, total, count in ((0, 30, 3), (1, 8, 2), (2, 5, 1)):
+            RobotStateRollup.objects.create(
+                robot=self.robot, resolution="minute", bucket_start=self.since + timedelta(minutes=minutes), count=count,
+                stats={"battery": {"min": 0, "max": 0, "sum": total, "count": count, "last": 0, "last_at": ""}},
+            )
+        # 最新の区間は集計中の可能性があるので、生データが残っていればそちらを使う
+        RobotStateHistory.objects.create(
+            robot=self.robot, state={"battery": 7}, timestamp=self.since + timedelta(minutes=2, seconds=30),
+        )
+        until = self.since + timedelta(minutes=10)
+
+        result = query_series(self.robot, ["battery"], since=self.since, until=until, points=500)
+        self.assertEqual(result["source"], "minute")
+        self.assertEqual(result["raw_count"], 6)
+        self.assertEqual([value for _, value in result["series"]["battery"]], [10.0, 4.0, 7.0])
+        self.assertEqual(result["series"]["battery"][0][0], self.since.isoformat())
+
+        result = query_series(self.robot, ["battery"], since=self.since, until=until, points=500, method="average")
+        self.assertEqual([value for _, value in result["series"]["battery"]], [10.0, 4.0, 7.0])
+
+    def test_wide_window_uses_rollups_and_recent_window_uses_raw(self):
+        since = self.now - timedelta(days=2)
+        RobotStateHistory.objects.create(robot=self.robot, state={"battery": 50}, timestamp=since + timedelta(hours=1))
+        RobotStateHistory.objects.create(robot=self.robot, state={"battery": 40}, timestamp=since + timedelta(hours=30))
+        build_rollups(commit_lag=0)
+        RobotStateHistory.objects.create(robot=self.robot, state={"battery": 30}, timestamp=since + timedelta(hours=31))
+
+        result = query_series(self.robot, ["battery"], since=since, until=self.now, points=10)
+        self.assertEqual(result["source"], "hour")
+        # 集計前の行も生データから読む
+        self.assertEqual(result["raw_count"], 3)
+        self.assertEqual([value for _, value in result["series"]["battery"]], [50.0, 40.0, 30.0])
+
+        result = query_series(self.robot, ["battery"], since=since, until=self.now, points=5000)
+        self.assertEqual(result["source"], "raw")
+        self.assertEqual(result["raw_count"], 3)
+
+    def test_empty_window(self):
+        result = query_series(self.robot, ["battery"], since=self.since, until=self.since + timedelta(hours=1))
+        self.assertEqual(result, {"source": "minute", "raw_count": 0, "series": {"battery": []}})
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class RobotStateHistoryAPITests(TestCase):
+    # 履歴 API のキーセットページネーションと絞り込み
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.robot = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=self.owner)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.client.force_login(self.owner)
+
+    def add(self, seconds, **state):
+        return RobotStateHistory.objects.create(robot=self.robot, state=state, timestamp=self.start + timedelta(seconds=seconds))
+
+    def test_cursor_pages_rows_with_equal_timestamps(self):
+        # 同じ時刻の行がページの境界をまたいでも重複や抜けが出ない
+        for i in range(25):
+            self.add(i // 10, seq=i)
+        seen = []
+        url = "/api/robots/r1/history/?page_size=7"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            seen += [row["state"]["seq"] for row in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(sorted(seen), list(range(25)))
+        # 新しい順
+        self.assertEqual(seen[:5], [24, 23, 22, 21, 20])
+
+    def test_since_until_and_fields(self):
+        for i in range(5):
+            self.add(i, battery=i, status="ok")
+        response = self.client.get("/api/robots/r1/history/", {
+            "since": (self.start + timedelta(seconds=1)).isoformat(),
+            "until": (self.start + timedelta(seconds=3)).isoformat(),
+            "fields": "battery,speed",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["state"] for row in response.data["results"]], [{"battery": 2}, {"battery": 1}])
+        self.assertEqual(response.data["results"][0]["robot"], str(self.robot))
+
+    def test_page_size_is_capped(self):
+        RobotStateHistory.objects.bulk_create([
+            RobotStateHistory(robot=self.robot, state={}, timestamp=self.start + timedelta(seconds=i)) for i in range(1001)
+        ])
+        response = self.client.get("/api/robots/r1/history/", {"page_size": 5000})
+        self.assertEqual(len(response.data["results"]), 1000)
+        self.assertIsNotNone(response.data["next"])
+
+    def test_invalid_datetime_is_rejected(self):
+        for value in ("yesterday", "2025-13-40T00:00:00"):
+            response = self.client.get("/api/robots/r1/history/", {"since": value})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("since", response.data)
+        self.assertEqual(self.client.get("/api/robots/r1/history/", {"until": "2025-02-30"}).status_code, 400)
+
+    def test_other_owners_robot_is_not_found(self):
+        self.client.force_login(User.objects.create(username="other"))
+        self.assertEqual(self.client.get("/api/robots/r1/history/").status_code, 404)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, SERVE_ASGI=False)
+class RobotStateHistoryExportTests(TestCase):
+    # 履歴のエクスポート
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        for unique_robot_id, robot_id in (("r1", "a"), ("r2", "b")):
+            robot = Robot.objects.create(unique_robot_id=unique_robot_id, robot_id=robot_id, owner=self.owner)
+            for i in range(2):
+                RobotStateHistory.objects.create(
+                    robot=robot, state={"battery": i, "status": "ok"}, timestamp=self.start + timedelta(seconds=i),
+                )
+        other = User.objects.create(username="other")
+        Robot.objects.create(unique_robot_id="r3", robot_id="c", owner=other).state_histories.create(
+            state={"battery": 9}, timestamp=self.start,
+        )
+        self.client.force_login(self.owner)
+
+    def test_ndjson(self):
+        response = self.client.get("/api/history/export/", {"robots": "r1,r3", "since": (self.start + timedelta(seconds=1)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertFalse(response.is_async)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{
+            "unique_robot_id": "r1", "robot_id": "a",
+            "timestamp": (self.start + timedelta(seconds=1)).isoformat(), "state": {"battery": 1, "status": "ok"},
+        }])
+
+    def test_csv_with_fields(self):
+        response = self.client.get("/api/history/export/", {"format": "csv", "fields": "battery,speed"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="robot_history.csv"', response["Content-Disposition"])
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, [
+            "unique_robot_id,robot_id,timestamp,battery,speed",
+            f"r1,a,{self.start.isoformat()},0,",
+            f"r1,a,{(self.start + timedelta(seconds=1)).isoformat()},1,",
+            f"r2,b,{self.start.isoformat()},0,",
+            f"r2,b,{(self.start + timedelta(seconds=1)).isoformat()},1,",
+        ])
+
+    def test_invalid_format(self):
+        self.assertEqual(self.client.get("/api/history/export/", {"format": "xml"}).status_code, 400)
+        with mock.patch("api.views.parquet_available", return_value=False):
+            response = self.client.get("/api/history/export/", {"format": "parquet"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("format", response.json())
+
+    @override_settings(SERVE_ASGI=True)
+    async def test_asgi_streams_async_iterator(self):
+        await self.async_client.aforce_login(self.owner)
+        response = await self.async_client.get("/api/history/export/", {"robots": "r2"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual([json.loads(line)["unique_robot_id"] for line in content.decode().splitlines()], ["r2", "r2"])
+
+
+@override_settings(ROBOT_DB_POOL_SIZES={"interactive": 3, "background": 2})
+class DBExecutorTests(SimpleTestCase):
+    # DB 呼び出し用のスレッドプール
+
+    def setUp(self):
+        patcher = mock.patch.dict(db._executors, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(db.shutdown_executors)
+
+    async def thread_name(self, pool):
+        return await db.db_sync_to_async("test", pool=pool)(lambda: threading.current_thread().name)()
+
+    async def test_calls_run_on_named_pool(self):
+        with mock.patch.object(db.connections["default"], "vendor", "postgresql"):
+            self.assertTrue((await self.thread_name("interactive")).startswith("robot-db-interactive"))
+            self.assertTrue((await self.thread_name("background")).startswith("robot-db-background"))
+            self.assertIsNot(db.get_executor("interactive"), db.get_executor("background"))
+            self.assertEqual(db.get_executor("interactive")._max_workers, 3)
+            self.assertEqual(db.get_executor("background")._max_workers, 2)
+
+    async def test_sqlite_shares_one_thread(self):
+        self.assertEqual(db.connections["default"].vendor, "sqlite")
+        names = {await self.thread_name("interactive"), await self.thread_name("background")}
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names.pop().startswith("robot-db-sqlite"))
+        self.assertIs(db.get_executor("interactive"), db.get_executor("background"))
+        self.assertEqual(db.get_executor("interactive")._max_workers, 1)
+
+    async def test_failed_call_closes_broken_connection(self):
+        broken = mock.Mock(connection=object(), errors_occurred=True, **{"is_usable.return_value": False})
+        recovered = mock.Mock(connection=object(), errors_occurred=True, **{"is_usable.return_value": True})
+        healthy = mock.Mock(connection=object(), errors_occurred=False)
+        closed = mock.Mock(connection=None, errors_occurred=True)
+        connections = mock.MagicMock()
+        connections.all.return_value = [broken, recovered, healthy, closed]
+
+        def fail():
+            raise OperationalError("server closed the connection unexpectedly")
+
+        with mock.patch.object(db, "connections", connections):
+            with self.assertRaises(OperationalError):
+                await db.db_sync_to_async("test")(fail)()
+        connections.all.assert_called_once_with(initialized_only=True)
+        broken.close.assert_called_once_with()
+        # 使える接続はエラーの記録だけを消して使い続ける
+        recovered.close.assert_not_called()
+        self.assertFalse(recovered.errors_occurred)
+        healthy.is_usable.assert_not_called()
+        healthy.close.assert_not_called()
+        closed.close.assert_not_called()
+
+
+class MetricsRenderTests(SimpleTestCase):
+    # Prometheus のテキスト形式
+
+    def setUp(self):
+        patcher = mock.patch.object(metrics, "_registry", [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counter_and_gauge(self):
+        counter = metrics.Counter("test_total", "Things counted.", ["kind"])
+        counter.inc(1, "a")
+        counter.inc(2, "a")
+        counter.inc(1, "b")
+        gauge = metrics.Gauge("test_level", "A level.")
+        gauge.set(5)
+        gauge.dec(2)
+        self.assertEqual(metrics.render_metrics(), "\n".join([
+            "# HELP test_total Things counted.",
+            "# TYPE test_total counter",
+            'test_total{kind="a"} 3',
+            'test_total{kind="b"} 1',
+            "# HELP test_level A level.",
+            "# TYPE test_level gauge",
+            "test_level 3",
+        ]) + "\n")
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Durations.", ["op"], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, "read")
+        self.assertEqual(histogram.render()[2:], [
+            # 上限と等しい値はその区間に入る (le)
+            'test_seconds_bucket{op="read",le="0.1"} 2',
+            'test_seconds_bucket{op="read",le="1"} 3',
+            'test_seconds_bucket{op="read",le="+Inf"} 4',
+            'test_seconds_sum{op="read"} 3.65',
+            'test_seconds_count{op="read"} 4',
+        ])
+        with mock.patch.object(metrics.time, "perf_counter", side_effect=[10.0, 10.25]):
+            with histogram.time("write"):
+                pass
+        self.assertIn('test_seconds_bucket{op="write",le="0.1"} 0', histogram.render())
+        self.assertIn('test_seconds_sum{op="write"} 0.25', histogram.render())
+
+    def test_label_values_are_escaped(self):
+        counter = metrics.Counter("test_total", "Things counted.", ["robot"])
+        counter.inc(1, 'a"b\\c\nd')
+        self.assertEqual(counter.render()[2], 'test_total{robot="a\\"b\\\\c\\nd"} 1')
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class MetricsViewTests(SimpleTestCase):
+    # /metrics の認証
+
+    def setUp(self):
+        patcher = mock.patch("api.views.get_state_buffer", return_value=InMemoryStateBuffer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(ROBOT_METRICS_TOKEN="secret")
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn("# TYPE robot_history_cache_rows gauge", response.content.decode())
+
+    @override_settings(ROBOT_METRICS_TOKEN="")
+    def test_no_token_configured(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class FrontendConsumerTests(TransactionTestCase):
+    # FrontendConsumer の購読（DB はプールのスレッドから読むため TransactionTestCase を使う）
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.other = User.objects.create(username="other")
+        Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=self.owner)
+        self.buffer = InMemoryStateBuffer()
+        patcher = mock.patch.object(consumers, "get_state_buffer", return_value=self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def communicator(self, user, query=""):
+        communicator = WebsocketCommunicator(FrontendConsumer.as_asgi(), f"/ws/frontend/?{query}")
+        communicator.scope["user"] = user
+        return communicator
+
+    async def test_robot_subscription_requires_owner(self):
+        for user in (AnonymousUser(), self.other):
+            communicator = self.communicator(user, "unique_robot_id=r1")
+            connected, code = await communicator.connect()
+            self.assertFalse(connected)
+            self.assertEqual(code, 4003)
+
+        communicator = self.communicator(self.owner, "unique_robot_id=r1")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())["type"], "snapshot")
+        await communicator.disconnect()
+
+    @skipUnless(consumers.msgpack, "msgpack が必要です")
+    async def test_snapshot_then_deltas(self):
+        # ロボットの受信から配信タスクを通してフロントエンドに届くまで
+        json_client = self.communicator(self.owner, "unique_robot_id=r1")
+        msgpack_client = self.communicator(self.owner, "unique_robot_id=r1&encoding=msgpack")
+        for client in (json_client, msgpack_client):
+            await client.connect()
+        self.assertEqual((await json_client.receive_json_from())["robots"], [])
+        self.assertEqual(consumers.msgpack.unpackb((await msgpack_client.receive_output())["bytes"])["type"], "snapshot")
+
+        robot = WebsocketCommunicator(RobotStateConsumer.as_asgi(), "/ws/robots/?unique_robot_id=r1")
+        with mock.patch.dict(consumers.registry.robot_registry, clear=True), \
+                mock.patch.object(consumers, "get_spool", return_value=None), \
+                mock.patch.object(consumers, "session_recorder", SessionRecorder()):
+            self.assertTrue((await robot.connect())[0])
+            broadcaster = asyncio.create_task(consumers.SharedTasks.send_to_frontend(get_channel_layer()))
+            try:
+                async def send_state(state):
+                    await robot.send_json_to({"robot_id": "a", "owner": "owner", "state": state})
+                    message = await json_client.receive_json_from(timeout=3)
+                    binary = await msgpack_client.receive_output(timeout=3)
+                    # MessagePack の購読には同じ内容をバイナリで送る
+                    self.assertEqual(consumers.msgpack.unpackb(binary["bytes"]), message)
+                    return message
+
+                first = await send_state({"battery": 50, "speed": 1, "mode": "auto"})
+                self.assertEqual((first["type"], first["seq"]), ("delta", 1))
+                self.assertEqual(first["robots"][0]["state"], {"battery": 50, "speed": 1, "mode": "auto"})
+                self.assertTrue(first["robots"][0]["online"])
+
+                # 変化したキーと削除されたキーだけを送る
+                second = await send_state({"battery": 40, "speed": 1})
+                self.assertEqual((second["epoch"], second["seq"]), (first["epoch"], 2))
+                self.assertEqual(second["robots"][0]["state"], {"battery": 40})
+                self.assertEqual(second["robots"][0]["removed"], ["mode"])
+
+                # 後から接続したフロントエンドには最新状態のスナップショットを送る
+                late_client = self.communicator(self.owner, "unique_robot_id=r1")
+                await late_client.connect()
+                snapshot = await late_client.receive_json_from()
+                self.assertEqual((snapshot["type"], snapshot["seq"]), ("snapshot", 2))
+                self.assertEqual(snapshot["robots"][0]["state"], {"battery": 40, "speed": 1})
+                await late_client.disconnect()
+            finally:
+                broadcaster.cancel()
+                await asyncio.gather(broadcaster, return_exceptions=True)
+                await robot.disconnect()
+        for client in (json_client, msgpack_client):
+            await client.disconnect()
+
+
+def reject_bad_rows(bulk_create):
+    # state に "bad" を含む行があると毎回失敗する bulk_create
+    def wrapper(objs, *args, **kwargs):
+        objs = list(objs)
+        if any(row.state.get("bad") for row in objs):
+            raise OperationalError("rejected")
+        return bulk_create(objs, *args, **kwargs)
+    return wrapper
+
+
+@override_settings(ROBOT_STATE_SCHEMA={}, ROBOT_FLUSH_MAX_ATTEMPTS=3)
+class WriteStateHistoryTests(TestCase):
+    # 履歴のフラッシュ
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.robot = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=owner)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def sample(self, second, **state):
+        return {"state": state or {"v": second}, "timestamp": self.start + timedelta(seconds=second)}
+
+    def test_writes_batches_and_drops_deleted_robots(self):
+        stats = write_state_history({
+            "r1": [self.sample(1), self.sample(2), self.sample(3)],
+            "deleted": [self.sample(4)],
+            "empty": [],
+        }, batch_size=2)
+        self.assertEqual((stats["rows"], stats["batches"], stats["dropped"], stats["failed"]), (3, 2, 1, {}))
+        self.assertEqual(
+            list(RobotStateHistory.objects.order_by("timestamp").values_list("state", flat=True)),
+            [{"v": 1}, {"v": 2}, {"v": 3}],
+        )
+        self.assertEqual(RobotCurrentState.objects.get(robot=self.robot).state, {"v": 3})
+
+    def test_rejected_row_is_retried_then_dead_lettered(self):
+        bulk_create = RobotStateHistory.objects.bulk_create
+        with mock.patch.object(RobotStateHistory.objects, "bulk_create", side_effect=reject_bad_rows(bulk_create)):
+            stats = write_state_history({"r1": [self.sample(1), self.sample(2, bad=True), self.sample(3)]})
+            # 同じバッチの正常な行は1行ずつ書き直される
+            self.assertEqual(stats["rows"], 2)
+            self.assertEqual(RobotStateHistory.objects.count(), 2)
+            failed = stats["failed"]["r1"]
+            self.assertEqual([(row["state"], row["attempts"]) for row in failed], [({"bad": True}, 1)])
+
+            stats = write_state_history({"r1": failed + [self.sample(4)]})
+            self.assertEqual(stats["failed"]["r1"][0]["attempts"], 2)
+            self.assertFalse(RobotStateDeadLetter.objects.exists())
+
+            stats = write_state_history({"r1": stats["failed"]["r1"]})
+        self.assertEqual((stats["failed"], stats["dead_lettered"]), ({}, 1))
+        dead_letter = RobotStateDeadLetter.objects.get()
+        self.assertEqual((dead_letter.unique_robot_id, dead_letter.attempts), ("r1", 3))
+        self.assertEqual(dead_letter.timestamp, self.sample(2)["timestamp"])
+        self.assertIn("rejected", dead_letter.error)
+        self.assertEqual(RobotStateHistory.objects.count(), 3)
+
+
+@override_settings(ROBOT_STATE_SCHEMA={}, ROBOT_FLUSH_MAX_ATTEMPTS=2)
+class FlushRobotsTests(TransactionTestCase):
+    # SharedTasks.flush_robots が書き込めなかった行をバッファと先行書き込みログに戻す
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=owner)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.buffer = InMemoryStateBuffer()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.spool = StateSpool(root)
+        self.spool.open()
+        self.addCleanup(self.spool.close)
+        for target, value in (("get_state_buffer", self.buffer), ("get_spool", self.spool)):
+            patcher = mock.patch.object(consumers, target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sample(self, second, **state):
+        return {"state": state or {"v": second}, "timestamp": self.start + timedelta(seconds=second)}
+
+    async def append(self, samples):
+        self.spool.append("r1", samples)
+        await self.buffer.append_history("r1", samples)
+
+    async def test_failed_rows_are_requeued_until_dead_lettered(self):
+        await self.append([self.sample(1), self.sample(2, bad=True)])
+        bulk_create = RobotStateHistory.objects.bulk_create
+        with mock.patch.object(RobotStateHistory.objects, "bulk_create", side_effect=reject_bad_rows(bulk_create)):
+            stats = await consumers.SharedTasks.flush_robots()
+            self.assertEqual(stats["rows"], 1)
+            # 失敗した行だけがキャッシュと新しいセグメントに残る
+            requeued = [dict(self.sample(2, bad=True), attempts=1)]
+            self.assertEqual(read_segments(self.spool.directory), {"r1": requeued})
+            self.assertEqual(self.buffer.robot_cache, {"r1": requeued})
+
+            stats = await consumers.SharedTasks.flush_robots()
+        self.assertEqual(stats["dead_lettered"], 1)
+        self.assertFalse(await self.buffer.has_history())
+        self.assertEqual(read_segments(self.spool.directory), {})
+        self.assertEqual(await RobotStateDeadLetter.objects.acount(), 1)
+
+    async def test_sealed_segment_is_synced_off_the_event_loop(self):
+        await self.append([self.sample(1)])
+        synced = []
+        with mock.patch("api.spool.os.fsync", side_effect=lambda handle: synced.append(threading.get_ident())):
+            await consumers.SharedTasks.flush_robots()
+        self.assertEqual(len(synced), 1)
+        self.assertNotEqual(synced[0], threading.get_ident())
+
+    async def test_unreachable_database_keeps_rows_without_attempts(self):
+        samples = [self.sample(1), self.sample(2)]
+        await self.append(samples)
+        with mock.patch("api.history.resolve_robot_ids", side_effect=OperationalError("unreachable")):
+            with self.assertRaises(OperationalError):
+                await consumers.SharedTasks.flush_robots()
+        # 試行回数を数えずにキャッシュへ戻し、セグメントも削除しない
+        self.assertEqual(self.buffer.robot_cache, {"r1": samples})
+        self.assertEqual(read_segments(self.spool.directory), {"r1": samples})
+
+        stats = await consumers.SharedTasks.flush_robots()
+        self.assertEqual(stats["rows"], 2)
+        self.assertEqual(read_segments(self.spool.directory), {})
+
+
+class FrontendWriterTests(SimpleTestCase):
+    # 接続ごとの送信タスクと、送信中に届いた差分の合成
+
+    async def start(self):
+        # 非同期のテストはテストごとにイベントループが変わるので、送信タスクはテストの中で起動する
+        consumer = self.consumer = FrontendConsumer()
+        consumer.channel_name = "test"
+        consumer.use_msgpack = False
+        consumer.pending_frame = consumer.pending_fleet = consumer.pending_robots = None
+        consumer.pending_alerts = []
+        consumer.pending_since = consumer.sending_since = None
+        consumer.pending_event = asyncio.Event()
+        consumer.close = mock.AsyncMock()
+        self.sent = []
+        self.gate = asyncio.Event()  # 閉じている間はソケットへの書き込みが終わらない
+
+        async def send(text_data=None, bytes_data=None):
+            self.sent.append(json.loads(text_data))
+            await self.gate.wait()
+        consumer.send = send
+        consumer.writer = asyncio.create_task(consumer.write_loop())
+
+    async def stop(self):
+        writer = self.consumer.writer
+        self.consumer.stop_writer()
+        if writer is not None:
+            await asyncio.gather(writer, return_exceptions=True)
+
+    def delta(self, seq, *entries):
+        return group_message("send_to_client", {"type": "delta", "epoch": "e", "seq": seq, "robots": list(entries)})
+
+    async def drain(self):
+        # 書き込みを終わらせ、溜まったフレームを送らせてから送信タスクを止める
+        self.gate.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        await self.stop()
+
+    async def test_frames_during_write_are_merged_per_robot(self):
+        await self.start()
+        await self.consumer.send_to_client(self.delta(1, frontend_entry("r1", {}, {"battery": 50})))
+        await asyncio.sleep(0)  # 1件目の書き込み中
+        await self.consumer.send_to_client(self.delta(2, frontend_entry("r1", {}, {"battery": 40, "speed": 1})))
+        await self.consumer.send_to_client(self.delta(
+            3, frontend_entry("r1", {"robot_id": "a"}, {"battery": 30}, removed=["speed"]),
+            frontend_entry("r2", {}, {"battery": 90}),
+        ))
+        await self.drain()
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[0]["seq"], 1)
+        # 合成したフレームの位置は最後の delta、同じキーは後勝ち
+        merged = self.sent[1]
+        self.assertEqual((merged["type"], merged["epoch"], merged["seq"]), ("delta", "e", 3))
+        self.assertEqual(merged["robots"], [
+            {"unique_robot_id": "r1", "robot_id": "a", "state": {"battery": 30}, "removed": ["speed"]},
+            {"unique_robot_id": "r2", "state": {"battery": 90}},
+        ])
+
+    async def test_pending_alerts_are_capped(self):
+        await self.start()
+        self.consumer.MAX_PENDING_ALERTS = 3
+        await self.consumer.send_to_client(self.delta(1, frontend_entry("r1", {}, {"battery": 50})))
+        await asyncio.sleep(0)
+        for rule_id in range(5):
+            await self.consumer.send_alert(group_message("send_alert", {"type": "alert", "rule_id": rule_id}))
+        await self.drain()
+        self.assertEqual([message.get("rule_id") for message in self.sent], [None, 2, 3, 4])
+
+    @override_settings(ROBOT_FRONTEND_MAX_LAG=0.05)
+    async def test_lagging_client_is_closed(self):
+        await self.start()
+        writer = self.consumer.writer
+        await self.consumer.send_to_client(self.delta(1, frontend_entry("r1", {}, {"battery": 50})))
+        await asyncio.sleep(0.1)  # 書き込みが終わらない
+        await self.consumer.send_to_client(self.delta(2, frontend_entry("r1", {}, {"battery": 40})))
+        self.consumer.close.assert_awaited_once_with(code=FrontendConsumer.LAGGING_CLOSE_CODE)
+        self.assertIsNone(self.consumer.writer)
+        self.assertIsNone(self.consumer.pending_robots)
+        await asyncio.gather(writer, return_exceptions=True)
+
+
+class TimerWheelTests(SimpleTestCase):
+
+    def test_deadline_is_taken_from_the_next_slot(self):
+        wheel = TimerWheel(tick=1.0, size=4)
+        wheel.schedule("a", 2.5)
+        self.assertEqual(wheel.positions["a"], 3)
+        self.assertEqual(wheel.advance(2.9), [])
+        self.assertEqual(wheel.advance(3.0), ["a"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_deadline_beyond_one_revolution_stays_in_slot(self):
+        wheel = TimerWheel(tick=1.0, size=4)
+        wheel.advance(0)
+        wheel.schedule("a", 10)
+        self.assertEqual(wheel.advance(6), [])  # 同じスロットを1周前に調べても取り出さない
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(10), ["a"])
+
+    def test_reschedule_and_past_deadline(self):
+        wheel = TimerWheel(tick=1.0, size=8)
+        wheel.advance(5)
+        wheel.schedule("a", 7)
+        wheel.schedule("a", 9)  # 活動があれば期限を延ばす
+        self.assertEqual(wheel.advance(8), [])
+        self.assertEqual(wheel.advance(9), ["a"])
+        # 過ぎた期限は次の tick で取り出す
+        wheel.schedule("b", 3)
+        self.assertEqual(wheel.positions["b"], 10 % 8)
+        self.assertEqual(wheel.advance(10), ["b"])
+
+
+class FakeRobotConnection:
+    ping_interval = 60
+    pong_timeout = 10
+
+    def __init__(self):
+        self.unique_robot_id = "r1"
+        self.offline = False
+        self.send = mock.AsyncMock()
+        self.close_dead_connection = mock.AsyncMock()
+
+
+class LivenessMonitorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = 0.0
+        patcher = mock.patch("api.liveness.time.monotonic", side_effect=lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.monitor = LivenessMonitor(tick=1.0, size=16)
+        self.consumer = FakeRobotConnection()
+        self.monitor.register(self.consumer)
+
+    async def advance(self, current_time):
+        self.clock = current_time
+        for consumer in self.monitor.wheel.advance(current_time):
+            await self.monitor.check(consumer)
+
+    async def test_ping_then_close_without_pong(self):
+        await self.advance(30)
+        self.consumer.last_activity = 30  # 受信があった
+        await self.advance(60)
+        self.consumer.send.assert_not_awaited()  # 最後の受信から ping_interval まで延ばす
+        await self.advance(89)
+        self.consumer.send.assert_not_awaited()
+        await self.advance(90)
+        self.consumer.send.assert_awaited_once_with(text_data='{"type": "ping"}')
+        await self.advance(99)
+        self.consumer.close_dead_connection.assert_not_awaited()
+        await self.advance(100)
+        self.consumer.close_dead_connection.assert_awaited_once()
+        self.assertEqual(len(self.monitor.wheel), 0)
+
+    async def test_pong_keeps_connection(self):
+        await self.advance(60)
+        self.consumer.send.assert_awaited_once()
+        self.consumer.last_activity = 65  # pong
+        await self.advance(70)
+        self.consumer.close_dead_connection.assert_not_awaited()
+        self.assertIsNone(self.consumer.ping_sent_at)
+        self.assertEqual(self.monitor.wheel.slots[self.monitor.wheel.positions[self.consumer]][self.consumer], 125)
+
+
+class RobotConnectionHandoverTests(SimpleTestCase):
+    # 古い接続（応答のないまま残ったソケット）の切断で新しい接続を消さない
+
+    def connection(self):
+        consumer = RobotStateConsumer()
+        consumer.unique_robot_id = "r1"
+        consumer.owner_username = "owner"
+        consumer.offline = False
+        consumer.session_key = None
+        consumer.frames_received = 0
+        consumer.state_buffer = InMemoryStateBuffer()
+        consumer.close = mock.AsyncMock()
+        return consumer
+
+    async def test_stale_connection_does_not_evict_replacement(self):
+        stale, replacement = self.connection(), self.connection()
+        with mock.patch.dict(consumers.connected_robots, {"r1": replacement}, clear=True), \
+                mock.patch.object(consumers, "session_recorder", SessionRecorder()):
+            await stale.close_dead_connection()
+            self.assertIs(consumers.connected_robots["r1"], replacement)
+            stale.close.assert_awaited_once_with(code=RobotStateConsumer.dead_close_code)
+            # 新しい接続がある間はオフラインを配信しない
+            self.assertEqual(await stale.state_buffer.pop_frontend(), {})
+
+            await replacement.close_dead_connection()
+            self.assertNotIn("r1", consumers.connected_robots)
+            self.assertFalse((await replacement.state_buffer.pop_frontend())["r1"]["meta"]["online"])
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        bucket.updated = 0.0
+        self.assertEqual([bucket.take(0.0) for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(bucket.take(0.0), 0.5)
+        self.assertEqual(bucket.take(0.25), 0.25)  # 0.5 トークンだけ戻っている
+        self.assertEqual(bucket.take(0.5), 0.0)
+        # 長く空いても burst までしか溜まらない
+        bucket.take(100.0)
+        self.assertEqual(bucket.tokens, 2)
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    ROBOT_MAX_PENDING_HANDSHAKES=1, ROBOT_HANDSHAKE_TIMEOUT=0.01, ROBOT_RECONNECT_BACKOFF=30.0,
+)
+class AdmissionTests(SimpleTestCase):
+
+    async def test_handshake_slot_timeout(self):
+        controller = AdmissionController()
+        self.assertTrue(await controller.acquire_handshake())
+        self.assertFalse(await controller.acquire_handshake())
+        controller.release_handshake()
+        self.assertTrue(await controller.acquire_handshake())
+        controller.release_handshake()
+
+    async def test_connection_is_deferred_when_handshakes_are_full(self):
+        controller = AdmissionController()
+        await controller.acquire_handshake()
+        with mock.patch.object(consumers, "admission_controller", controller), \
+                mock.patch.object(consumers.registry, "get_robot", return_value=None):
+            communicator = WebsocketCommunicator(RobotStateConsumer.as_asgi(), "/ws/robots/?unique_robot_id=r1")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            message = await communicator.receive_json_from()
+            self.assertEqual(message["type"], "backoff")
+            self.assertTrue(1.0 <= message["retry_after"] <= 30.0)
+            self.assertEqual((await communicator.receive_output())["code"], BACKOFF_CLOSE_CODE)
+        controller.release_handshake()
+
+    @override_settings(ROBOT_THROTTLE_CLOSE_AFTER=5)
+    async def test_throttled_frames_are_dropped_and_noticed_once_a_second(self):
+        consumer = RobotStateConsumer()
+        consumer.unique_robot_id = "r1"
+        consumer.owner_username = "unknown"
+        consumer.offline = False
+        consumer.session_key = None
+        consumer.frames_received = 0
+        consumer.state_buffer = InMemoryStateBuffer()
+        consumer.rate_limit = TokenBucket(rate=0.001, burst=1)
+        consumer.throttled_frames = 0
+        consumer.throttle_notified_at = None
+        consumer.send = mock.AsyncMock()
+        consumer.close = mock.AsyncMock()
+        consumer.process_samples = mock.AsyncMock()
+
+        with mock.patch.object(consumers, "session_recorder", SessionRecorder()):
+            await consumer.receive(text_data='{"pong": true}')
+            for _ in range(3):
+                await consumer.receive(text_data='{"pong": true}')
+            notices = [json.loads(call.kwargs["text_data"]) for call in consumer.send.await_args_list]
+            self.assertEqual([notice["type"] for notice in notices], ["throttle"])
+            self.assertGreater(notices[0]["retry_after"], 0)
+
+            consumer.throttle_notified_at -= RobotStateConsumer.throttle_notice_interval
+            await consumer.receive(text_data='{"pong": true}')
+            await consumer.receive(text_data='{"pong": true}')
+            self.assertEqual(consumer.send.await_count, 2)
+            consumer.close.assert_not_awaited()
+
+            # ROBOT_THROTTLE_CLOSE_AFTER を超えたらバックオフを指示して切断する
+            await consumer.receive(text_data='{"pong": true}')
+        self.assertEqual(json.loads(consumer.send.await_args.kwargs["text_data"])["type"], "backoff")
+        consumer.close.assert_awaited_once_with(code=BACKOFF_CLOSE_CODE)
+        self.assertTrue(consumer.offline)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class CurrentStateTests(TestCase):
+    # 最新状態テーブルとダッシュボードのキャッシュ
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create(username="owner")
+        self.r1 = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=self.owner)
+        self.r2 = Robot.objects.create(unique_robot_id="r2", robot_id="b", owner=self.owner)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def at(self, second):
+        return self.start + timedelta(seconds=second)
+
+    def current(self):
+        return dict(RobotCurrentState.objects.values_list("robot__unique_robot_id", "state"))
+
+    def test_update_creates_and_only_moves_forward(self):
+        self.assertEqual(update_current_states({self.r1.pk: {"state": {"v": 1}, "timestamp": self.at(10)}}), 1)
+        cache.set(dashboard_cache_key(self.owner.id), [])
+        cache.set(detail_cache_key("r1"), self.r1)
+        changed = update_current_states({
+            self.r1.pk: {"state": {"v": 0}, "timestamp": self.at(5)},  # 古い行は反映しない
+            self.r2.pk: {"state": {"v": 2}, "timestamp": self.at(5)},
+        })
+        self.assertEqual(changed, 1)
+        self.assertEqual(self.current(), {"r1": {"v": 1}, "r2": {"v": 2}})
+        # r1 は変わっていないが、r2 と同じ所有者のダッシュボードは無効化される
+        self.assertIsNone(cache.get(dashboard_cache_key(self.owner.id)))
+        self.assertIsNotNone(cache.get(detail_cache_key("r1")))
+
+        self.assertEqual(update_current_states({self.r1.pk: {"state": {"v": 3}, "timestamp": self.at(20)}}), 1)
+        self.assertEqual(self.current()["r1"], {"v": 3})
+        self.assertIsNone(cache.get(detail_cache_key("r1")))
+
+    def test_rest_changes_invalidate_dashboard(self):
+        self.client.force_login(self.owner)
+        key = dashboard_cache_key(self.owner.id)
+
+        def dashboard_ids():
+            self.client.get("/top/")
+            return [robot["unique_robot_id"] for robot in cache.get(key)]
+
+        self.assertEqual(dashboard_ids(), ["r1", "r2"])
+        response = self.client.post("/api/robots/", {"unique_robot_id": "r3", "robot_id": "c"})
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(dashboard_ids(), ["r1", "r2", "r3"])
+
+        response = self.client.put(
+            "/api/robots/r1/", {"unique_robot_id": "r1", "robot_id": "renamed"}, content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(cache.get(key))
+        self.client.get("/top/")
+        self.assertEqual(cache.get(key)[0]["robot_id"], "renamed")
+
+        self.assertEqual(self.client.delete("/api/robots/r2/").status_code, 204)
+        self.assertEqual(dashboard_ids(), ["r1", "r3"])
+
+    def test_dashboard_does_not_read_history(self):
+        RobotStateHistory.objects.create(robot=self.r1, state={"v": 1}, timestamp=self.at(1))
+        update_current_states({self.r1.pk: {"state": {"v": 1}, "timestamp": self.at(1)}})
+        self.client.force_login(self.owner)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/top/")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if RobotStateHistory._meta.db_table in query["sql"]])
+        self.assertEqual([robot["latest_state"] for robot in response.context["robots"]], [{"v": 1}, None])
+
+    def test_backfill_command(self):
+        for second, robot in ((1, self.r1), (3, self.r1), (2, self.r2)):
+            RobotStateHistory.objects.create(robot=robot, state={"v": second}, timestamp=self.at(second))
+        update_current_states({self.r1.pk: {"state": {"v": 0}, "timestamp": self.at(0)}})
+
+        call_command("backfill_current_state", "--chunk-size", "1", stdout=open(os.devnull, "w"))
+        # 記録済みの r1 はそのまま
+        self.assertEqual(self.current(), {"r1": {"v": 0}, "r2": {"v": 2}})
+        call_command("backfill_current_state", "--all", stdout=open(os.devnull, "w"))
+        self.assertEqual(self.current(), {"r1": {"v": 3}, "r2": {"v": 2}})
+
+
+@override_settings(ROBOT_SESSION_STALE_SECONDS=60, SECURE_SSL_REDIRECT=False)
+class ConnectionSessionTests(TestCase):
+    # 接続セッションのまとめ書き
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.robot = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=self.owner)
+        self.recorder = SessionRecorder()
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def at(self, second):
+        return self.start + timedelta(seconds=second)
+
+    def flush(self, second):
+        return write_sessions(self.recorder.take(), current_time=self.at(second))
+
+    def session(self, session_key):
+        return RobotConnectionSession.objects.get(session_key=session_key)
+
+    def test_open_and_close_in_one_flush_is_written_closed(self):
+        session_key = self.recorder.open(self.robot.pk, self.at(0))
+        with mock.patch("api.sessions.now", return_value=self.at(5)):
+            self.recorder.close(session_key, 1000, 7)
+        self.assertEqual(self.flush(10), {"opened": 1, "closed": 0, "expired": 0})
+        session = self.session(session_key)
+        self.assertEqual((session.disconnected_at, session.last_seen_at), (self.at(5), self.at(5)))
+        self.assertEqual((session.close_code, session.messages), (1000, 7))
+        self.robot.refresh_from_db()
+        self.assertEqual(self.robot.last_connected, self.at(0))
+        self.assertFalse(self.recorder.has_pending())
+
+    def test_heartbeat_and_close_in_later_flush(self):
+        session_key = self.recorder.open(self.robot.pk, self.at(0))
+        self.flush(10)
+        self.assertEqual(self.session(session_key).last_seen_at, self.at(10))
+        # 接続中のセッションは flush ごとに生存を記録する
+        self.assertTrue(self.recorder.has_pending())
+        self.flush(40)
+        self.assertEqual(self.session(session_key).last_seen_at, self.at(40))
+
+        with mock.patch("api.sessions.now", return_value=self.at(45)):
+            self.recorder.close(session_key, 4004, 3)
+        self.assertEqual(self.flush(50)["closed"], 1)
+        session = self.session(session_key)
+        self.assertEqual((session.disconnected_at, session.last_seen_at, session.close_code), (self.at(45), self.at(45), 4004))
+        self.assertFalse(self.recorder.has_pending())
+
+    def test_stale_sessions_are_closed_at_last_heartbeat(self):
+        crashed = RobotConnectionSession.objects.create(
+            robot=self.robot, session_key=uuid.uuid4(), connected_at=self.at(0), last_seen_at=self.at(10),
+        )
+        recent = RobotConnectionSession.objects.create(
+            robot=self.robot, session_key=uuid.uuid4(), connected_at=self.at(0), last_seen_at=self.at(50),
+        )
+        self.assertEqual(write_sessions({"opened": {}, "closed": {}, "active": []}, current_time=self.at(100))["expired"], 1)
+        self.assertEqual(self.session(crashed.session_key).disconnected_at, self.at(10))
+        self.assertIsNone(self.session(recent.session_key).disconnected_at)
+
+    def test_sessions_of_deleted_robots_are_skipped(self):
+        self.recorder.open(self.robot.pk + 100, self.at(0))
+        self.assertEqual(self.flush(10)["opened"], 0)
+
+    def test_rest_edit_does_not_bump_last_connected(self):
+        self.robot.last_connected = self.at(0)
+        self.robot.save()
+        self.client.force_login(self.owner)
+        response = self.client.put(
+            "/api/robots/r1/", {"unique_robot_id": "r1", "robot_id": "renamed", "last_connected": self.at(99).isoformat()},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.robot.refresh_from_db()
+        self.assertEqual((self.robot.robot_id, self.robot.last_connected), ("renamed", self.at(0)))
+
+
+@override_settings(
+    ROBOT_STATE_SCHEMA={"battery": "number", "status": "text"}, ROBOT_POSITION_FIELDS=[], SECURE_SSL_REDIRECT=False,
+    ROBOT_HISTORY_RETENTION_DAYS=1, ROBOT_HEATMAP_RETENTION_DAYS=0, ROBOT_ROLLUP_RETENTION_DAYS={"minute": 0, "hour": 0},
+)
+class StateValueTests(TestCase):
+    # 索引付けした状態のキー (RobotStateValue) と検索 API
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.other = User.objects.create(username="other")
+        self.r1 = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=self.owner)
+        self.r2 = Robot.objects.create(unique_robot_id="r2", robot_id="b", owner=self.owner)
+        self.r3 = Robot.objects.create(unique_robot_id="r3", robot_id="c", owner=self.other)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.client.force_login(self.owner)
+
+    def at(self, minutes):
+        return self.start + timedelta(minutes=minutes)
+
+    def write(self, unique_robot_id, minutes, **state):
+        return write_state_history({unique_robot_id: [{"state": state, "timestamp": self.at(minutes)}]})
+
+    def test_extract_values_by_type(self):
+        schema = {"battery": "number", "status": "text", "mode": "text", "speed": "number"}
+        values = extract_state_values(self.r1.pk, {
+            "battery": 40, "status": "x" * 300, "mode": {"nested": 1}, "speed": True, "other": 1,
+        }, self.at(0), schema)
+        self.assertEqual([(value.key, value.number, value.text) for value in values], [
+            ("battery", 40.0, None), ("status", None, "x" * 255),
+        ])
+        values = extract_state_values(self.r1.pk, {"battery": "40", "status": 3}, self.at(0), schema)
+        self.assertEqual([(value.key, value.text) for value in values], [("status", "3")])
+
+    def test_values_are_written_with_history(self):
+        self.write("r1", 0, battery=40, status="ok", speed=1)
+        self.assertEqual(
+            sorted(RobotStateValue.objects.values_list("key", "number", "text")),
+            [("battery", 40.0, None), ("status", None, "ok")],
+        )
+        # サイドテーブルに書き込めなければ履歴も書き込まない
+        with mock.patch.object(RobotStateValue.objects, "bulk_create", side_effect=OperationalError("rejected")):
+            stats = self.write("r1", 1, battery=30)
+        self.assertEqual(stats["rows"], 0)
+        self.assertEqual(len(stats["failed"]["r1"]), 1)
+        self.assertEqual(RobotStateHistory.objects.count(), 1)
+
+    def test_values_expire_with_raw_retention(self):
+        self.write("r1", 0, battery=40)
+        self.write("r1", 90, battery=30)
+        deleted = expire_history(self.at(24 * 60 + 30))
+        self.assertEqual(deleted["values"], 1)
+        self.assertEqual(list(RobotStateValue.objects.values_list("number", flat=True)), [30.0])
+
+    def test_field_robots_query(self):
+        self.write("r1", 0, battery=10)
+        self.write("r1", 10, battery=15)
+        self.write("r1", 20, battery=80)
+        self.write("r2", 5, battery=12, status="ok")
+        self.write("r3", 10, battery=5)  # 他の所有者
+        response = self.client.get("/api/state-fields/battery/robots/", {"lt": 20, "since": self.at(1).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(robot["unique_robot_id"], robot["matches"], robot["min_value"]) for robot in response.json()["robots"]],
+            [("r1", 1, 15.0), ("r2", 1, 12.0)],
+        )
+        response = self.client.get("/api/state-fields/status/robots/", {"in": "ok,error"})
+        self.assertEqual([robot["unique_robot_id"] for robot in response.json()["robots"]], ["r2"])
+
+        self.assertEqual(self.client.get("/api/state-fields/speed/robots/").status_code, 400)
+        self.assertEqual(self.client.get("/api/state-fields/battery/robots/", {"lt": "low"}).status_code, 400)
+
+    def test_robot_field_values_and_schema(self):
+        self.write("r1", 0, battery=10, flag=True)
+        self.write("r1", 10, battery=50)
+        response = self.client.get("/api/robots/r1/fields/battery/", {"gte": 20})
+        self.assertEqual([value["value"] for value in response.json()["results"]], [50.0])
+        self.assertEqual(self.client.get("/api/robots/r3/fields/battery/").status_code, 404)
+
+        response = self.client.get("/api/robots/r1/schema/")
+        self.assertEqual(response.json()["indexed"], {"battery": "number", "status": "text"})
+        self.assertEqual(response.json()["observed"], {"battery": ["number"], "flag": ["boolean"]})
+
+
+class SpatialGridTests(SimpleTestCase):
+
+    def test_moves_and_removal(self):
+        grid = SpatialGrid(cell_size=1.0)
+        grid.update("r1", "owner", 0.2, 0.2)
+        grid.update("r1", "owner", 0.8, 0.9)  # 同じセル内の移動
+        self.assertEqual(grid.cells, {(0, 0): {"r1"}})
+        grid.update("r1", "owner", -0.5, 2.5)  # セルをまたぐ移動
+        self.assertEqual(grid.cells, {(-1, 2): {"r1"}})
+        self.assertEqual(grid.within(-1, 2, 0, 3), [("r1", -0.5, 2.5)])
+        grid.remove("r1")
+        grid.remove("r1")
+        self.assertEqual((grid.cells, len(grid)), ({}, 0))
+
+    def test_box_and_radius_queries(self):
+        grid = SpatialGrid(cell_size=1.0)
+        grid.update("r1", "owner", 1.0, 1.0)
+        grid.update("r2", "owner", 2.5, 1.0)
+        grid.update("r3", "owner", 1.5, 1.2)
+        grid.update("r4", "other", 1.1, 1.1)
+        grid.update("r5", "owner", 9.0, 9.0)
+        self.assertEqual(sorted(grid.within(3, 2, 0, 0, owner="owner")), [("r1", 1.0, 1.0), ("r2", 2.5, 1.0), ("r3", 1.5, 1.2)])
+
+        nearby = grid.nearby(1.0, 1.0, 1.0, owner="owner")
+        self.assertEqual([robot[0] for robot in nearby], ["r1", "r3"])  # 近い順、半径の外 (r2) は含まない
+        self.assertEqual([robot[0] for robot in grid.nearby(1.0, 1.0, 2.0, limit=2)], ["r1", "r4"])
+
+        # 範囲のセル数が使用中のセル数より多い場合は使用中のセルを走査する（範囲のセルを列挙すると終わらない）
+        self.assertEqual(len(grid.within(-1e9, -1e9, 1e9, 1e9)), 5)
+
+
+@override_settings(
+    ROBOT_POSITION_FIELDS=["pos_x", "pos_y"], ROBOT_HEATMAP_TILE_SIZE=10.0, ROBOT_HEATMAP_TILE_CELLS=4,
+    ROBOT_STATE_SCHEMA={}, SECURE_SSL_REDIRECT=False,
+)
+class HeatmapTests(TestCase):
+    # 位置のヒートマップ（ロールアップと同じ処理で集計する）と位置の検索 API
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.robot = Robot.objects.create(unique_robot_id="r1", robot_id="a", owner=self.owner)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.client.force_login(self.owner)
+
+    def add(self, minutes, x, y):
+        RobotStateHistory.objects.create(
+            robot=self.robot, state={"pos_x": x, "pos_y": y}, timestamp=self.start + timedelta(minutes=minutes),
+        )
+
+    def test_tiles_are_accumulated_by_rollups(self):
+        self.add(0, 1.0, 1.0)  # タイル (0, 0) セル 0
+        self.add(1, 2.0, 2.0)  # タイル (0, 0) セル 0
+        self.add(2, 9.9, 1.0)  # タイル (0, 0) セル 3
+        self.add(3, -1.0, 12.0)  # タイル (-1, 1)
+        self.add(70, 1.0, 1.0)  # 次の1時間
+        build_rollups(commit_lag=0)
+        self.add(4, 1.0, 6.0)  # タイル (0, 0) セル 8（既存のタイルに加算する）
+        build_rollups(commit_lag=0)
+
+        tile = RobotHeatmapTile.objects.get(bucket_start=self.start, tile_x=0, tile_y=0)
+        self.assertEqual((tile.count, tile.cells), (4, {"0": 2, "3": 1, "8": 1}))
+        self.assertEqual(RobotHeatmapTile.objects.count(), 3)
+
+        heatmap = query_heatmap(self.owner, until=self.start + timedelta(hours=1), bounds=(0, 0, 5, 5))
+        self.assertEqual(heatmap["tiles"], [{"tile_x": 0, "tile_y": 0, "count": 4, "cells": {0: 2, 3: 1, 8: 1}}])
+        # zoom=1 では 2x2 のセルをまとめる（4x4 -> 2x2）
+        response = self.client.get("/api/heatmap/", {"zoom": 1, "x0": 0, "y0": 0, "x1": 5, "y1": 5})
+        self.assertEqual(response.json()["cells"], 2)
+        self.assertEqual(response.json()["tiles"], [{"tile_x": 0, "tile_y": 0, "count": 5, "cells": {"0": 3, "1": 1, "2": 1}}])
+        self.assertEqual(self.client.get("/api/heatmap/", {"zoom": 3}).status_code, 400)
+        self.assertEqual(self.client.get("/api/heatmap/", {"x0": 0}).status_code, 400)
+
+    def test_positions_view(self):
+        grid = SpatialGrid(cell_size=1.0)
+        grid.update("r1", "owner", 1.0, 1.0)
+        grid.update("r2", "owner", 3.0, 1.0)
+        grid.update("r3", "other", 1.0, 1.0)
+        with mock.patch("api.views.get_spatial_index", return_value=grid):
+            response = self.client.get("/api/positions/", {"x0": 0, "y0": 0, "x1": 5, "y1": 5})
+            self.assertEqual([robot["unique_robot_id"] for robot in response.json()["robots"]], ["r1", "r2"])
+            response = self.client.get("/api/positions/", {"x": 3, "y": 1, "radius": 5, "limit": 1})
+            self.assertEqual(
+                [(robot["unique_robot_id"], robot["distance"]) for robot in response.json()["robots"]], [("r2", 0.0)],
+            )
+            self.assertEqual(self.client.get("/api/positions/", {"x": 0, "y": 0, "radius": -1}).status_code, 400)
+            self.assertEqual(self.client.get("/api/positions/", {"x0": 0, "y0": 0, "x1": "nan", "y1": 1}).status_code, 400)
+
+
+@override_settings(ROBOT_REGISTRY_TTL=60.0, ROBOT_REGISTRY_MAX_SIZE=2)
+class RobotRegistryTests(SimpleTestCase):
+    # ロボット識別情報のプロセス内キャッシュ
+
+    def setUp(self):
+        self.clock = 0.0
+        for patcher in (
+            mock.patch.dict(registry.robot_registry, clear=True),
+            mock.patch("api.registry.time.monotonic", side_effect=lambda: self.clock),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def register(self, unique_robot_id, robot_id="a", owner="owner"):
+        robot = Robot(id=len(registry.robot_registry) + 1, unique_robot_id=unique_robot_id, robot_id=robot_id)
+        robot.owner = User(username=owner)
+        return registry.register_robot(robot)
+
+    def test_hit_miss_and_invalidate(self):
+        self.assertIsNone(registry.get_robot("r1"))
+        entry = self.register("r1")
+        self.assertIs(registry.get_robot("r1"), entry)
+        self.assertTrue(entry["resolved"])
+        self.assertFalse(self.register("r2", owner=registry.UNKNOWN)["resolved"])
+        registry.invalidate_robot("r1")
+        registry.invalidate_robot("r1")
+        self.assertIsNone(registry.get_robot("r1"))
+
+    def test_entries_expire(self):
+        # 他のワーカーで変更・削除されたロボットも TTL 後には DB から読み直す
+        self.register("r1")
+        self.clock = 59.0
+        self.assertIsNotNone(registry.get_robot("r1"))
+        self.clock = 60.0
+        self.assertIsNone(registry.get_robot("r1"))
+        self.assertNotIn("r1", registry.robot_registry)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.register("r1")
+        self.register("r2")
+        registry.get_robot("r1")
+        self.register("r3")
+        self.assertEqual(list(registry.robot_registry), ["r1", "r3"])
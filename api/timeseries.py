@@ -0,0 +1,204 @@
+from django.conf import settings
+from django.db.models import Q, Min, Max, Sum
+from django.utils.timezone import now
+from .models import RobotStateHistory, RobotStateRollup
+from .history import ROLLUP_RESOLUTIONS, bucket_start, numeric_fields
+from array import array
+from datetime import datetime, timedelta
+from itertools import chain
+import logging
+
+logger = logging.getLogger(__name__)
+
+SERIES_METHODS = ("lttb", "average")
+SERIES_DEFAULT_POINTS = 500
+SERIES_MAX_POINTS = 5000
+SERIES_CHUNK_SIZE = 2000  # サーバーサイドカーソルで1回に読む行数
+REPLAY_CHUNK_SIZE = 500  # リプレイで1回に読む行数
+
+
+def series_queryset(robot, since=None, until=None):
+    queryset = RobotStateHistory.objects.filter(robot=robot)
+    if since:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until:
+        queryset = queryset.filter(timestamp__lt=until)
+    return queryset
+
+
+def series_resolution(since, until=None, points=SERIES_DEFAULT_POINTS, current_time=None):
+    # 時系列を読むロールアップの集計単位（生データから読む場合は None）
+    # 1点あたりの幅が集計単位以上なら、その中で最も粗い集計単位で足りる
+    # 生データの保持期間より前を含む期間は、1点あたりの幅によらず残っている最も細かい集計単位から読む
+    if since is None:
+        return None
+    current_time = current_time or now()
+    width = ((until or current_time) - since) / points
+    covered = [
+        resolution for resolution in ROLLUP_RESOLUTIONS
+        if not settings.ROBOT_ROLLUP_RETENTION_DAYS.get(resolution)
+        or since >= current_time - timedelta(days=settings.ROBOT_ROLLUP_RETENTION_DAYS[resolution])
+    ]
+    coarse = [resolution for resolution in covered if ROLLUP_RESOLUTIONS[resolution] <= width]
+    if coarse:
+        return coarse[-1]
+    retention_days = settings.ROBOT_HISTORY_RETENTION_DAYS
+    if covered and retention_days and since < current_time - timedelta(days=retention_days):
+        return covered[0]
+    return None
+
+
+def rollup_queryset(robot, resolution, since=None, until=None):
+    queryset = RobotStateRollup.objects.filter(robot=robot, resolution=resolution)
+    if since:
+        queryset = queryset.filter(bucket_start__gte=bucket_start(since, resolution))
+    if until:
+        queryset = queryset.filter(bucket_start__lt=until)
+    return queryset
+
+
+def rollup_rows(queryset):
+    # 区間ごとの平均値を、区間の開始時刻のサンプルとして返す
+    rows = queryset.order_by("bucket_start").values_list("bucket_start", "stats").iterator(chunk_size=SERIES_CHUNK_SIZE)
+    for timestamp, stats in rows:
+        yield timestamp, {field: value["sum"] / value["count"] for field, value in stats.items() if value["count"]}
+
+
+def lttb_indices(xs, ys, threshold):
+    # Largest-Triangle-Three-Buckets: 見た目の形を保ったまま threshold 点に間引く
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+    selected = 0
+    indices = [0]
+    for i in range(threshold - 2):
+        # 次のバケットの平均点
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_count = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / avg_count
+        avg_y = sum(ys[avg_start:avg_end]) / avg_count
+
+        # 現在のバケットから、前に選んだ点と次のバケットの平均点とで作る三角形が最大の点を選ぶ
+        ax, ay = xs[selected], ys[selected]
+        max_area = -1.0
+        next_selected = int(i * every) + 1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                next_selected = j
+        indices.append(next_selected)
+        selected = next_selected
+    indices.append(n - 1)
+    return indices
+
+
+def _epoch(timestamp):
+    return timestamp.timestamp()
+
+
+def _iso(epoch, tz):
+    return datetime.fromtimestamp(epoch, tz=tz).isoformat()
+
+
+def downsample_lttb(rows, fields, points):
+    # フィールドごとに (時刻, 値) を配列に溜めてから間引く
+    columns = {field: (array("d"), array("d")) for field in fields}
+    raw_count = 0
+    tz = None
+    for timestamp, state in rows:
+        raw_count += 1
+        tz = tz or timestamp.tzinfo
+        values = numeric_fields(state)
+        for field, (xs, ys) in columns.items():
+            if field in values:
+                xs.append(_epoch(timestamp))
+                ys.append(float(values[field]))
+
+    series = {}
+    for field, (xs, ys) in columns.items():
+        series[field] = [[_iso(xs[i], tz), ys[i]] for i in lttb_indices(xs, ys, points)]
+    return raw_count, series
+
+
+def downsample_average(rows, fields, points, start, end):
+    # [start, end) を points 個の等間隔バケットに分けて平均する（全フィールドで同じ時刻軸になる）
+    start_epoch = _epoch(start)
+    width = max((_epoch(end) - start_epoch) / points, 1e-6)
+    sums = {field: [0.0] * points for field in fields}
+    counts = {field: [0] * points for field in fields}
+    raw_count = 0
+    for timestamp, state in rows:
+        raw_count += 1
+        index = min(points - 1, max(0, int((_epoch(timestamp) - start_epoch) / width)))
+        values = numeric_fields(state)
+        for field in fields:
+            if field in values:
+                sums[field][index] += values[field]
+                counts[field][index] += 1
+
+    series = {}
+    for field in fields:
+        series[field] = [
+            [_iso(start_epoch + index * width, start.tzinfo), sums[field][index] / counts[field][index]]
+            for index in range(points)
+            if counts[field][index]
+        ]
+    return raw_count, series
+
+
+def query_series(robot, fields, since=None, until=None, points=SERIES_DEFAULT_POINTS, method="lttb"):
+    # 指定期間の数値フィールドを表示解像度に間引いた時系列を返す
+    # 生データの保持期間より前を含む期間や、1点あたりの幅が集計単位以上の期間はロールアップから読む
+    resolution = series_resolution(since, until, points)
+    rollups = None
+    rollup_count = rollup_buckets = 0
+    first = last = None
+    raw_since = since
+    if resolution:
+        rollups = rollup_queryset(robot, resolution, since, until)
+        latest = rollups.aggregate(latest=Max("bucket_start"))["latest"]
+        if latest is not None:
+            # 最新の区間はまだ集計中の可能性があるので、その区間以降は生データから読む
+            rollups = rollups.filter(bucket_start__lt=latest)
+            raw_since = latest
+            summary = rollups.aggregate(first=Min("bucket_start"), last=Max("bucket_start"), count=Sum("count"))
+            if summary["first"] is not None:
+                first, last = summary["first"], summary["last"]
+                rollup_count = summary["count"]
+                rollup_buckets = rollups.count()
+
+    queryset = series_queryset(robot, raw_since, until)
+    bounds = queryset.aggregate(first=Min("timestamp"), last=Max("timestamp"))
+    first = first or bounds["first"]
+    last = bounds["last"] or last
+    if first is None:
+        return {"source": resolution or "raw", "raw_count": 0, "series": {field: [] for field in fields}}
+
+    rows = queryset.order_by("timestamp").values_list("timestamp", "state").iterator(chunk_size=SERIES_CHUNK_SIZE)
+    if rollup_buckets:
+        rows = chain(rollup_rows(rollups), rows)
+    if method == "average":
+        start = since or first
+        end = until or last
+        if end <= start:
+            end = start + timedelta(seconds=1)
+        count, series = downsample_average(rows, fields, points, start, end)
+    else:
+        count, series = downsample_lttb(rows, fields, points)
+    # ロールアップの区間は集計したサンプル数で数える
+    return {"source": resolution or "raw", "raw_count": count - rollup_buckets + rollup_count, "series": series}
+
+
+def replay_rows(robot_pk, after, until=None, limit=REPLAY_CHUNK_SIZE):
+    # after: (timestamp, id) より後の行を時刻順に返す（同じ時刻の行を取りこぼさないよう id も使う）
+    timestamp, history_id = after
+    queryset = RobotStateHistory.objects.filter(robot_id=robot_pk).filter(
+        Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=history_id)
+    )
+    if until:
+        queryset = queryset.filter(timestamp__lt=until)
+    return list(queryset.order_by("timestamp", "id").values_list("id", "timestamp", "state")[:limit])
@@ -13,8 +13,19 @@ urlpatterns = [
     
     # API endpoints
     path('api/robots/', views.RobotListCreateAPIView.as_view(), name='robot_list_api'), 
+    path('api/history/export/', views.RobotStateHistoryExportAPIView.as_view(), name='robot_state_history_export_api'),
     path('api/robots/<str:unique_robot_id>/', views.RobotDetailAPIView.as_view(), name='robot_detail_api'),
     path('api/robots/<str:unique_robot_id>/history/', views.RobotStateHistoryAPIView.as_view(), name='robot_state_history_api'),
+    path('api/robots/<str:unique_robot_id>/rollups/', views.RobotStateRollupAPIView.as_view(), name='robot_state_rollup_api'),
+    path('api/robots/<str:unique_robot_id>/series/', views.RobotStateSeriesAPIView.as_view(), name='robot_state_series_api'),
+    path('api/robots/<str:unique_robot_id>/schema/', views.RobotStateSchemaAPIView.as_view(), name='robot_state_schema_api'),
+    path('api/robots/<str:unique_robot_id>/fields/<str:key>/', views.RobotStateValueAPIView.as_view(), name='robot_state_value_api'),
+    path('api/state-fields/<str:key>/robots/', views.RobotStateFieldRobotsAPIView.as_view(), name='robot_state_field_robots_api'),
+    path('api/positions/', views.RobotPositionAPIView.as_view(), name='robot_position_api'),
+    path('api/heatmap/', views.RobotHeatmapAPIView.as_view(), name='robot_heatmap_api'),
+    path('api/alert-rules/', views.AlertRuleListCreateAPIView.as_view(), name='alert_rule_list_api'),
+    path('api/alert-rules/<int:pk>/', views.AlertRuleDetailAPIView.as_view(), name='alert_rule_detail_api'),
+    path('api/robots/<str:unique_robot_id>/sessions/', views.RobotConnectionSessionAPIView.as_view(), name='robot_connection_session_api'),
 ]
 
 
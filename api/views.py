@@ -2,18 +2,109 @@ from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth import login
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import StreamingHttpResponse, HttpResponse, Http404
+from django.conf import settings
+from asgiref.sync import async_to_sync
 from django.utils.safestring import mark_safe
-from django.utils.timezone import localtime
-from django.db.models import Max
+from django.utils.timezone import is_naive, make_aware
 from django.views.generic import DetailView, TemplateView, FormView
 from django.urls import reverse_lazy
+from django.db.models import Count, Min, Max
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.generics import RetrieveUpdateDestroyAPIView, ListCreateAPIView, ListAPIView
-from rest_framework.pagination import PageNumberPagination
-from .models import Robot, RobotStateHistory
-from .serializers import RobotSerializer, RobotStateHistorySerializer
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.pagination import CursorPagination
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from .models import Robot, RobotStateHistory, RobotStateRollup, RobotConnectionSession, RobotStateValue, AlertRule
+from .serializers import (
+    RobotSerializer, RobotStateHistorySerializer, RobotStateRollupSerializer, RobotConnectionSessionSerializer,
+    RobotStateValueSerializer, AlertRuleSerializer,
+)
+from .schema import get_state_schema, describe_states
+from .current_state import get_dashboard_robots, get_detail_robot, invalidate_robot_cache
+from . import registry
+from . import metrics
+from .buffers import get_state_buffer
+from .timeseries import query_series, SERIES_METHODS, SERIES_DEFAULT_POINTS, SERIES_MAX_POINTS
+from .exports import EXPORT_CONTENT_TYPES, export_queryset, iter_export, aiter_export, parquet_available
+from .spatial import get_spatial_index, query_heatmap
 import json
+import math
+import logging
 
+logger = logging.getLogger(__name__)
+
+
+# since / until クエリパラメータで期間を絞り込む
+def parse_datetime_param(query_params, param):
+    value = query_params.get(param)
+    if not value:
+        return None
+    try:
+        timestamp = parse_datetime(value)
+    except ValueError:
+        # 形式は正しいが存在しない日時（2025-13-40 など）
+        timestamp = None
+    if timestamp is None:
+        raise ValidationError({param: "ISO 8601 形式の日時を指定してください。"})
+    return make_aware(timestamp) if is_naive(timestamp) else timestamp
+
+def filter_time_range(queryset, query_params, field="timestamp"):
+    since = parse_datetime_param(query_params, "since")
+    until = parse_datetime_param(query_params, "until")
+    if since:
+        queryset = queryset.filter(**{f"{field}__gte": since})
+    if until:
+        queryset = queryset.filter(**{f"{field}__lt": until})
+    return queryset
+
+NUMBER_LOOKUPS = ("lt", "lte", "gt", "gte")
+
+def get_indexed_field_type(key):
+    field_type = get_state_schema().get(key)
+    if field_type is None:
+        raise ValidationError({"key": f"'{key}' は ROBOT_STATE_SCHEMA で索引付けされていません。"})
+    return field_type
+
+def filter_state_values(queryset, query_params, field_type):
+    # ?lt= / ?lte= / ?gt= / ?gte= / ?eq=（text は ?eq= と カンマ区切りの ?in=）
+    if field_type == "number":
+        for lookup in NUMBER_LOOKUPS + ("eq",):
+            value = query_params.get(lookup)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValidationError({lookup: "数値を指定してください。"})
+            queryset = queryset.filter(**{"number" if lookup == "eq" else f"number__{lookup}": value})
+        return queryset.filter(number__isnull=False)
+    if query_params.get("eq") is not None:
+        queryset = queryset.filter(text=query_params["eq"])
+    if query_params.get("in"):
+        queryset = queryset.filter(text__in=query_params["in"].split(","))
+    return queryset.filter(text__isnull=False)
+
+def parse_float_params(query_params, params, required=True):
+    # 数値のクエリパラメータをまとめて読む（required=False で省略時は None）
+    values = []
+    for param in params:
+        value = query_params.get(param)
+        if value is None:
+            if required:
+                raise ValidationError({param: "数値を指定してください。"})
+            values.append(None)
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValidationError({param: "数値を指定してください。"})
+        if not math.isfinite(value):
+            raise ValidationError({param: "有限の数値を指定してください。"})
+        values.append(value)
+    return values
 
 # ダッシュボード
 class RobotDashboardView(LoginRequiredMixin, TemplateView):
@@ -21,35 +112,18 @@ class RobotDashboardView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        robots = Robot.objects.filter(owner=self.request.user)
-
-        latest_timestamps = (
-            RobotStateHistory.objects.filter(robot__in=robots)
-            .values("robot_id")  
-            .annotate(latest_timestamp=Max("timestamp")) 
-        )
+        # 最新状態は RobotCurrentState から取得し、結果はキャッシュする（履歴テーブルは集計しない）
+        robots = get_dashboard_robots(self.request.user)
 
-        latest_timestamps_map = {
-            entry["robot_id"]: entry["latest_timestamp"]
-            for entry in latest_timestamps
-        }
-        
         robots_json = [
             {
-                "unique_robot_id": robot.unique_robot_id,
-                "robot_id": robot.robot_id,
-                "last_connected": localtime(robot.last_connected).strftime("%Y/%m/%d %H:%M:%S") if robot.last_connected else "Never",
+                "unique_robot_id": robot["unique_robot_id"],
+                "robot_id": robot["robot_id"],
+                "last_connected": robot["last_connected"],
             }
             for robot in robots
         ]
 
-        for robot in robots:
-            robot.latest_timestamp = (
-                localtime(latest_timestamps_map.get(robot.id)).strftime("%Y/%m/%d %H:%M:%S")
-                if latest_timestamps_map.get(robot.id)
-                else "No Data"
-            )
-
         context["robots"] = robots
         context["robots_json"] = mark_safe(json.dumps(robots_json))
         return context
@@ -61,16 +135,9 @@ class RobotDetailView(DetailView):
     context_object_name = 'robot'
 
     def get_object(self, queryset=None):
-        unique_robot_id = self.kwargs.get('unique_robot_id')
-        robot = get_object_or_404(Robot, unique_robot_id=unique_robot_id)
-
-        # 最新のtimestampを取得
-        latest_state = RobotStateHistory.objects.filter(robot=robot).aggregate(latest_timestamp=Max('timestamp'))
-        robot.latest_timestamp = (
-            localtime(latest_state['latest_timestamp']).strftime("%Y/%m/%d %H:%M:%S")
-            if latest_state['latest_timestamp']
-            else "No Data"
-        )
+        robot = get_detail_robot(self.kwargs.get('unique_robot_id'))
+        if robot is None:
+            raise Http404("Robot not found")
         return robot
 
 # サインアップ
@@ -96,6 +163,7 @@ class RobotListCreateAPIView(ListCreateAPIView):
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
+        invalidate_robot_cache(serializer.instance.unique_robot_id, self.request.user.id)
 
 # ロボット詳細取得、更新、削除
 class RobotDetailAPIView(RetrieveUpdateDestroyAPIView):
@@ -103,22 +171,327 @@ class RobotDetailAPIView(RetrieveUpdateDestroyAPIView):
     queryset = Robot.objects.all()
     serializer_class = RobotSerializer
     permission_classes = [IsAuthenticated]
+    lookup_field = "unique_robot_id"
 
     def get_queryset(self):
         return Robot.objects.filter(owner=self.request.user)
 
     def perform_update(self, serializer):
         serializer.save(owner=self.request.user)
+        # 接続中のコンシューマーが次のメッセージで最新の情報を読み直すようにする
+        registry.invalidate_robot(serializer.instance.unique_robot_id)
+        invalidate_robot_cache(serializer.instance.unique_robot_id, self.request.user.id)
+
+    def perform_destroy(self, instance):
+        unique_robot_id = instance.unique_robot_id
+        instance.delete()
+        registry.invalidate_robot(unique_robot_id)
+        invalidate_robot_cache(unique_robot_id, self.request.user.id)
+
+# 履歴のキーセットページネーション（COUNT(*) や OFFSET を使わない）
+class RobotStateHistoryPagination(CursorPagination):
+    # 同じ時刻の行の順序が問い合わせごとに変わると重複や抜けが出るので、id でも並べる
+    ordering = ("-timestamp", "-id")
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+class RobotStateRollupPagination(RobotStateHistoryPagination):
+    ordering = "-bucket_start"
+
+class RobotConnectionSessionPagination(RobotStateHistoryPagination):
+    ordering = "-connected_at"
 
 #ロボット履歴取得
 class RobotStateHistoryAPIView(ListAPIView):
 
     serializer_class = RobotStateHistorySerializer
-    pagination_class = PageNumberPagination
+    pagination_class = RobotStateHistoryPagination
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
         unique_robot_id = self.kwargs['unique_robot_id']
-        robot = Robot.objects.filter(unique_robot_id=unique_robot_id, owner=self.request.user).first()
-        robot = get_object_or_404(Robot, unique_robot_id=unique_robot_id, owner=self.request.user)
-        return RobotStateHistory.objects.filter(robot=robot)
+        self.robot = get_object_or_404(Robot.objects.select_related("owner"), unique_robot_id=unique_robot_id, owner=self.request.user)
+        queryset = RobotStateHistory.objects.filter(robot=self.robot)
+        return filter_time_range(queryset, self.request.query_params)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        fields = self.request.query_params.get("fields")
+        context["state_fields"] = [field for field in fields.split(",") if field] if fields else None
+        return context
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        # 全行が同じロボットなので、行ごとに robot を引かずに取得済みのインスタンスを使う
+        for history in page or []:
+            history.robot = self.robot
+        return page
+
+# ロボット履歴のロールアップ取得（長期間の参照用）
+class RobotStateRollupAPIView(ListAPIView):
+
+    serializer_class = RobotStateRollupSerializer
+    pagination_class = RobotStateRollupPagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        robot = get_object_or_404(Robot, unique_robot_id=self.kwargs['unique_robot_id'], owner=self.request.user)
+        resolution = self.request.query_params.get("resolution", "hour")
+        if resolution not in dict(RobotStateRollup.RESOLUTION_CHOICES):
+            raise ValidationError({"resolution": "minute または hour を指定してください。"})
+
+        queryset = RobotStateRollup.objects.filter(robot=robot, resolution=resolution)
+        return filter_time_range(queryset, self.request.query_params, "bucket_start")
+
+# ロボット履歴の時系列（表示解像度に間引いたもの）
+class RobotStateSeriesAPIView(APIView):
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, unique_robot_id):
+        robot = get_object_or_404(Robot, unique_robot_id=unique_robot_id, owner=request.user)
+
+        fields = request.query_params.get("fields")
+        fields = [field for field in fields.split(",") if field] if fields else None
+        if not fields:
+            raise ValidationError({"fields": "数値フィールドをカンマ区切りで指定してください。"})
+        method = request.query_params.get("method", "lttb")
+        if method not in SERIES_METHODS:
+            raise ValidationError({"method": f"{', '.join(SERIES_METHODS)} のいずれかを指定してください。"})
+        try:
+            points = int(request.query_params.get("points", SERIES_DEFAULT_POINTS))
+        except ValueError:
+            raise ValidationError({"points": "整数を指定してください。"})
+        if not 3 <= points <= SERIES_MAX_POINTS:
+            raise ValidationError({"points": f"3 から {SERIES_MAX_POINTS} の範囲で指定してください。"})
+
+        since = parse_datetime_param(request.query_params, "since")
+        until = parse_datetime_param(request.query_params, "until")
+        result = query_series(robot, fields, since=since, until=until, points=points, method=method)
+        return Response({
+            "unique_robot_id": robot.unique_robot_id,
+            "method": method,
+            "points": points,
+            **result,
+        })
+
+# 索引付けした状態のキーで条件に合うロボットを検索する
+# 例: /api/state-fields/battery/robots/?lt=20&since=<1時間前>
+class RobotStateFieldRobotsAPIView(APIView):
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, key):
+        field_type = get_indexed_field_type(key)
+        queryset = RobotStateValue.objects.filter(key=key, robot__owner=request.user)
+        queryset = filter_time_range(queryset, request.query_params)
+        queryset = filter_state_values(queryset, request.query_params, field_type)
+        robots = (
+            queryset.values("robot__unique_robot_id", "robot__robot_id")
+            .annotate(
+                matches=Count("id"),
+                first_match=Min("timestamp"),
+                last_match=Max("timestamp"),
+                min_value=Min(field_type),
+                max_value=Max(field_type),
+            )
+            .order_by("robot__unique_robot_id")
+        )
+        return Response({
+            "key": key,
+            "robots": [
+                {
+                    "unique_robot_id": robot["robot__unique_robot_id"],
+                    "robot_id": robot["robot__robot_id"],
+                    "matches": robot["matches"],
+                    "first_match": robot["first_match"],
+                    "last_match": robot["last_match"],
+                    "min_value": robot["min_value"],
+                    "max_value": robot["max_value"],
+                }
+                for robot in robots
+            ],
+        })
+
+# 索引付けした状態のキーの値（1ロボット分）
+class RobotStateValueAPIView(ListAPIView):
+
+    serializer_class = RobotStateValueSerializer
+    pagination_class = RobotStateHistoryPagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        field_type = get_indexed_field_type(self.kwargs["key"])
+        robot = get_object_or_404(Robot, unique_robot_id=self.kwargs['unique_robot_id'], owner=self.request.user)
+        queryset = RobotStateValue.objects.filter(robot=robot, key=self.kwargs["key"])
+        queryset = filter_time_range(queryset, self.request.query_params)
+        return filter_state_values(queryset, self.request.query_params, field_type)
+
+# 状態のキーと型（索引付けの設定と、最近のサンプルから抽出したもの）
+class RobotStateSchemaAPIView(APIView):
+
+    permission_classes = [IsAuthenticated]
+    sample_size = 100
+
+    def get(self, request, unique_robot_id):
+        robot = get_object_or_404(Robot, unique_robot_id=unique_robot_id, owner=request.user)
+        states = RobotStateHistory.objects.filter(robot=robot).order_by("-timestamp").values_list("state", flat=True)
+        return Response({
+            "unique_robot_id": robot.unique_robot_id,
+            "indexed": get_state_schema(),
+            "observed": describe_states(states[:self.sample_size]),
+        })
+
+# 接続中のロボットの現在位置を範囲・近傍で検索する
+# 例: /api/positions/?x0=0&y0=0&x1=10&y1=10 , /api/positions/?x=5&y=5&radius=2&limit=10
+# 索引はワーカーごとに持つため、このリクエストを処理したワーカーに接続しているロボットだけが対象になる
+# （複数ワーカー構成では結果が一部になる。応答の "scope": "worker" で示す）
+class RobotPositionAPIView(APIView):
+
+    permission_classes = [IsAuthenticated]
+    max_limit = 1000
+
+    def get(self, request):
+        index = get_spatial_index()
+        owner = request.user.username
+        if "radius" in request.query_params:
+            x, y, radius = parse_float_params(request.query_params, ("x", "y", "radius"))
+            if radius < 0:
+                raise ValidationError({"radius": "0 以上の数値を指定してください。"})
+            try:
+                limit = int(request.query_params.get("limit", self.max_limit))
+            except ValueError:
+                raise ValidationError({"limit": "整数を指定してください。"})
+            if not 1 <= limit <= self.max_limit:
+                raise ValidationError({"limit": f"1 から {self.max_limit} の範囲で指定してください。"})
+            matches = index.nearby(x, y, radius, owner=owner, limit=limit)
+            robots = [
+                {"unique_robot_id": unique_robot_id, "x": robot_x, "y": robot_y, "distance": distance}
+                for unique_robot_id, robot_x, robot_y, distance in matches
+            ]
+        else:
+            x0, y0, x1, y1 = parse_float_params(request.query_params, ("x0", "y0", "x1", "y1"))
+            robots = [
+                {"unique_robot_id": unique_robot_id, "x": robot_x, "y": robot_y}
+                for unique_robot_id, robot_x, robot_y in sorted(index.within(x0, y0, x1, y1, owner=owner))
+            ]
+        for robot in robots:
+            robot_entry = registry.get_robot(robot["unique_robot_id"])
+            robot["robot_id"] = robot_entry["robot_id"] if robot_entry else None
+        return Response({"scope": "worker", "robots": robots})
+
+# 位置のヒートマップ（所有者のロボット全体、1時間ごとの集計を期間で足し合わせたもの）
+# 例: /api/heatmap/?since=<1日前>&x0=0&y0=0&x1=20&y1=20&zoom=1
+class RobotHeatmapAPIView(APIView):
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        bounds = parse_float_params(request.query_params, ("x0", "y0", "x1", "y1"), required=False)
+        if any(value is None for value in bounds):
+            if any(value is not None for value in bounds):
+                raise ValidationError({"bounds": "x0, y0, x1, y1 は全て指定してください。"})
+            bounds = None
+        max_zoom = int(math.log2(settings.ROBOT_HEATMAP_TILE_CELLS))
+        try:
+            zoom = int(request.query_params.get("zoom", 0))
+        except ValueError:
+            raise ValidationError({"zoom": "整数を指定してください。"})
+        if not 0 <= zoom <= max_zoom:
+            raise ValidationError({"zoom": f"0 から {max_zoom} の範囲で指定してください。"})
+
+        return Response(query_heatmap(
+            request.user,
+            since=parse_datetime_param(request.query_params, "since"),
+            until=parse_datetime_param(request.query_params, "until"),
+            bounds=bounds,
+            zoom=zoom,
+        ))
+
+# アラートのルールの一覧・作成（変更は ROBOT_ALERT_RULE_REFRESH_INTERVAL 秒以内に配信タスクへ反映される）
+class AlertRuleListCreateAPIView(ListCreateAPIView):
+
+    serializer_class = AlertRuleSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return AlertRule.objects.filter(owner=self.request.user).select_related("robot")
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+# アラートのルールの取得・更新・削除
+class AlertRuleDetailAPIView(RetrieveUpdateDestroyAPIView):
+
+    serializer_class = AlertRuleSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return AlertRule.objects.filter(owner=self.request.user).select_related("robot")
+
+#ロボット接続セッション取得
+class RobotConnectionSessionAPIView(ListAPIView):
+
+    serializer_class = RobotConnectionSessionSerializer
+    pagination_class = RobotConnectionSessionPagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        robot = get_object_or_404(Robot, unique_robot_id=self.kwargs['unique_robot_id'], owner=self.request.user)
+        queryset = RobotConnectionSession.objects.filter(robot=robot)
+        return filter_time_range(queryset, self.request.query_params, "connected_at")
+
+# ロボット履歴の一括エクスポート（ストリーミング）
+class RobotStateHistoryExportAPIView(APIView):
+
+    permission_classes = [IsAuthenticated]
+
+    def perform_content_negotiation(self, request, force=False):
+        # ?format= はエクスポート形式として使うため、レンダラーの選択で 404 にしない
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request):
+        export_format = request.query_params.get("format", "ndjson")
+        if export_format not in EXPORT_CONTENT_TYPES:
+            raise ValidationError({"format": f"{', '.join(EXPORT_CONTENT_TYPES)} のいずれかを指定してください。"})
+        if export_format == "parquet" and not parquet_available():
+            raise ValidationError({"format": "parquet 形式には pyarrow が必要です。"})
+
+        robots = Robot.objects.filter(owner=request.user)
+        unique_robot_ids = request.query_params.get("robots")
+        if unique_robot_ids:
+            robots = robots.filter(unique_robot_id__in=unique_robot_ids.split(","))
+        fields = request.query_params.get("fields")
+        fields = [field for field in fields.split(",") if field] if fields else None
+
+        queryset = export_queryset(
+            robots,
+            since=parse_datetime_param(request.query_params, "since"),
+            until=parse_datetime_param(request.query_params, "until"),
+        )
+        chunks = iter_export(queryset, export_format, fields=fields)
+        if settings.SERVE_ASGI:
+            chunks = aiter_export(chunks)
+
+        response = StreamingHttpResponse(chunks, content_type=EXPORT_CONTENT_TYPES[export_format])
+        response["Content-Disposition"] = f'attachment; filename="robot_history.{export_format}"'
+        return response
+
+# Prometheus 形式のメトリクス
+def metrics_view(request):
+    token = settings.ROBOT_METRICS_TOKEN
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse(status=401)
+
+    # バッファ・索引のサイズは収集時にだけ取得する（取り込み処理には負荷をかけない）
+    metrics.SPATIAL_INDEX_ROBOTS.set(len(get_spatial_index()))
+    try:
+        sizes = async_to_sync(get_state_buffer().sizes)()
+        metrics.HISTORY_CACHE_ROWS.set(sizes["history_rows"])
+        metrics.HISTORY_CACHE_ROBOTS.set(sizes["history_robots"])
+        metrics.FRONTEND_PENDING_ROBOTS.set(sizes["frontend_robots"])
+    except Exception as e:
+        logger.error(f"Error collecting buffer sizes: {e}")
+
+    return HttpResponse(metrics.render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
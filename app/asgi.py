@@ -21,6 +21,10 @@ def get_start_tasks():
     from api.consumers import start_tasks
     return start_tasks
 
+def get_stop_tasks():
+    from api.consumers import stop_tasks
+    return stop_tasks
+
 # Lifespan handler for startup and shutdown events
 async def lifespan(scope, receive, send):
     if scope["type"] == "lifespan":
@@ -38,10 +42,12 @@ async def lifespan(scope, receive, send):
 
                     await send({"type": "lifespan.startup.complete"})
                 elif message["type"] == "lifespan.shutdown":
-                    logger.info("ASGI server shutting down. Cancelling tasks.")
+                    logger.info("ASGI server shutting down. Cancelling tasks and flushing buffered states.")
                     for task in tasks:
                         task.cancel()
                     await asyncio.gather(*tasks, return_exceptions=True)
+                    # 定期タスクを止め、フラッシュ待ちの履歴を書き込む
+                    await get_stop_tasks()()
                     await send({"type": "lifespan.shutdown.complete"})
                     break
         except Exception as e:
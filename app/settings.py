@@ -67,6 +67,8 @@ TEMPLATES = [
 # ASGI & WSGIアプリケーション
 WSGI_APPLICATION = "app.wsgi.application"
 ASGI_APPLICATION = "app.asgi.application"
+# ASGI サーバーで配信するか（StreamingHttpResponse に非同期イテレータを渡す。WSGI で配信する場合は False）
+SERVE_ASGI = env.bool("SERVE_ASGI", default=True)
 
 
 # チャンネルレイヤー (Redisバックエンド)
@@ -79,6 +81,127 @@ CHANNEL_LAYERS = {
     },
 }
 
+# ロボット状態バッファ (既定はプロセス内dict、複数ワーカー構成では api.buffers.RedisStateBuffer)
+ROBOT_STATE_BUFFER = {
+    "BACKEND": env("ROBOT_STATE_BUFFER", default="api.buffers.InMemoryStateBuffer"),
+    "OPTIONS": {
+        "url": env(
+            "ROBOT_STATE_BUFFER_URL",
+            default=f"redis://{env('REDIS_HOST', default='127.0.0.1')}:{env('REDIS_PORT', default=6379)}/1",
+        ),
+    },
+}
+
+# ロボット状態履歴の保存ポリシー (mode: interval / deadband / on_change / keep_all)
+# 環境変数 ROBOT_PERSISTENCE_POLICY にJSONで指定すると、所有者・ロボット単位で上書きできる
+ROBOT_PERSISTENCE_POLICY = env.json("ROBOT_PERSISTENCE_POLICY", default={
+    "default": {"mode": "interval", "interval": 5},
+    "owners": {},
+    "robots": {},
+})
+
+# デバイス側の時刻がサーバー時刻よりこの秒数以上進んでいる場合は受信時刻で置き換える
+# （ROBOT_HISTORY_RETENTION_DAYS より古い時刻のサンプルは破棄する）
+ROBOT_MAX_CLOCK_SKEW = env.float("ROBOT_MAX_CLOCK_SKEW", default=300.0)
+
+# ロボット識別情報（robot_id・所有者）のプロセス内キャッシュ
+# REST API での変更は他のワーカーには ROBOT_REGISTRY_TTL 秒以内に反映される
+ROBOT_REGISTRY_TTL = env.float("ROBOT_REGISTRY_TTL", default=60.0)
+ROBOT_REGISTRY_MAX_SIZE = env.int("ROBOT_REGISTRY_MAX_SIZE", default=10000)  # 超えたら最も使われていないものから捨てる
+
+# コンシューマー・定期タスクが DB を呼び出すスレッドプールの上限（プロセスごとに最大でこの合計数の DB 接続を使う）
+ROBOT_DB_POOL_SIZES = {
+    "interactive": env.int("ROBOT_DB_POOL_SIZE", default=8),  # ロボットの登録・フロントエンドの問い合わせ
+    "background": env.int("ROBOT_DB_BACKGROUND_POOL_SIZE", default=2),  # 履歴のフラッシュ・集計
+}
+
+# ロボット状態履歴のフラッシュ間隔（秒）
+ROBOT_FLUSH_INTERVAL = env.int("ROBOT_FLUSH_INTERVAL", default=30)
+
+# フラッシュ待ちのサンプルを追記する先行書き込みログのディレクトリ（空の場合は使わない）
+# 正常終了しなかったプロセスのログは次の起動時に読み戻して書き込む
+# ROBOT_STATE_BUFFER が Redis の場合は書き込み待ちの履歴が Redis に残るので使わない
+ROBOT_SPOOL_DIR = env("ROBOT_SPOOL_DIR", default=str(BASE_DIR / "spool"))
+ROBOT_SPOOL_SYNC_INTERVAL = env.float("ROBOT_SPOOL_SYNC_INTERVAL", default=1.0)  # fsync の間隔（秒）
+
+# ロボット状態履歴の書き込み設定
+ROBOT_FLUSH_BATCH_SIZE = env.int("ROBOT_FLUSH_BATCH_SIZE", default=1000)  # bulk_create 1回あたりの行数
+# 書き込みに失敗した行を再試行する回数。超えた行は RobotStateDeadLetter に隔離する
+# （DB に接続できない場合はフラッシュ全体をやり直すので回数に数えない）
+ROBOT_FLUSH_MAX_ATTEMPTS = env.int("ROBOT_FLUSH_MAX_ATTEMPTS", default=5)
+
+# 検索用に型付きのサイドテーブルへ展開する状態のキー {"キー": "number" | "text"}
+# 例: ROBOT_STATE_SCHEMA='{"battery": "number", "pos_x": "number", "pos_y": "number", "status": "text"}'
+ROBOT_STATE_SCHEMA = env.json("ROBOT_STATE_SCHEMA", default={})
+
+# ロボット状態履歴の保持期間とロールアップ (0 は無期限)
+ROBOT_HISTORY_RETENTION_DAYS = env.int("ROBOT_HISTORY_RETENTION_DAYS", default=30)  # 生データ
+ROBOT_ROLLUP_RETENTION_DAYS = {
+    "minute": env.int("ROBOT_MINUTE_ROLLUP_RETENTION_DAYS", default=180),
+    "hour": env.int("ROBOT_HOUR_ROLLUP_RETENTION_DAYS", default=0),
+}
+ROBOT_HISTORY_MAINTENANCE_INTERVAL = env.int("ROBOT_HISTORY_MAINTENANCE_INTERVAL", default=300)  # 集計・削除の実行間隔（秒）
+# 履歴の id が採番されてからコミットされるまでにかかる最大秒数の見積もり。ロールアップはこの秒数以上前に
+# 記録した id の最大値までだけを集計する（並行するフラッシュで遅れてコミットされた行を取りこぼさないため）
+ROBOT_ROLLUP_COMMIT_LAG = env.int("ROBOT_ROLLUP_COMMIT_LAG", default=60)
+
+# ロボットの位置として扱う状態のキー [x, y]（空の場合は位置の索引・ヒートマップを使わない）
+ROBOT_POSITION_FIELDS = env.list("ROBOT_POSITION_FIELDS", default=["pos_x", "pos_y"])
+# 接続中のロボットの現在位置の索引のグリッド幅（地図座標の単位）
+# 索引はワーカーごとに持つため、複数ワーカー構成では /api/positions/ は応答したワーカーに接続しているロボットだけを返す
+ROBOT_SPATIAL_CELL_SIZE = env.float("ROBOT_SPATIAL_CELL_SIZE", default=1.0)
+# 位置のヒートマップ（履歴のロールアップと同時に所有者・1時間ごとに集計する）
+ROBOT_HEATMAP_TILE_SIZE = env.float("ROBOT_HEATMAP_TILE_SIZE", default=10.0)  # タイル1枚の幅（地図座標の単位）
+ROBOT_HEATMAP_TILE_CELLS = env.int("ROBOT_HEATMAP_TILE_CELLS", default=32)  # タイル1枚の1辺のセル数
+ROBOT_HEATMAP_RETENTION_DAYS = env.int("ROBOT_HEATMAP_RETENTION_DAYS", default=180)  # 保持期間 (0 は無期限)
+
+# アラートのルール（AlertRule）の読み込み間隔と、時間に依存するルール（silent_for）の評価間隔（秒）
+ROBOT_ALERT_RULE_REFRESH_INTERVAL = env.float("ROBOT_ALERT_RULE_REFRESH_INTERVAL", default=10.0)
+ROBOT_ALERT_SWEEP_INTERVAL = env.float("ROBOT_ALERT_SWEEP_INTERVAL", default=1.0)
+
+# ロボット接続セッションの書き込み間隔（秒）と、生存記録が途絶えたセッションを切断済みとみなすまでの秒数
+ROBOT_SESSION_FLUSH_INTERVAL = env.int("ROBOT_SESSION_FLUSH_INTERVAL", default=10)
+ROBOT_SESSION_STALE_SECONDS = env.int("ROBOT_SESSION_STALE_SECONDS", default=60)
+
+# ダッシュボード・詳細ページの表示データのキャッシュ（秒）。ロボットの更新・最新状態の更新時にも無効化する
+ROBOT_DASHBOARD_CACHE_TTL = env.int("ROBOT_DASHBOARD_CACHE_TTL", default=30)
+
+# フロントエンド配信で未送信の差分がこの秒数を超えて溜まったクライアントは切断する
+ROBOT_FRONTEND_MAX_LAG = env.float("ROBOT_FRONTEND_MAX_LAG", default=10.0)
+
+# ロボット接続のアドミッション制御
+# DB を使う接続処理の同時実行数と、空きを待つ秒数（待てなかった接続はクローズコード 4029 で閉じる）
+ROBOT_MAX_PENDING_HANDSHAKES = env.int("ROBOT_MAX_PENDING_HANDSHAKES", default=50)
+ROBOT_HANDSHAKE_TIMEOUT = env.float("ROBOT_HANDSHAKE_TIMEOUT", default=5.0)
+ROBOT_RECONNECT_BACKOFF = env.float("ROBOT_RECONNECT_BACKOFF", default=30.0)  # ロボットに指示する再接続待ちの上限（秒）
+# 受信フレーム数の制限（rate: 1秒あたり, burst: 一時的に許容する数, rate=0 で無制限）
+# 既定は無制限。有効にすると超過したフレームは破棄して {"type": "throttle", "retry_after"} を返すので、
+# ロボットの送信間隔より十分大きい値を設定する（例: ROBOT_MESSAGE_RATE=20, ROBOT_MESSAGE_BURST=40）
+ROBOT_RATE_LIMITS = {
+    "robot": {  # ロボット（接続）ごと
+        "rate": env.float("ROBOT_MESSAGE_RATE", default=0.0),
+        "burst": env.int("ROBOT_MESSAGE_BURST", default=40),
+    },
+    "owner": {  # 所有者ごと（所有者の全ロボットの合計、ワーカーごとに数える）
+        "rate": env.float("ROBOT_OWNER_MESSAGE_RATE", default=0.0),
+        "burst": env.int("ROBOT_OWNER_MESSAGE_BURST", default=4000),
+    },
+}
+ROBOT_THROTTLE_CLOSE_AFTER = env.int("ROBOT_THROTTLE_CLOSE_AFTER", default=200)  # 続けて破棄したフレーム数がこれを超えたら切断する
+
+# フロントエンドの再接続時に送り直せるよう、購読単位ごとに保持する配信済みフレーム数（0.2秒ごとに1フレーム）
+ROBOT_FRONTEND_RESUME_BUFFER = env.int("ROBOT_FRONTEND_RESUME_BUFFER", default=150)
+
+# ダッシュボードに送るフリート集計の対象キー {"キー": "number" | "text"}（オンラインのロボットの最新状態を集計する）
+ROBOT_FLEET_FIELDS = env.json("ROBOT_FLEET_FIELDS", default={
+    "battery": "number", "current": "number", "speed": "number", "status": "text",
+})
+ROBOT_FLEET_REFRESH_INTERVAL = env.float("ROBOT_FLEET_REFRESH_INTERVAL", default=5.0)  # 変化がなくても全所有者に送る間隔（秒）
+ROBOT_FLEET_PRUNE_INTERVAL = env.float("ROBOT_FLEET_PRUNE_INTERVAL", default=60.0)  # 削除されたロボットを集計・アラートから外す間隔（秒）
+
+# /metrics の認証トークン（空の場合は認証なし）
+ROBOT_METRICS_TOKEN = env("ROBOT_METRICS_TOKEN", default="")
+
 # RESTフレームワーク設定
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -95,6 +218,11 @@ DATABASES = {
     "default": env.db("DATABASE_URL", default="sqlite:///db.sqlite3")
 }
 
+# キャッシュ設定（複数ワーカー構成では CACHE_URL に rediscache:// などの共有キャッシュを指定する）
+CACHES = {
+    "default": env.cache("CACHE_URL", default="locmemcache://")
+}
+
 # パスワードバリデーション
 AUTH_PASSWORD_VALIDATORS = [
     {
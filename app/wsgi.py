@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+# WSGI で配信する場合はストリーミングレスポンスに同期イテレータを渡す
+os.environ.setdefault('SERVE_ASGI', 'False')
 
 application = get_wsgi_application()